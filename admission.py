@@ -0,0 +1,204 @@
+"""
+Control de admisión por agente e impresora: límite de trabajos en curso y
+cola de espera acotada, con Retry-After estimado cuando no hay sitio
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+
+
+class AdmissionController:
+    """
+    Cada agente admite como mucho `agent_limit` trabajos en curso y cada una
+    de sus impresoras `printer_limit`. Las peticiones que no caben esperan
+    (hasta `queue_timeout` segundos) en una cola de `max_queue` por agente;
+    con la cola llena se rechazan al instante, así una ráfaga del POS no
+    acapara hilos del VPS ni satura el PC de la tienda.
+
+    Retry-After se calcula con lo que hay por delante y el tiempo medio de
+    servicio del agente (media móvil de los trabajos terminados).
+    """
+
+    def __init__(self, agent_limit=4, printer_limit=2, max_queue=16, queue_timeout=10):
+        self.agent_limit = agent_limit
+        self.printer_limit = printer_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._agents = {}   # agent_id -> {'cond', 'in_flight', 'printers', 'waiting', 'service_time'}
+
+    def _new_state(self):
+        return {'cond': threading.Condition(), 'in_flight': 0, 'printers': {}, 'waiting': 0, 'service_time': 1.0}
+
+    def _state(self, agent_id):
+        state = self._agents.get(agent_id)
+        if state is None:
+            with self._lock:
+                state = self._agents.setdefault(agent_id, self._new_state())
+        return state
+
+    def _fits(self, state, printers):
+        if state['in_flight'] >= self.agent_limit:
+            return False
+        return all(state['printers'].get(printer, 0) < self.printer_limit for printer in printers)
+
+    def _take(self, state, printers):
+        state['in_flight'] += 1
+        for printer in printers:
+            state['printers'][printer] = state['printers'].get(printer, 0) + 1
+
+    def _give(self, state, printers, elapsed):
+        state['in_flight'] -= 1
+        for printer in printers:
+            left = state['printers'].get(printer, 1) - 1
+            if left:
+                state['printers'][printer] = left
+            else:
+                state['printers'].pop(printer, None)
+        if elapsed is not None:
+            state['service_time'] += 0.2 * (elapsed - state['service_time'])
+
+    def _retry_after(self, state, printers):
+        """Segundos estimados hasta que quepa una petición más"""
+        backlog = state['waiting'] + 1
+        slots = min(self.agent_limit, self.printer_limit) if printers else self.agent_limit
+        return max(1, math.ceil(backlog * state['service_time'] / slots))
+
+    def _wait_budget(self, timeout):
+        return self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+
+    def acquire(self, agent_id, printers=(), timeout=None):
+        """(admitido, segundos para Retry-After)"""
+        state = self._state(agent_id)
+        with state['cond']:
+            if self._fits(state, printers):
+                self._take(state, printers)
+                return True, 0
+            if state['waiting'] >= self.max_queue:
+                return False, self._retry_after(state, printers)
+
+            state['waiting'] += 1
+            try:
+                admitted = state['cond'].wait_for(lambda: self._fits(state, printers), self._wait_budget(timeout))
+            finally:
+                state['waiting'] -= 1
+            if not admitted:
+                return False, self._retry_after(state, printers)
+            self._take(state, printers)
+            return True, 0
+
+    def release(self, agent_id, printers=(), elapsed=None):
+        """Liberar el hueco de un trabajo terminado (`elapsed` en segundos)"""
+        state = self._state(agent_id)
+        with state['cond']:
+            self._give(state, printers, elapsed)
+            state['cond'].notify_all()
+
+    def in_flight(self):
+        """{agent_id: trabajos en curso} de los agentes con trabajos"""
+        return {agent_id: state['in_flight'] for agent_id, state in list(self._agents.items()) if state['in_flight']}
+
+    def waiting(self):
+        return sum(state['waiting'] for state in list(self._agents.values()))
+
+    def forget(self, agent_id):
+        with self._lock:
+            state = self._agents.get(agent_id)
+            if state and not state['in_flight'] and not state['waiting']:
+                self._agents.pop(agent_id, None)
+
+
+class SharedAdmissionController(AdmissionController):
+    """
+    Mismos límites repartidos entre los workers de gunicorn
+    (REGISTRY_BACKEND=sqlite): los huecos ocupados viven en la tabla
+    admission_slots, así que `agent_limit` es por agente y no por proceso.
+    Quien espera reintenta cuando se libera un hueco en su worker o cada
+    `poll_interval` segundos (los de otros workers). La cola de espera y el
+    tiempo de servicio para Retry-After siguen siendo de cada proceso.
+    """
+
+    def __init__(self, store, agent_limit=4, printer_limit=2, max_queue=16, queue_timeout=10,
+                 poll_interval=0.05, slot_grace=30):
+        super().__init__(agent_limit, printer_limit, max_queue, queue_timeout)
+        self.store = store
+        self.poll_interval = poll_interval
+        # Margen sobre el timeout del trabajo antes de dar por perdido un hueco
+        self.slot_grace = slot_grace
+        self.owner = str(os.getpid())
+
+    def _admit(self, agent_id, printers, timeout):
+        expires_at = time.time() + (timeout or self.queue_timeout) + self.slot_grace
+        return self.store.admit(
+            agent_id, printers, self.agent_limit, self.printer_limit, self.owner, expires_at
+        )
+
+    def acquire(self, agent_id, printers=(), timeout=None):
+        state = self._state(agent_id)
+        if not self._admit(agent_id, printers, timeout):
+            with state['cond']:
+                if state['waiting'] >= self.max_queue:
+                    return False, self._retry_after(state, printers)
+                state['waiting'] += 1
+
+            deadline = time.time() + self._wait_budget(timeout)
+            try:
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False, self._retry_after(state, printers)
+                    with state['cond']:
+                        state['cond'].wait(min(self.poll_interval, remaining))
+                    if self._admit(agent_id, printers, timeout):
+                        break
+            finally:
+                with state['cond']:
+                    state['waiting'] -= 1
+
+        with state['cond']:
+            self._take(state, printers)
+        return True, 0
+
+    def release(self, agent_id, printers=(), elapsed=None):
+        self.store.release_admission(agent_id, printers, self.owner)
+        super().release(agent_id, printers, elapsed)
+
+    def in_flight(self):
+        return self.store.admission_counts()
+
+
+class AsyncAdmissionController(AdmissionController):
+    """Mismos límites para la edición asyncio: la espera es una corrutina"""
+
+    def _new_state(self):
+        return dict(super()._new_state(), cond=asyncio.Condition())
+
+    async def acquire(self, agent_id, printers=(), timeout=None):
+        state = self._state(agent_id)
+        async with state['cond']:
+            if self._fits(state, printers):
+                self._take(state, printers)
+                return True, 0
+            if state['waiting'] >= self.max_queue:
+                return False, self._retry_after(state, printers)
+
+            state['waiting'] += 1
+            try:
+                await asyncio.wait_for(
+                    state['cond'].wait_for(lambda: self._fits(state, printers)),
+                    self._wait_budget(timeout)
+                )
+            except asyncio.TimeoutError:
+                return False, self._retry_after(state, printers)
+            finally:
+                state['waiting'] -= 1
+            self._take(state, printers)
+            return True, 0
+
+    async def release(self, agent_id, printers=(), elapsed=None):
+        state = self._state(agent_id)
+        async with state['cond']:
+            self._give(state, printers, elapsed)
+            state['cond'].notify_all()
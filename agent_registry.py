@@ -0,0 +1,395 @@
+"""
+Registro de agentes con seguimiento incremental de actividad (online/offline)
+"""
+import bisect
+import heapq
+import threading
+import time
+
+
+def printer_name(printer):
+    """Nombre de una impresora del inventario (dict con 'name' o texto)"""
+    return printer.get('name') if isinstance(printer, dict) else str(printer)
+
+
+class AgentRegistry:
+    """
+    Cada agente online tiene una única entrada (last_seen, agent_id) en un
+    min-heap. Los latidos solo actualizan last_seen; al revisar la cabeza del
+    heap, las entradas desactualizadas se reprograman y las vencidas pasan a
+    offline. Así cada consulta cuesta O(cambios · log n) y no O(agentes).
+
+    Los agentes offline entran en un segundo heap ordenado por last_seen del
+    que se desalojan cuando superan `evict_ttl` o cuando el registro pasa de
+    `max_entries`, de modo que la memoria queda acotada.
+
+    Al registrarse cada agente se indexa por estado, plataforma y nombre de
+    impresora, y se guarda un resumen (plataforma y recuentos), así que
+    `page()` filtra y pagina sin recorrer toda la flota.
+
+    Si se indica `store`, los cambios se persisten (en lote) en SQLite.
+    """
+
+    def __init__(self, online_ttl=60, evict_ttl=None, max_entries=None, on_evict=None, store=None):
+        self.online_ttl = online_ttl
+        self.evict_ttl = evict_ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.store = store
+        self.evicted = 0
+        self._lock = threading.RLock()
+        self._agents = {}     # agent_id -> {'info', 'last_seen', 'status'}
+        self._heap = []       # (last_seen, agent_id) de los agentes online
+        self._offline_heap = []   # (last_seen, agent_id) de los agentes offline
+        self._by_status = {'online': set(), 'offline': set()}
+        self._by_platform = {}    # plataforma -> agent_ids
+        self._by_printer = {}     # nombre de impresora -> agent_ids
+        self._sorted_ids = []     # agent_ids ordenados, para paginar por cursor
+
+    def __contains__(self, agent_id):
+        return agent_id in self._agents
+
+    def __len__(self):
+        return len(self._agents)
+
+    def get(self, agent_id):
+        return self._agents.get(agent_id)
+
+    def restore(self):
+        """Reconstruir el registro desde el store tras un reinicio"""
+        for agent_id, info, last_seen in self.store.load_agents():
+            self._register(agent_id, info, last_seen)
+
+    def register(self, agent_id, info, now=None):
+        """Crear o actualizar un agente y marcarlo online"""
+        now = now or time.time()
+        record = self._register(agent_id, info, now)
+        if self.store:
+            self.store.upsert_agent(agent_id, info, now)
+        return record
+
+    def _register(self, agent_id, info, now):
+        with self._lock:
+            record = self._agents.get(agent_id)
+            is_new = record is None
+            if is_new:
+                record = {'info': info, 'last_seen': now, 'status': 'offline'}
+                self._agents[agent_id] = record
+                self._by_status['offline'].add(agent_id)
+                bisect.insort(self._sorted_ids, agent_id)
+            else:
+                self._unindex(agent_id, record)
+                record['info'] = info
+            self._index(agent_id, record)
+            self._mark_seen(agent_id, record, now)
+        
+        if is_new and self.max_entries is not None and len(self._agents) > self.max_entries:
+            self.expire(now)
+        return record
+
+    def touch(self, agent_id, now=None):
+        """Registrar actividad de un agente; False si no está registrado"""
+        with self._lock:
+            record = self._agents.get(agent_id)
+            if record is None:
+                return False
+            now = now or time.time()
+            self._mark_seen(agent_id, record, now)
+        if self.store:
+            self.store.touch_agent(agent_id, now)
+        return True
+
+    def request_refresh(self, agent_id):
+        """Marcar que el próximo latido debe pedir el inventario completo"""
+        record = self._agents.get(agent_id)
+        if record is None:
+            return False
+        record['refresh_inventory'] = True
+        return True
+
+    def pop_refresh(self, agent_id):
+        """True si había una petición de inventario pendiente (y la consume)"""
+        record = self._agents.get(agent_id)
+        return bool(record and record.pop('refresh_inventory', False))
+
+    def _index(self, agent_id, record):
+        info = record['info']
+        record['summary'] = {
+            'platform': info.get('platform', 'Unknown'),
+            'printers_count': len(info.get('printers', [])),
+            'scales_count': len(info.get('scales', []))
+        }
+        record['printer_names'] = {printer_name(printer) for printer in info.get('printers', [])}
+        self._by_platform.setdefault(record['summary']['platform'], set()).add(agent_id)
+        for name in record['printer_names']:
+            self._by_printer.setdefault(name, set()).add(agent_id)
+
+    def _unindex(self, agent_id, record):
+        for index, keys in ((self._by_platform, [record['summary']['platform']]),
+                            (self._by_printer, record['printer_names'])):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(agent_id)
+                    if not ids:
+                        del index[key]
+
+    def _mark_seen(self, agent_id, record, now):
+        record['last_seen'] = now
+        if record['status'] != 'online':
+            self._set_status(agent_id, record, 'online')
+            heapq.heappush(self._heap, (now, agent_id))
+
+    def _set_status(self, agent_id, record, status):
+        self._by_status[record['status']].discard(agent_id)
+        self._by_status[status].add(agent_id)
+        record['status'] = status
+
+    def expire(self, now=None):
+        """Pasar a offline los agentes vencidos y desalojar los muertos; devuelve los que cambiaron"""
+        now = now or time.time()
+        deadline = now - self.online_ttl
+        changed = []
+        evicted = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= deadline:
+                seen, agent_id = heapq.heappop(heap)
+                record = self._agents.get(agent_id)
+                if record is None or record['status'] != 'online':
+                    continue
+                if record['last_seen'] > seen:
+                    # Hubo latidos desde que se programó: reprogramar
+                    heapq.heappush(heap, (record['last_seen'], agent_id))
+                    continue
+                self._set_status(agent_id, record, 'offline')
+                heapq.heappush(self._offline_heap, (record['last_seen'], agent_id))
+                changed.append(agent_id)
+            
+            evicted = self._evict(now)
+        
+        for agent_id in evicted:
+            if self.store:
+                self.store.archive_agent(agent_id)
+            if self.on_evict:
+                self.on_evict(agent_id)
+        return changed
+
+    def _evict(self, now):
+        offline = self._offline_heap
+        evicted = []
+        while offline:
+            seen, agent_id = offline[0]
+            record = self._agents.get(agent_id)
+            if record is None or record['status'] != 'offline' or record['last_seen'] != seen:
+                # Entrada obsoleta: el agente volvió o ya fue desalojado
+                heapq.heappop(offline)
+                continue
+            
+            too_old = self.evict_ttl is not None and seen <= now - self.evict_ttl
+            too_many = self.max_entries is not None and len(self._agents) > self.max_entries
+            if not (too_old or too_many):
+                break
+            
+            heapq.heappop(offline)
+            del self._agents[agent_id]
+            self._by_status['offline'].discard(agent_id)
+            self._unindex(agent_id, record)
+            position = bisect.bisect_left(self._sorted_ids, agent_id)
+            del self._sorted_ids[position]
+            self.evicted += 1
+            evicted.append(agent_id)
+        return evicted
+
+    def ids(self, status=None):
+        """Ids de los agentes, opcionalmente filtrados por estado"""
+        self.expire()
+        with self._lock:
+            if status is None:
+                return list(self._agents)
+            return list(self._by_status.get(status, ()))
+
+    def items(self, status=None):
+        """Pares (agent_id, registro), opcionalmente filtrados por estado"""
+        return [(agent_id, self._agents[agent_id]) for agent_id in self.ids(status)
+                if agent_id in self._agents]
+
+    def counts(self):
+        """Número de agentes por estado"""
+        self.expire()
+        with self._lock:
+            return {status: len(ids) for status, ids in self._by_status.items()}
+
+    def device_counts(self):
+        """(impresoras, básculas) declaradas por los agentes online"""
+        printers = scales = 0
+        for _, record in self.items('online'):
+            printers += record['summary']['printers_count']
+            scales += record['summary']['scales_count']
+        return printers, scales
+
+    def page(self, status=None, platform=None, printer=None, limit=None, cursor=None):
+        """
+        Resúmenes de agentes filtrados, en orden de agent_id y a partir de
+        `cursor` (el último agent_id de la página anterior). Devuelve
+        (agentes, siguiente cursor o None).
+        """
+        self.expire()
+        with self._lock:
+            filters = []
+            if status is not None:
+                filters.append(self._by_status.get(status, set()))
+            if platform is not None:
+                filters.append(self._by_platform.get(platform, set()))
+            if printer is not None:
+                filters.append(self._by_printer.get(printer, set()))
+            filters.sort(key=len)
+            wanted = limit + 1 if limit is not None else None
+
+            ids = self._sorted_ids
+            if filters and len(filters[0]) * 8 < len(ids):
+                # Filtro selectivo: ordenar solo los candidatos del índice más pequeño
+                candidates = (
+                    agent_id for agent_id in filters[0]
+                    if (cursor is None or agent_id > cursor) and all(agent_id in f for f in filters[1:])
+                )
+                selected = heapq.nsmallest(wanted, candidates) if wanted else sorted(candidates)
+            else:
+                # Poco selectivo: recorrer el orden global desde el cursor
+                start = bisect.bisect_right(ids, cursor) if cursor is not None else 0
+                selected = []
+                for position in range(start, len(ids)):
+                    agent_id = ids[position]
+                    if all(agent_id in f for f in filters):
+                        selected.append(agent_id)
+                        if wanted and len(selected) == wanted:
+                            break
+
+            more = wanted is not None and len(selected) == wanted
+            selected = selected[:limit]
+            agents = []
+            for agent_id in selected:
+                record = self._agents[agent_id]
+                agents.append(dict(
+                    record['summary'],
+                    agent_id=agent_id,
+                    status=record['status'],
+                    last_seen=record['last_seen']
+                ))
+        return agents, (selected[-1] if more else None)
+
+
+class SQLiteAgentRegistry:
+    """
+    Registro compartido entre procesos (varios workers de gunicorn) sobre la
+    tabla agents de SQLite. El estado online se deriva de last_seen con el
+    índice idx_agents_last_seen, así que un latido recibido por un worker es
+    visible para todos. Misma interfaz que AgentRegistry.
+    """
+
+    def __init__(self, store, online_ttl=60, evict_ttl=None, max_entries=None, on_evict=None,
+                 evict_interval=60):
+        self.store = store
+        self.online_ttl = online_ttl
+        self.evict_ttl = evict_ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.evict_interval = evict_interval
+        self.evicted = 0
+        self._last_evict = 0
+        self._lock = threading.Lock()
+
+    def _record(self, info, last_seen, now=None):
+        online = last_seen >= (now or time.time()) - self.online_ttl
+        return {'info': info, 'last_seen': last_seen, 'status': 'online' if online else 'offline'}
+
+    def __contains__(self, agent_id):
+        return self.store.get_agent(agent_id) is not None
+
+    def __len__(self):
+        return self.store.count_agents(time.time() - self.online_ttl)[1]
+
+    def get(self, agent_id):
+        row = self.store.get_agent(agent_id)
+        return self._record(*row) if row else None
+
+    def restore(self):
+        pass
+
+    def register(self, agent_id, info, now=None):
+        """Crear o actualizar un agente; se escribe de inmediato para los demás workers"""
+        now = now or time.time()
+        self.store.upsert_agent(agent_id, info, now, sync=True)
+        return self._record(info, now, now)
+
+    def touch(self, agent_id, now=None):
+        """Registrar actividad de un agente; False si no está registrado"""
+        if agent_id not in self:
+            return False
+        self.store.touch_agent(agent_id, now or time.time())
+        return True
+
+    def request_refresh(self, agent_id):
+        return self.store.set_refresh(agent_id, True) > 0
+
+    def pop_refresh(self, agent_id):
+        return self.store.pop_refresh(agent_id)
+
+    def expire(self, now=None):
+        """Desalojar agentes muertos (como mucho una vez cada `evict_interval`)"""
+        now = now or time.time()
+        with self._lock:
+            if now - self._last_evict < self.evict_interval:
+                return []
+            self._last_evict = now
+
+        evicted = self.store.evict_agents(
+            seen_before=now - self.evict_ttl if self.evict_ttl is not None else None,
+            keep=self.max_entries,
+            offline_before=now - self.online_ttl
+        )
+        self.evicted += len(evicted)
+        if self.on_evict:
+            for agent_id in evicted:
+                self.on_evict(agent_id)
+        return []
+
+    def ids(self, status=None):
+        return [agent_id for agent_id, _ in self.items(status)]
+
+    def items(self, status=None):
+        self.expire()
+        now = time.time()
+        return [
+            (agent_id, self._record(info, last_seen, now))
+            for agent_id, info, last_seen in self.store.list_agents(now - self.online_ttl, status)
+        ]
+
+    def counts(self):
+        self.expire()
+        online, total = self.store.count_agents(time.time() - self.online_ttl)
+        return {'online': online, 'offline': total - online}
+
+    def device_counts(self):
+        return self.store.device_counts(time.time() - self.online_ttl)
+
+    def page(self, status=None, platform=None, printer=None, limit=None, cursor=None):
+        self.expire()
+        now = time.time()
+        rows = self.store.page_agents(
+            now - self.online_ttl, status, platform, printer,
+            limit + 1 if limit is not None else None, cursor
+        )
+        more = limit is not None and len(rows) > limit
+        agents = [
+            {
+                'agent_id': agent_id,
+                'platform': platform_name or 'Unknown',
+                'status': 'online' if last_seen >= now - self.online_ttl else 'offline',
+                'last_seen': last_seen,
+                'printers_count': printers_count or 0,
+                'scales_count': scales_count or 0
+            }
+            for agent_id, platform_name, last_seen, printers_count, scales_count in rows[:limit]
+        ]
+        return agents, (agents[-1]['agent_id'] if more else None)
@@ -0,0 +1,496 @@
+"""
+Edición asyncio (ASGI) de la API del VPS - mismas rutas que app_ultralight.py
+
+Cada impresión o lectura de báscula en curso es una corrutina esperando un
+Future, no un hilo del sistema, así que un solo proceso aguanta decenas de
+miles de operaciones simultáneas. Un solo proceso por diseño: registro y cola
+viven en memoria (persistidos en SQLite como en app_ultralight.py). La lógica
+que no depende del modelo de concurrencia está en connector_core.py.
+
+    hypercorn app_async:app --bind 0.0.0.0:5000
+"""
+from quart import Quart, request, websocket, jsonify, g, redirect
+from quart.wrappers.response import DataBody
+import asyncio
+import os
+import time
+import json
+from job_queue import AsyncJobQueue
+from agent_registry import AgentRegistry
+from storage import SQLiteStore
+from idempotency import AsyncIdempotencyCache
+from serialization import select_json_provider, negotiate_encoding, compress
+from sharding import response_headers, websocket_url
+from admission import AsyncAdmissionController
+from scale_streams import AsyncScaleStreamHub, sse_event, SSE_KEEPALIVE
+from connector_core import (
+    ConnectorCore, telemetry, REQUEST_LATENCY, BODY_AGENT_ROUTES, ADMISSION_SETTINGS, STORE_SETTINGS,
+    MAX_POLL_WAIT, PRINT_TIMEOUT, SCALE_TIMEOUT, MAX_AGENTS_PAGE, SCALE_WATCH_LEASE,
+    SCALE_STREAM_QUEUE, SSE_KEEPALIVE_INTERVAL, COMPRESS_MIN_SIZE, COMPRESS_LEVEL,
+    server_timing_header, count_print_outcomes, retry_headers, job_printers, throttled_response,
+    batch_error, is_final_print_response, idempotent_response, is_event_stream, cached_reading_response
+)
+
+app = Quart(__name__)
+
+# Serializador JSON elegido al arrancar (orjson si está instalado)
+app.json = select_json_provider(os.getenv('JSON_BACKEND', 'auto'))(app)
+
+# Persistencia de agentes, historial de trabajos y lecturas (SQLite WAL)
+DB_PATH = os.getenv('DB_PATH', 'pos_connector.db')
+store = SQLiteStore(DB_PATH, **STORE_SETTINGS)
+
+# Cola de trabajos que los agentes drenan por long-poll o WebSocket
+job_queue = AsyncJobQueue(max_batch=int(os.getenv('JOB_BATCH_SIZE', 50)), store=store)
+
+# Respuestas de impresión ya servidas, por Idempotency-Key
+idempotency_cache = AsyncIdempotencyCache(
+    max_entries=int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 10000)),
+    ttl=int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+)
+
+# Lecturas continuas de báscula para los clientes SSE
+scale_streams = AsyncScaleStreamHub(max_queue=SCALE_STREAM_QUEUE)
+renewal_tasks = set()
+admission = AsyncAdmissionController(**ADMISSION_SETTINGS)
+
+# Registro, breaker, webhooks, muestreador y sharding comunes con app_ultralight.py
+core = ConnectorCore(store, job_queue, AgentRegistry, admission, scale_streams, DB_PATH).start()
+agents = core.agents
+breaker = core.breaker
+shard = core.shard
+
+@app.before_serving
+async def bind_event_loop():
+    # Los desalojos del muestreador se programan en este bucle
+    core.loop = asyncio.get_running_loop()
+
+@app.route('/')
+async def index():
+    return jsonify({
+        'status': 'running',
+        'message': 'POS Device Connector API - Async',
+        'version': '1.0.0',
+        'environment': os.getenv('FLASK_ENV', 'development')
+    })
+
+@app.route('/health')
+async def health():
+    return jsonify(core.health())
+
+@app.route('/metrics')
+async def metrics():
+    return jsonify(dict(core.sampler.snapshot(), status='ok', tasks_running=len(asyncio.all_tasks())))
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def observe_request(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(elapsed, request.method, route, str(response.status_code))
+
+        # Desglose por salto (VPS → agente → dispositivo) que dejó dispatch_to_agent
+        response.headers['Server-Timing'] = server_timing_header(getattr(g, 'server_timing', None), elapsed)
+    return response
+
+@app.after_request
+async def compress_response(response):
+    if (not isinstance(response.response, DataBody)
+            or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < COMPRESS_MIN_SIZE):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    response.set_data(compress(await response.get_data(), encoding, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/metrics/prometheus')
+async def prometheus_metrics():
+    return telemetry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+async def request_agent_id():
+    agent_id = (request.view_args or {}).get('agent_id')
+    if agent_id is None and request.path in BODY_AGENT_ROUTES:
+        agent_id = (await request.get_json(silent=True) or {}).get('agent_id')
+    return agent_id
+
+@app.before_request
+async def route_to_owner():
+    """Atender aquí solo a los agentes de este nodo; el resto va a su dueño"""
+    if not shard.enabled:
+        return None
+    owner = core.remote_owner(await request_agent_id(), request.headers)
+    if owner is None:
+        return None
+
+    # requests es bloqueante: el reenvío va a un hilo del pool por defecto
+    forwarded, timings = await asyncio.to_thread(
+        core.forward_to_owner, owner, request.method, request.path, request.query_string,
+        dict(request.headers), await request.get_data()
+    )
+    if timings is None:
+        return jsonify(forwarded), 502
+
+    g.server_timing = timings
+    if is_event_stream(forwarded):
+        # Streams SSE: pasar cada trama en cuanto llega del nodo dueño
+        response = await app.make_response(
+            (stream_forwarded(forwarded), forwarded.status_code, response_headers(forwarded))
+        )
+        response.timeout = None
+        return response
+    content = await asyncio.to_thread(lambda: forwarded.content)
+    return app.response_class(content, forwarded.status_code, response_headers(forwarded))
+
+async def stream_forwarded(forwarded):
+    chunks = forwarded.iter_content(chunk_size=None)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        forwarded.close()
+
+@app.before_websocket
+async def redirect_channel_to_owner():
+    """Un WebSocket no se puede reenviar: el agente sigue la redirección hasta su dueño"""
+    owner = core.remote_owner((websocket.view_args or {}).get('agent_id'), websocket.headers)
+    if owner is None:
+        return None
+    target = websocket.path + (f"?{websocket.query_string.decode()}" if websocket.query_string else '')
+    return redirect(websocket_url(owner) + target, 307)
+
+@app.route('/shard')
+async def shard_info():
+    """Nodos del anillo y, con ?agent_id=, el nodo dueño de ese agente"""
+    return jsonify(core.shard_info(request.args.get('agent_id')))
+
+@app.route('/agent/register', methods=['POST'])
+async def agent_register():
+    """Registrar agente local"""
+    try:
+        return jsonify(core.register_response(await request.get_json()))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/inventory/refresh', methods=['POST'])
+async def request_inventory_refresh(agent_id):
+    """Pedir al agente que re-escanee y envíe su inventario en el próximo latido"""
+    if not agents.request_refresh(agent_id):
+        return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+    return jsonify({'success': True, 'agent_id': agent_id})
+
+@app.route('/agent/print-completed', methods=['POST'])
+async def agent_print_completed():
+    """Recibir notificación de impresión completada"""
+    try:
+        data = await request.get_json()
+        core.handle_print_completed(data.get('agent_id'), data.get('result'))
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/scale-reading', methods=['POST'])
+async def agent_scale_reading():
+    """Recibir lectura de báscula de agente"""
+    try:
+        core.handle_agent_event(await request.get_json())
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agents', methods=['GET'])
+async def get_agents():
+    """
+    Obtener lista de agentes conectados; filtros ?status=&platform=&has_printer=
+    y paginación ?limit=&cursor= (cursor = next_cursor de la página anterior)
+    """
+    try:
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, MAX_AGENTS_PAGE))
+
+        agents_list, next_cursor = agents.page(
+            status=request.args.get('status'),
+            platform=request.args.get('platform'),
+            printer=request.args.get('has_printer'),
+            limit=limit,
+            cursor=request.args.get('cursor')
+        )
+
+        return jsonify({
+            'success': True,
+            'agents': agents_list,
+            'total': len(agents_list),
+            'next_cursor': next_cursor
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/jobs', methods=['GET'])
+async def get_jobs():
+    """Historial de trabajos, filtrable por agente y estado"""
+    try:
+        # La consulta a SQLite bloquea: fuera del bucle de eventos
+        jobs = await asyncio.to_thread(
+            store.job_history,
+            agent_id=request.args.get('agent_id'),
+            status=request.args.get('status'),
+            before=request.args.get('before', type=float),
+            limit=min(request.args.get('limit', 50, type=int), 500)
+        )
+        return jsonify({
+            'success': True,
+            'jobs': jobs,
+            'total': len(jobs)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/jobs', methods=['GET'])
+async def agent_fetch_jobs(agent_id):
+    """Long-poll del agente para recoger trabajos pendientes"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        wait = min(float(request.args.get('wait', 25)), MAX_POLL_WAIT)
+        max_jobs = request.args.get('max', type=int)
+
+        core.touch_agent(agent_id)
+        jobs = await job_queue.fetch(agent_id, wait=wait, max_jobs=max_jobs)
+        core.touch_agent(agent_id)
+
+        return jsonify({
+            'success': True,
+            'jobs': jobs
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/jobs/results', methods=['POST'])
+async def agent_job_results(agent_id):
+    """Recibir en lote los resultados de los trabajos ejecutados por el agente"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        data = await request.get_json()
+        accepted = core.accept_results(agent_id, data.get('results', []))
+
+        return jsonify({
+            'success': True,
+            'accepted': accepted
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.websocket('/agent/<agent_id>/ws')
+async def agent_channel(agent_id):
+    """Canal persistente iniciado por el agente: latidos, comandos y resultados"""
+
+    async def pump_jobs():
+        # Reenviar al agente los trabajos de su cola en cuanto llegan
+        while True:
+            if agent_id not in agents:
+                await asyncio.sleep(1)
+                continue
+            jobs = await job_queue.fetch(agent_id, wait=MAX_POLL_WAIT)
+            for index, job in enumerate(jobs):
+                try:
+                    await websocket.send(json.dumps({'type': 'job', 'id': job['job_id'], 'job': job}))
+                except BaseException:
+                    # Canal cerrado o tarea cancelada: que lo recoja otra conexión
+                    job_queue.requeue(agent_id, jobs[index:])
+                    raise
+
+    await websocket.accept()
+    print(f"🔌 Canal WebSocket abierto: {agent_id}")
+    pump = asyncio.ensure_future(pump_jobs())
+
+    try:
+        while True:
+            raw = await websocket.receive()
+            reply = core.handle_channel_message(agent_id, json.loads(raw))
+            if reply is not None:
+                await websocket.send(json.dumps(reply))
+    finally:
+        pump.cancel()
+        print(f"🔌 Canal WebSocket cerrado: {agent_id}")
+
+async def dispatch_to_agent(agent_id, job_type, payload, timeout):
+    """Encolar un trabajo y esperar la respuesta del agente; devuelve (cuerpo, status)"""
+    unavailable = core.unavailable_response(agent_id)
+    if unavailable:
+        count_print_outcomes(job_type, *unavailable)
+        return unavailable
+
+    printers = job_printers(job_type, payload)
+    waiting_since = time.perf_counter()
+    admitted, retry_after = await admission.acquire(agent_id, printers, timeout)
+    if not admitted:
+        return throttled_response(job_type, retry_after)
+
+    started = time.perf_counter()
+    try:
+        # La prueba half-open se toma justo antes de enviar: cualquier salida
+        # que no llegue a finish_forward la devuelve
+        unavailable, probe = core.breaker_response(agent_id)
+        if unavailable:
+            count_print_outcomes(job_type, *unavailable)
+            return unavailable
+        try:
+            return await forward_job(agent_id, job_type, payload, timeout - (started - waiting_since))
+        finally:
+            if probe:
+                breaker.release_probe(agent_id)
+    finally:
+        await admission.release(agent_id, printers, time.perf_counter() - started)
+
+async def forward_job(agent_id, job_type, payload, timeout):
+    """Enviar un trabajo ya admitido al agente y esperar su resultado"""
+    started = time.perf_counter()
+    job = job_queue.submit(agent_id, job_type, payload)
+    result = await job_queue.wait_result(agent_id, job['job_id'], timeout)
+    response, g.server_timing = core.finish_forward(
+        agent_id, job_type, job['job_id'], result, (time.perf_counter() - started) * 1000
+    )
+    return response
+
+async def dispatch_print(agent_id, job_type, payload):
+    """Despachar una impresión respetando la cabecera Idempotency-Key"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        body, status = await dispatch_to_agent(agent_id, job_type, payload, PRINT_TIMEOUT)
+        return jsonify(body), status, retry_headers(body)
+
+    # El agente también deduplica con la misma clave (p. ej. tras un reinicio del VPS)
+    payload = dict(payload, idempotency_key=key)
+    response, replayed = await idempotency_cache.run(
+        f"{agent_id}:{key}",
+        lambda: dispatch_to_agent(agent_id, job_type, payload, PRINT_TIMEOUT),
+        wait_timeout=PRINT_TIMEOUT,
+        cache_if=is_final_print_response
+    )
+    body, status, headers = idempotent_response(response, replayed)
+    return jsonify(body), status, headers
+
+@app.route('/agent/<agent_id>/print', methods=['POST'])
+async def print_via_agent(agent_id):
+    """Imprimir via agente específico"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        return await dispatch_print(agent_id, 'print', await request.get_json())
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/print/batch', methods=['POST'])
+async def print_batch_via_agent(agent_id):
+    """Imprimir una ráfaga de tickets en un solo viaje al agente"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        jobs = (await request.get_json()).get('jobs') or []
+        error = batch_error(jobs)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+
+        return await dispatch_print(agent_id, 'print_batch', {'jobs': jobs})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/scale/read', methods=['POST'])
+async def read_scale_via_agent(agent_id):
+    """Leer báscula via agente específico"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        data = await request.get_json()
+
+        # Lectura reciente ya conocida: se responde sin ir al agente
+        max_age_ms = request.args.get('max_age_ms', type=float)
+        if max_age_ms is not None:
+            reading = core.cached_scale_reading(agent_id, data.get('scale_port'), max_age_ms / 1000)
+            if reading is not None:
+                return jsonify(cached_reading_response(reading))
+
+        body, status = await dispatch_to_agent(agent_id, 'scale_read', data, SCALE_TIMEOUT)
+        return jsonify(body), status, retry_headers(body)
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+async def renew_scale_watch(agent_id, port):
+    """Pedir al agente que siga leyendo la báscula otros SCALE_WATCH_LEASE segundos"""
+    job = job_queue.submit(agent_id, 'scale_watch', core.scale_watch_payload(port))
+    result = await job_queue.wait_result(agent_id, job['job_id'], SCALE_TIMEOUT)
+    core.finish_scale_watch(agent_id, port, job['job_id'], result)
+
+@app.route('/agent/<agent_id>/scale/<path:port>/stream', methods=['GET'])
+async def stream_scale(agent_id, port):
+    """Lecturas continuas de una báscula como Server-Sent Events"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        # Sin breaker: el stream no envía trabajos cuyo resultado lo cierre
+        unavailable = core.offline_response(agent_id)
+        if unavailable:
+            body, status = unavailable
+            return jsonify(body), status, retry_headers(body)
+
+        subscription = scale_streams.subscribe(agent_id, port)
+        print(f"📡 Stream de báscula abierto: {agent_id} {port}")
+
+        async def events():
+            try:
+                latest = scale_streams.latest(agent_id, port)
+                if latest:
+                    yield sse_event(latest).encode()
+                while True:
+                    # Un solo cliente por (agente, puerto) renueva el lease
+                    if scale_streams.claim_renewal(agent_id, port, SCALE_WATCH_LEASE / 3):
+                        task = asyncio.ensure_future(renew_scale_watch(agent_id, port))
+                        renewal_tasks.add(task)
+                        task.add_done_callback(renewal_tasks.discard)
+                    reading = await scale_streams.next_reading(
+                        subscription, min(SSE_KEEPALIVE_INTERVAL, SCALE_WATCH_LEASE / 3)
+                    )
+                    yield (SSE_KEEPALIVE if reading is None else sse_event(reading)).encode()
+            finally:
+                scale_streams.unsubscribe(agent_id, port, subscription)
+                print(f"📡 Stream de báscula cerrado: {agent_id} {port}")
+
+        response = await app.make_response((events(), 200, {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }))
+        # Sin límite de duración para la respuesta (RESPONSE_TIMEOUT de Quart)
+        response.timeout = None
+        return response
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+if __name__ == '__main__':
+    port = int(os.getenv('PORT', 5000))
+    app.run(host='0.0.0.0', port=port, debug=False)
@@ -1,11 +1,78 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, redirect
 import os
 import time
+import json
+import threading
+from job_queue import JobQueue, SharedJobQueue
+from agent_registry import AgentRegistry, SQLiteAgentRegistry
+from storage import SQLiteStore
+from idempotency import IdempotencyCache
+from serialization import select_json_provider, negotiate_encoding, compress
+from sharding import response_headers, websocket_url
+from admission import AdmissionController, SharedAdmissionController
+from scale_streams import ScaleStreamHub, SharedScaleStreamHub, sse_event, SSE_KEEPALIVE
+from connector_core import (
+    ConnectorCore, telemetry, REQUEST_LATENCY, BODY_AGENT_ROUTES, ADMISSION_SETTINGS, STORE_SETTINGS,
+    MAX_POLL_WAIT, PRINT_TIMEOUT, SCALE_TIMEOUT, MAX_AGENTS_PAGE, SCALE_WATCH_LEASE,
+    SCALE_STREAM_QUEUE, SSE_KEEPALIVE_INTERVAL, COMPRESS_MIN_SIZE, COMPRESS_LEVEL,
+    server_timing_header, count_print_outcomes, retry_headers, job_printers, throttled_response,
+    batch_error, is_final_print_response, idempotent_response, is_event_stream, cached_reading_response
+)
+
+# Canal WebSocket opcional (flask-sock); sin él los agentes usan long-poll
+try:
+    from flask_sock import Sock
+    SOCK_AVAILABLE = True
+except ImportError:
+    SOCK_AVAILABLE = False
 
 app = Flask(__name__)
 
-# Almacenamiento simplificado
-agents = {}
+# Serializador JSON elegido al arrancar (orjson si está instalado)
+app.json = select_json_provider(os.getenv('JSON_BACKEND', 'auto'))(app)
+sock = Sock(app) if SOCK_AVAILABLE else None
+
+# Persistencia de agentes, historial de trabajos y lecturas (SQLite WAL)
+DB_PATH = os.getenv('DB_PATH', 'pos_connector.db')
+store = SQLiteStore(DB_PATH, **STORE_SETTINGS)
+
+# 'memory': registro y cola en este proceso (un solo worker)
+# 'sqlite': registro y cola compartidos entre workers de gunicorn
+REGISTRY_BACKEND = os.getenv('REGISTRY_BACKEND', 'memory')
+JOB_BATCH_SIZE = int(os.getenv('JOB_BATCH_SIZE', 50))
+SHARED_POLL_INTERVAL = float(os.getenv('SHARED_POLL_INTERVAL', 0.05))
+
+# Cola de trabajos que los agentes drenan con long-poll y lecturas continuas de
+# báscula para los clientes SSE (repartidas entre workers a través de SQLite)
+if REGISTRY_BACKEND == 'sqlite':
+    job_queue = SharedJobQueue(store, max_batch=JOB_BATCH_SIZE, poll_interval=SHARED_POLL_INTERVAL)
+    scale_streams = SharedScaleStreamHub(store, max_queue=SCALE_STREAM_QUEUE, poll_interval=SHARED_POLL_INTERVAL)
+else:
+    job_queue = JobQueue(max_batch=JOB_BATCH_SIZE, store=store)
+    scale_streams = ScaleStreamHub(max_queue=SCALE_STREAM_QUEUE)
+
+# Respuestas de impresión ya servidas, por Idempotency-Key
+idempotency_cache = IdempotencyCache(
+    max_entries=int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 10000)),
+    ttl=int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+)
+
+# Con varios workers los huecos en curso se cuentan en SQLite: el límite es por agente
+if REGISTRY_BACKEND == 'sqlite':
+    admission = SharedAdmissionController(store, poll_interval=SHARED_POLL_INTERVAL, **ADMISSION_SETTINGS)
+else:
+    admission = AdmissionController(**ADMISSION_SETTINGS)
+
+# Registro, breaker, webhooks, muestreador y sharding comunes con app_async.py
+core = ConnectorCore(
+    store, job_queue,
+    SQLiteAgentRegistry if REGISTRY_BACKEND == 'sqlite' else AgentRegistry,
+    admission, scale_streams, DB_PATH,
+    shared=REGISTRY_BACKEND == 'sqlite'
+).start()
+agents = core.agents
+breaker = core.breaker
+shard = core.shard
 
 @app.route('/')
 def index():
@@ -18,90 +85,343 @@ def index():
 
 @app.route('/health')
 def health():
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': time.time()
-    })
+    return jsonify(core.health())
 
 @app.route('/metrics')
 def metrics():
-    return jsonify({
-        'status': 'ok',
-        'agents_count': len(agents)
-    })
+    return jsonify(dict(core.sampler.snapshot(), status='ok'))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(elapsed, request.method, route, str(response.status_code))
+
+        # Desglose por salto (VPS → agente → dispositivo) que dejó dispatch_to_agent
+        response.headers['Server-Timing'] = server_timing_header(getattr(g, 'server_timing', None), elapsed)
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < COMPRESS_MIN_SIZE):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/metrics/prometheus')
+def prometheus_metrics():
+    return telemetry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def request_agent_id():
+    agent_id = (request.view_args or {}).get('agent_id')
+    if agent_id is None and request.path in BODY_AGENT_ROUTES:
+        agent_id = (request.get_json(silent=True) or {}).get('agent_id')
+    return agent_id
+
+@app.before_request
+def route_to_owner():
+    """Atender aquí solo a los agentes de este nodo; el resto va a su dueño"""
+    if not shard.enabled:
+        return None
+    owner = core.remote_owner(request_agent_id(), request.headers)
+    if owner is None:
+        return None
+
+    # Un WebSocket no se puede reenviar: el agente sigue la redirección hasta su dueño
+    if request.url_rule and request.url_rule.rule == '/agent/<agent_id>/ws':
+        target = request.path + (f"?{request.query_string.decode()}" if request.query_string else '')
+        return redirect(websocket_url(owner) + target, 307)
+
+    forwarded, timings = core.forward_to_owner(
+        owner, request.method, request.path, request.query_string, request.headers, request.get_data()
+    )
+    if timings is None:
+        return jsonify(forwarded), 502
+
+    g.server_timing = timings
+    if is_event_stream(forwarded):
+        # Streams SSE: pasar cada trama en cuanto llega del nodo dueño
+        return Response(
+            stream_forwarded(forwarded), forwarded.status_code, response_headers(forwarded)
+        )
+    return app.response_class(forwarded.content, forwarded.status_code, response_headers(forwarded))
+
+def stream_forwarded(forwarded):
+    try:
+        yield from forwarded.iter_content(chunk_size=None)
+    finally:
+        forwarded.close()
+
+@app.route('/shard')
+def shard_info():
+    """Nodos del anillo y, con ?agent_id=, el nodo dueño de ese agente"""
+    return jsonify(core.shard_info(request.args.get('agent_id')))
 
 @app.route('/agent/register', methods=['POST'])
 def agent_register():
     """Registrar agente local"""
+    try:
+        return jsonify(core.register_response(request.json))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/inventory/refresh', methods=['POST'])
+def request_inventory_refresh(agent_id):
+    """Pedir al agente que re-escanee y envíe su inventario en el próximo latido"""
+    if not agents.request_refresh(agent_id):
+        return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+    return jsonify({'success': True, 'agent_id': agent_id})
+
+@app.route('/agent/print-completed', methods=['POST'])
+def agent_print_completed():
+    """Recibir notificación de impresión completada"""
     try:
         data = request.json
-        agent_id = data.get('agent_id')
-        
-        agents[agent_id] = {
-            'info': data,
-            'last_seen': time.time(),
-            'status': 'online'
-        }
-        
-        print(f"✅ Agente registrado: {agent_id}")
-        
-        return jsonify({
-            'success': True,
-            'agent_id': agent_id,
-            'message': 'Agente registrado exitosamente'
-        })
+        core.handle_print_completed(data.get('agent_id'), data.get('result'))
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/scale-reading', methods=['POST'])
+def agent_scale_reading():
+    """Recibir lectura de báscula de agente"""
+    try:
+        core.handle_agent_event(request.json)
+        return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/agents', methods=['GET'])
 def get_agents():
-    """Obtener lista de agentes conectados"""
+    """
+    Obtener lista de agentes conectados; filtros ?status=&platform=&has_printer=
+    y paginación ?limit=&cursor= (cursor = next_cursor de la página anterior)
+    """
     try:
-        agents_list = []
-        current_time = time.time()
-        
-        for agent_id, agent_data in agents.items():
-            is_online = (current_time - agent_data['last_seen']) < 60
-            
-            agents_list.append({
-                'agent_id': agent_id,
-                'platform': agent_data['info'].get('platform', 'Unknown'),
-                'status': 'online' if is_online else 'offline',
-                'last_seen': agent_data['last_seen'],
-                'printers_count': len(agent_data['info'].get('printers', [])),
-                'scales_count': len(agent_data['info'].get('scales', []))
-            })
-        
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, MAX_AGENTS_PAGE))
+
+        agents_list, next_cursor = agents.page(
+            status=request.args.get('status'),
+            platform=request.args.get('platform'),
+            printer=request.args.get('has_printer'),
+            limit=limit,
+            cursor=request.args.get('cursor')
+        )
+
         return jsonify({
             'success': True,
             'agents': agents_list,
-            'total': len(agents_list)
+            'total': len(agents_list),
+            'next_cursor': next_cursor
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    """Historial de trabajos, filtrable por agente y estado"""
+    try:
+        jobs = store.job_history(
+            agent_id=request.args.get('agent_id'),
+            status=request.args.get('status'),
+            before=request.args.get('before', type=float),
+            limit=min(request.args.get('limit', 50, type=int), 500)
+        )
+        return jsonify({
+            'success': True,
+            'jobs': jobs,
+            'total': len(jobs)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/jobs', methods=['GET'])
+def agent_fetch_jobs(agent_id):
+    """Long-poll del agente para recoger trabajos pendientes"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        wait = min(float(request.args.get('wait', 25)), MAX_POLL_WAIT)
+        max_jobs = request.args.get('max', type=int)
+
+        core.touch_agent(agent_id)
+        jobs = job_queue.fetch(agent_id, wait=wait, max_jobs=max_jobs)
+        core.touch_agent(agent_id)
+
+        return jsonify({
+            'success': True,
+            'jobs': jobs
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/agent/<agent_id>/jobs/results', methods=['POST'])
+def agent_job_results(agent_id):
+    """Recibir en lote los resultados de los trabajos ejecutados por el agente"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        accepted = core.accept_results(agent_id, request.json.get('results', []))
+
+        return jsonify({
+            'success': True,
+            'accepted': accepted
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+if SOCK_AVAILABLE:
+    @sock.route('/agent/<agent_id>/ws')
+    def agent_channel(ws, agent_id):
+        """Canal persistente iniciado por el agente: latidos, comandos y resultados"""
+        send_lock = threading.Lock()
+        closed = threading.Event()
+
+        def send(message):
+            with send_lock:
+                ws.send(json.dumps(message))
+
+        def pump_jobs():
+            # Reenviar al agente los trabajos de su cola en cuanto llegan
+            while not closed.is_set():
+                if agent_id not in agents:
+                    closed.wait(1)
+                    continue
+                jobs = job_queue.fetch(agent_id, wait=MAX_POLL_WAIT)
+                if not jobs:
+                    continue
+                if closed.is_set():
+                    job_queue.requeue(agent_id, jobs)
+                    return
+                try:
+                    for index, job in enumerate(jobs):
+                        send({'type': 'job', 'id': job['job_id'], 'job': job})
+                except Exception:
+                    job_queue.requeue(agent_id, jobs[index:])
+                    return
+
+        print(f"🔌 Canal WebSocket abierto: {agent_id}")
+        threading.Thread(target=pump_jobs, daemon=True).start()
+
+        try:
+            while True:
+                raw = ws.receive()
+                if raw is None:
+                    break
+                reply = core.handle_channel_message(agent_id, json.loads(raw))
+                if reply is not None:
+                    send(reply)
+        finally:
+            closed.set()
+            print(f"🔌 Canal WebSocket cerrado: {agent_id}")
+
+def dispatch_to_agent(agent_id, job_type, payload, timeout):
+    """Encolar un trabajo y esperar la respuesta del agente; devuelve (cuerpo, status)"""
+    unavailable = core.unavailable_response(agent_id)
+    if unavailable:
+        count_print_outcomes(job_type, *unavailable)
+        return unavailable
+
+    printers = job_printers(job_type, payload)
+    waiting_since = time.perf_counter()
+    admitted, retry_after = admission.acquire(agent_id, printers, timeout)
+    if not admitted:
+        return throttled_response(job_type, retry_after)
+
+    started = time.perf_counter()
+    try:
+        # La prueba half-open se toma justo antes de enviar: cualquier salida
+        # que no llegue a finish_forward la devuelve
+        unavailable, probe = core.breaker_response(agent_id)
+        if unavailable:
+            count_print_outcomes(job_type, *unavailable)
+            return unavailable
+        try:
+            return forward_job(agent_id, job_type, payload, timeout - (started - waiting_since))
+        finally:
+            if probe:
+                breaker.release_probe(agent_id)
+    finally:
+        admission.release(agent_id, printers, time.perf_counter() - started)
+
+def forward_job(agent_id, job_type, payload, timeout):
+    """Enviar un trabajo ya admitido al agente y esperar su resultado"""
+    started = time.perf_counter()
+    job = job_queue.submit(agent_id, job_type, payload)
+    result = job_queue.wait_result(agent_id, job['job_id'], timeout)
+    response, g.server_timing = core.finish_forward(
+        agent_id, job_type, job['job_id'], result, (time.perf_counter() - started) * 1000
+    )
+    return response
+
+def dispatch_print(agent_id, job_type, payload):
+    """Despachar una impresión respetando la cabecera Idempotency-Key"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        body, status = dispatch_to_agent(agent_id, job_type, payload, PRINT_TIMEOUT)
+        return jsonify(body), status, retry_headers(body)
+
+    # El agente también deduplica con la misma clave (reintentos en otro worker)
+    payload = dict(payload, idempotency_key=key)
+    response, replayed = idempotency_cache.run(
+        f"{agent_id}:{key}",
+        lambda: dispatch_to_agent(agent_id, job_type, payload, PRINT_TIMEOUT),
+        wait_timeout=PRINT_TIMEOUT,
+        cache_if=is_final_print_response
+    )
+    body, status, headers = idempotent_response(response, replayed)
+    return jsonify(body), status, headers
+
 @app.route('/agent/<agent_id>/print', methods=['POST'])
 def print_via_agent(agent_id):
     """Imprimir via agente específico"""
     try:
         if agent_id not in agents:
             return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
-        
-        # Simular impresión por ahora
+
         data = request.json
-        print(f"🖨️ Simulación impresión para {agent_id}:")
-        print(f"   Impresora: {data.get('printer_name')}")
-        print(f"   Contenido: {data.get('content')}")
-        
-        return jsonify({
-            'success': True,
-            'result': {
-                'printer': data.get('printer_name'),
-                'status': 'simulated',
-                'timestamp': time.time()
-            }
-        })
-        
+        print(f"🖨️ Encolando impresión para {agent_id}: {data.get('printer_name')}")
+
+        return dispatch_print(agent_id, 'print', data)
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/agent/<agent_id>/print/batch', methods=['POST'])
+def print_batch_via_agent(agent_id):
+    """Imprimir una ráfaga de tickets en un solo viaje al agente"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        jobs = request.json.get('jobs') or []
+        error = batch_error(jobs)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+
+        print(f"🖨️ Encolando lote de {len(jobs)} impresiones para {agent_id}")
+
+        return dispatch_print(agent_id, 'print_batch', {'jobs': jobs})
+
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -111,26 +431,71 @@ def read_scale_via_agent(agent_id):
     try:
         if agent_id not in agents:
             return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
-        
-        # Simular lectura de báscula
+
         data = request.json
-        print(f"⚖️ Simulación lectura báscula para {agent_id}:")
-        print(f"   Puerto: {data.get('scale_port')}")
-        
-        return jsonify({
-            'success': True,
-            'weight': {
-                'port': data.get('scale_port'),
-                'weight': 1.23,
-                'unit': 'kg',
-                'timestamp': time.time(),
-                'note': 'simulated'
-            }
+
+        # Lectura reciente ya conocida: se responde sin ir al agente
+        max_age_ms = request.args.get('max_age_ms', type=float)
+        if max_age_ms is not None:
+            reading = core.cached_scale_reading(agent_id, data.get('scale_port'), max_age_ms / 1000)
+            if reading is not None:
+                return jsonify(cached_reading_response(reading))
+
+        print(f"⚖️ Encolando lectura de báscula para {agent_id}: {data.get('scale_port')}")
+
+        body, status = dispatch_to_agent(agent_id, 'scale_read', data, SCALE_TIMEOUT)
+        return jsonify(body), status, retry_headers(body)
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def renew_scale_watch(agent_id, port):
+    """Pedir al agente que siga leyendo la báscula otros SCALE_WATCH_LEASE segundos"""
+    job = job_queue.submit(agent_id, 'scale_watch', core.scale_watch_payload(port))
+    result = job_queue.wait_result(agent_id, job['job_id'], SCALE_TIMEOUT)
+    core.finish_scale_watch(agent_id, port, job['job_id'], result)
+
+@app.route('/agent/<agent_id>/scale/<path:port>/stream', methods=['GET'])
+def stream_scale(agent_id, port):
+    """Lecturas continuas de una báscula como Server-Sent Events"""
+    try:
+        if agent_id not in agents:
+            return jsonify({'success': False, 'error': 'Agente no encontrado'}), 404
+
+        # Sin breaker: el stream no envía trabajos cuyo resultado lo cierre
+        unavailable = core.offline_response(agent_id)
+        if unavailable:
+            body, status = unavailable
+            return jsonify(body), status, retry_headers(body)
+
+        subscription = scale_streams.subscribe(agent_id, port)
+        print(f"📡 Stream de báscula abierto: {agent_id} {port}")
+
+        def events():
+            try:
+                latest = scale_streams.latest(agent_id, port)
+                if latest:
+                    yield sse_event(latest)
+                while True:
+                    # Un solo cliente por (agente, puerto) renueva el lease
+                    if scale_streams.claim_renewal(agent_id, port, SCALE_WATCH_LEASE / 3):
+                        threading.Thread(target=renew_scale_watch, args=(agent_id, port), daemon=True).start()
+                    reading = scale_streams.next_reading(
+                        subscription, min(SSE_KEEPALIVE_INTERVAL, SCALE_WATCH_LEASE / 3)
+                    )
+                    yield SSE_KEEPALIVE if reading is None else sse_event(reading)
+            finally:
+                scale_streams.unsubscribe(agent_id, port, subscription)
+                print(f"📡 Stream de báscula cerrado: {agent_id} {port}")
+
+        return Response(events(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
         })
-        
+
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
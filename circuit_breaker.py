@@ -0,0 +1,83 @@
+"""
+Circuit breaker por agente para no retener workers esperando a tiendas caídas
+"""
+import threading
+import time
+
+
+class CircuitBreaker:
+    """
+    Tras `failure_threshold` timeouts seguidos el circuito de un agente se abre
+    y las peticiones fallan al instante durante `reset_timeout` segundos.
+    Después se deja pasar una única petición de prueba (half-open): si el
+    agente responde se cierra, si no vuelve a abrirse. Quien toma la prueba y
+    no llega a enviar el trabajo la devuelve con `release_probe`; si aun así
+    se pierde, caduca a los `probe_timeout` segundos.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30, probe_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # Una prueba sin resultado tras este tiempo se da por perdida
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._circuits = {}   # agent_id -> {'failures', 'opened_at', 'probing' (inicio de la prueba o None)}
+
+    def allow(self, agent_id, take_probe=True):
+        """
+        (permitido, segundos hasta reintentar, prueba). Con `take_probe` falso
+        solo se consulta: no se reserva la prueba half-open
+        """
+        now = time.time()
+        with self._lock:
+            circuit = self._circuits.get(agent_id)
+            if circuit is None or circuit['opened_at'] is None:
+                return True, 0, False
+
+            remaining = circuit['opened_at'] + self.reset_timeout - now
+            if remaining > 0:
+                return False, remaining, False
+            if circuit['probing'] and now - circuit['probing'] < self.probe_timeout:
+                return False, self.reset_timeout, False
+            if not take_probe:
+                return True, 0, False
+
+            # Half-open: una sola petición de prueba
+            circuit['probing'] = now
+            return True, 0, True
+
+    def release_probe(self, agent_id):
+        """Devolver la prueba half-open de una petición que no llegó a enviarse"""
+        with self._lock:
+            circuit = self._circuits.get(agent_id)
+            if circuit is not None:
+                circuit['probing'] = None
+
+    def record_success(self, agent_id):
+        with self._lock:
+            self._circuits.pop(agent_id, None)
+
+    def record_failure(self, agent_id):
+        with self._lock:
+            circuit = self._circuits.setdefault(
+                agent_id, {'failures': 0, 'opened_at': None, 'probing': None}
+            )
+            circuit['failures'] += 1
+            if circuit['probing'] or circuit['failures'] >= self.failure_threshold:
+                circuit['opened_at'] = time.time()
+                circuit['probing'] = None
+
+    def state(self, agent_id):
+        with self._lock:
+            circuit = self._circuits.get(agent_id)
+        if circuit is None or circuit['opened_at'] is None:
+            return 'closed'
+        return 'half_open' if circuit['probing'] else 'open'
+
+    def open_count(self):
+        with self._lock:
+            return sum(1 for circuit in self._circuits.values() if circuit['opened_at'] is not None)
+
+    def forget(self, agent_id):
+        with self._lock:
+            self._circuits.pop(agent_id, None)
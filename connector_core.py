@@ -0,0 +1,610 @@
+"""
+Lógica común de app_ultralight.py (Flask, hilos) y app_async.py (Quart, asyncio)
+
+Configuración, métricas, registro de agentes, mensajes del canal, respuestas
+de despacho y reenvío entre nodos viven aquí una sola vez. Cada app aporta su
+cola de trabajos, su control de admisión y su hub de streams (bloqueantes o
+asyncio) y conserva solo las rutas y las esperas.
+"""
+import os
+import time
+import requests
+from circuit_breaker import CircuitBreaker
+from resource_sampler import ResourceSampler
+from metrics import MetricsRegistry
+from sharding import ShardRouter, FORWARDED_HEADER, parse_server_timing
+from webhooks import WebhookDispatcher
+
+MAX_POLL_WAIT = 30
+PRINT_TIMEOUT = 30
+SCALE_TIMEOUT = 10
+MAX_PRINT_BATCH = int(os.getenv('MAX_PRINT_BATCH', 100))
+MAX_AGENTS_PAGE = int(os.getenv('MAX_AGENTS_PAGE', 1000))
+
+# Lecturas continuas de báscula para los clientes SSE; el agente lee mientras
+# el VPS le renueve el lease (cada tercio de SCALE_WATCH_LEASE)
+SCALE_WATCH_LEASE = int(os.getenv('SCALE_WATCH_LEASE', 30))
+SCALE_STREAM_QUEUE = int(os.getenv('SCALE_STREAM_QUEUE', 16))
+SSE_KEEPALIVE_INTERVAL = 15
+
+# /health y /metrics sirven la última muestra sin hacer trabajo por petición
+HEALTH_SAMPLE_INTERVAL = float(os.getenv('HEALTH_SAMPLE_INTERVAL', 5))
+
+# Listados grandes (/agents, /jobs) comprimidos si el cliente lo acepta
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 1))
+
+# Retención del historial en SQLite (segundos; 0 = conservar siempre)
+STORE_SETTINGS = {
+    'job_ttl': float(os.getenv('JOB_RETENTION_TTL', 30 * 24 * 3600)),
+    'reading_ttl': float(os.getenv('SCALE_READING_RETENTION_TTL', 24 * 3600)),
+    'sweep_interval': float(os.getenv('RETENTION_SWEEP_INTERVAL', 600))
+}
+
+# Trabajos en curso por agente e impresora; lo que no cabe espera en una cola
+# acotada y, si está llena, recibe 429 con Retry-After
+ADMISSION_SETTINGS = {
+    'agent_limit': int(os.getenv('ADMISSION_AGENT_LIMIT', 4)),
+    'printer_limit': int(os.getenv('ADMISSION_PRINTER_LIMIT', 2)),
+    'max_queue': int(os.getenv('ADMISSION_MAX_QUEUE', 16)),
+    'queue_timeout': float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 10))
+}
+
+# Eventos de dispositivos hacia el POS en la nube
+CLOUD_URL = os.getenv('CLOUD_URL', '').rstrip('/')
+# Los lotes {'events': [...]} van a su propio endpoint; los de un solo evento
+# (/api/device/print/completed, /api/device/scale/reading) no los entienden
+CLOUD_EVENTS_PATH = '/api/device/events'
+
+# Rutas de agentes que llevan el agent_id en el cuerpo y no en la URL
+BODY_AGENT_ROUTES = {'/agent/register', '/agent/print-completed', '/agent/scale-reading'}
+
+# Métricas Prometheus de este proceso: latencias, resultados de impresión y colas
+telemetry = MetricsRegistry()
+REQUEST_LATENCY = telemetry.histogram(
+    'pos_http_request_duration_seconds',
+    'Latencia de las peticiones HTTP por ruta',
+    ('method', 'route', 'status')
+)
+FORWARD_LATENCY = telemetry.histogram(
+    'pos_agent_forward_duration_seconds',
+    'Tiempo desde que se encola un trabajo hasta la respuesta del agente',
+    ('agent_id', 'type'),
+    max_series=int(os.getenv('METRICS_MAX_AGENT_SERIES', 1000))
+)
+PRINT_OUTCOMES = telemetry.counter(
+    'pos_print_outcomes',
+    'Tickets impresos por resultado',
+    ('outcome',),
+    max_series=50
+)
+ADMISSION_REJECTED = telemetry.counter(
+    'pos_admission_rejected',
+    'Trabajos rechazados con 429 por exceder los límites del agente',
+    ('type',),
+    max_series=20
+)
+WEBHOOK_EVENTS = telemetry.counter(
+    'pos_webhook_events',
+    'Eventos enviados al POS en la nube por destino y resultado',
+    ('destination', 'outcome'),
+    max_series=50
+)
+SHARD_FORWARDS = telemetry.counter(
+    'pos_shard_forwarded',
+    'Peticiones reenviadas al nodo dueño del agente',
+    ('node', 'status'),
+    max_series=200
+)
+
+
+def hop_timings(result, dispatch_ms):
+    """
+    Etapas en ms: `dispatch` es la ida y vuelta al agente, `transit` lo que no
+    pasó dentro del agente (cola + red) y `agent_*` las etapas que él midió
+    """
+    agent = (result or {}).get('timings') or {}
+    timings = {'dispatch': round(dispatch_ms, 2)}
+    if 'total' in agent:
+        timings['transit'] = round(max(dispatch_ms - agent['total'], 0), 2)
+    for name, ms in agent.items():
+        timings[f'agent_{name}'] = ms
+    return timings
+
+
+def server_timing_header(timings, elapsed):
+    """Cabecera Server-Timing con el desglose por salto y el total de la petición"""
+    timings = dict(timings or {}, total=round(elapsed * 1000, 2))
+    return ', '.join(f'{name};dur={ms}' for name, ms in timings.items())
+
+
+def count_print_outcomes(job_type, body, status):
+    """Contar el resultado de cada ticket de una impresión despachada"""
+    if job_type not in ('print', 'print_batch'):
+        return
+    if status == 503:
+        PRINT_OUTCOMES.inc('unavailable')
+    elif status == 429:
+        PRINT_OUTCOMES.inc('throttled')
+    elif status == 504:
+        PRINT_OUTCOMES.inc('timeout')
+    else:
+        for result in body.get('results') or [body.get('result') or {}]:
+            PRINT_OUTCOMES.inc(result.get('status', 'error'))
+
+
+def retry_headers(body):
+    """Cabecera Retry-After para las respuestas 503 (breaker) y 429 (admisión)"""
+    if 'retry_after' in body:
+        return {'Retry-After': str(body['retry_after'])}
+    return {}
+
+
+def job_printers(job_type, payload):
+    """Impresoras que ocupa un trabajo (para el límite por impresora)"""
+    if job_type == 'print':
+        return (payload.get('printer_name'),)
+    if job_type == 'print_batch':
+        return tuple({job.get('printer_name') for job in payload.get('jobs') or []})
+    return ()
+
+
+def throttled_response(job_type, retry_after):
+    """429 para un trabajo que no cupo en los límites de admisión del agente"""
+    ADMISSION_REJECTED.inc(job_type)
+    response = {
+        'success': False,
+        'error': 'Agente saturado: demasiados trabajos en curso; reintentar más tarde',
+        'retry_after': retry_after
+    }, 429
+    count_print_outcomes(job_type, *response)
+    return response
+
+
+def batch_error(jobs):
+    """Mensaje de error si el lote de impresión no es válido (o None)"""
+    if not jobs or not isinstance(jobs, list):
+        return 'Se requiere una lista jobs'
+    if len(jobs) > MAX_PRINT_BATCH:
+        return f'Máximo {MAX_PRINT_BATCH} trabajos por lote'
+    for index, job in enumerate(jobs):
+        if not isinstance(job, dict) or not job.get('printer_name'):
+            return f'jobs[{index}] debe ser un objeto con printer_name'
+    return None
+
+
+def is_final_print_response(response):
+    """Solo se memorizan impresiones que no conviene repetir (sin errores ni timeouts)"""
+    body, status = response
+    if status >= 500 or not body.get('success'):
+        return False
+    results = body.get('results') or [body.get('result') or {}]
+    return all(result.get('status') != 'error' for result in results)
+
+
+def idempotent_response(response, replayed):
+    """(cuerpo, status, cabeceras) de una impresión despachada con Idempotency-Key"""
+    if response is None:
+        return {
+            'success': False,
+            'error': 'Ya hay una petición en curso con esta Idempotency-Key'
+        }, 409, {}
+
+    body, status = response
+    if replayed:
+        PRINT_OUTCOMES.inc('replayed')
+    headers = dict(retry_headers(body), **{'Idempotent-Replayed': 'true' if replayed else 'false'})
+    return body, status, headers
+
+
+def is_event_stream(forwarded):
+    """Respuesta SSE del nodo dueño: se pasa trama a trama en lugar de entera"""
+    return forwarded.headers.get('Content-Type', '').startswith('text/event-stream')
+
+
+def cached_reading_response(reading):
+    """Respuesta de /scale/read servida con la última lectura conocida"""
+    return {
+        'success': True,
+        'weight': reading,
+        'cached': True,
+        'age_ms': round((time.time() - reading['received_at']) * 1000, 2)
+    }
+
+
+class ConnectorCore:
+    """
+    Estado y lógica del VPS que no dependen del modelo de concurrencia:
+    registro de agentes, circuit breaker, webhooks, muestreador y sharding.
+    `shared` indica que otros workers comparten el store (REGISTRY_BACKEND=sqlite).
+    Con `loop` (app_async.py) lo que toca las colas se programa en ese bucle.
+    """
+
+    def __init__(self, store, job_queue, registry_class, admission, scale_streams, db_path, shared=False):
+        self.store = store
+        self.job_queue = job_queue
+        self.admission = admission
+        self.scale_streams = scale_streams
+        self.shared = shared
+        self.loop = None
+
+        # Tras varios timeouts seguidos se deja de encolar para ese agente un rato
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('BREAKER_FAILURES', 3)),
+            reset_timeout=int(os.getenv('BREAKER_RESET', 30)),
+            probe_timeout=PRINT_TIMEOUT + 5
+        )
+
+        # En cola, por lotes y con reintentos, fuera del camino de las peticiones
+        self.webhooks = WebhookDispatcher(
+            api_key=os.getenv('CLOUD_API_KEY'),
+            max_batch=int(os.getenv('WEBHOOK_BATCH_SIZE', 100)),
+            flush_interval=float(os.getenv('WEBHOOK_FLUSH_INTERVAL', 1.0)),
+            max_queue=int(os.getenv('WEBHOOK_MAX_QUEUE', 10000)),
+            max_attempts=int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5)),
+            on_result=lambda url, outcome, count: WEBHOOK_EVENTS.inc(url, outcome, amount=count)
+        )
+
+        # Registro de agentes con vencimiento incremental y desalojo de agentes muertos
+        self.agents = registry_class(
+            online_ttl=int(os.getenv('AGENT_ONLINE_TTL', 60)),
+            evict_ttl=int(os.getenv('AGENT_EVICT_TTL', 7 * 24 * 3600)),
+            max_entries=int(os.getenv('AGENT_MAX_ENTRIES', 100000)),
+            on_evict=self.on_agent_evicted,
+            store=store
+        )
+
+        self.sampler = ResourceSampler(
+            self.collect_stats,
+            interval=HEALTH_SAMPLE_INTERVAL,
+            disk_path=os.path.dirname(os.path.abspath(db_path))
+        )
+
+        # Varios nodos: cada agente tiene un nodo dueño por hashing consistente y
+        # cualquier nodo reenvía allí las peticiones de ese agente
+        self.shard = ShardRouter(
+            self_url=os.getenv('SHARD_SELF'),
+            nodes=os.getenv('SHARD_NODES', '').split(','),
+            vnodes=int(os.getenv('SHARD_VNODES', 160)),
+            pool_size=int(os.getenv('SHARD_POOL_SIZE', 32)),
+            read_timeout=MAX_POLL_WAIT + 5
+        )
+
+        telemetry.gauge('pos_job_queue_depth', 'Trabajos en cola por agente', lambda: job_queue.depths(), ('agent_id',))
+        telemetry.gauge('pos_agents', 'Agentes por estado', lambda: self.snapshot_values(
+            online='agents_online', offline='agents_offline'
+        ), ('status',))
+        telemetry.gauge('pos_devices', 'Dispositivos de los agentes online', lambda: self.snapshot_values(
+            printers='printers_count', scales='scales_count'
+        ), ('kind',))
+        telemetry.gauge('pos_webhook_queue_depth', 'Eventos pendientes de enviar por destino', lambda: self.webhooks.depths(), ('destination',))
+        telemetry.gauge('pos_agent_in_flight', 'Trabajos en curso por agente', lambda: admission.in_flight(), ('agent_id',))
+        telemetry.gauge('pos_admission_waiting', 'Peticiones esperando hueco en algún agente', lambda: admission.waiting())
+        telemetry.gauge('pos_circuits_open', 'Agentes con el circuit breaker abierto', lambda: self.breaker.open_count())
+        telemetry.gauge('pos_host_usage_percent', 'Uso de recursos del host', lambda: self.snapshot_values(
+            cpu='cpu_percent', memory='memory_percent', disk='disk_percent'
+        ), ('resource',))
+
+    def start(self):
+        """Reconstruir el registro tras un reinicio y arrancar el muestreador"""
+        # El vencimiento decide quién sigue online
+        self.agents.restore()
+        self.sampler.start()
+        return self
+
+    def on_agent_evicted(self, agent_id):
+        """Liberar recursos de un agente desalojado del registro"""
+        # Los desalojos llegan también desde el hilo del muestreador; las colas
+        # de app_async.py solo se pueden tocar desde su bucle de eventos
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._forget_agent, agent_id)
+        else:
+            self._forget_agent(agent_id)
+
+    def _forget_agent(self, agent_id):
+        self.job_queue.forget(agent_id)
+        self.breaker.forget(agent_id)
+        self.admission.forget(agent_id)
+        self.scale_streams.forget(agent_id)
+        print(f"🗑️ Agente desalojado por inactividad: {agent_id}")
+
+    # Estado del servicio
+
+    def collect_stats(self):
+        """Contadores del servicio para el muestreador (fuera del camino de las peticiones)"""
+        counts = self.agents.counts()
+        printers, scales = self.agents.device_counts()
+        return {
+            'agents_count': counts['online'] + counts['offline'],
+            'agents_online': counts['online'],
+            'agents_offline': counts['offline'],
+            'agents_evicted': self.agents.evicted,
+            'printers_count': printers,
+            'scales_count': scales,
+            'circuits_open': self.breaker.open_count(),
+            'scale_streams': self.scale_streams.stream_count(),
+            'jobs_pending': self.job_queue.depth(),
+            'webhook_events_pending': sum(self.webhooks.depths().values())
+        }
+
+    def health(self):
+        age = self.sampler.age()
+        stale = age is None or age > 3 * HEALTH_SAMPLE_INTERVAL
+        return dict(
+            self.sampler.snapshot(),
+            status='degraded' if stale else 'healthy',
+            timestamp=time.time()
+        )
+
+    def snapshot_values(self, **keys):
+        """Valores de la última muestra para un gauge: {etiqueta: clave de la muestra}"""
+        snapshot = self.sampler.snapshot()
+        return {label: snapshot[key] for label, key in keys.items() if key in snapshot} or None
+
+    # Agentes
+
+    def register_agent(self, data):
+        """Guardar/actualizar la información de un agente"""
+        agent_id = data.get('agent_id')
+
+        self.agents.register(agent_id, data)
+        self.agents.pop_refresh(agent_id)
+
+        print(f"✅ Agente registrado: {agent_id}")
+        return agent_id
+
+    def agent_heartbeat(self, agent_id, inventory_hash):
+        """Latido ligero con hash del inventario; devuelve (inventory_required, rescan)"""
+        record = self.agents.get(agent_id)
+        if record is None or not self.touch_agent(agent_id):
+            return True, False
+
+        rescan = self.agents.pop_refresh(agent_id)
+        changed = record['info'].get('inventory_hash') != inventory_hash
+        return rescan or changed, rescan
+
+    def register_response(self, data):
+        """Cuerpo de /agent/register: latido con hash o alta con inventario completo"""
+        agent_id = data.get('agent_id')
+
+        # Latido: solo hash del inventario, sin lista de dispositivos
+        if 'printers' not in data and 'scales' not in data:
+            inventory_required, rescan = self.agent_heartbeat(agent_id, data.get('inventory_hash'))
+            return {
+                'success': True,
+                'agent_id': agent_id,
+                'inventory_required': inventory_required,
+                'rescan': rescan
+            }
+
+        return {
+            'success': True,
+            'agent_id': self.register_agent(data),
+            'inventory_required': False,
+            'message': 'Agente registrado exitosamente'
+        }
+
+    def touch_agent(self, agent_id):
+        """Marcar actividad de un agente; False si no está registrado"""
+        return self.agents.touch(agent_id)
+
+    def notify_cloud(self, event_type, event):
+        """Encolar un evento para el POS en la nube (no espera a la entrega)"""
+        if CLOUD_URL:
+            self.webhooks.enqueue(
+                f"{CLOUD_URL}{CLOUD_EVENTS_PATH}", dict(event, event=event_type, timestamp=time.time())
+            )
+
+    def handle_print_completed(self, agent_id, result):
+        """Procesar la notificación de impresión completada de un agente"""
+        if self.touch_agent(agent_id):
+            self.notify_cloud('print_completed', {
+                'device_type': 'printer',
+                'agent_id': agent_id,
+                'result': result
+            })
+            print(f"🖨️ Impresión completada en {agent_id}: {(result or {}).get('status')}")
+
+    def handle_scale_reading(self, agent_id, reading):
+        """Procesar una lectura de báscula enviada por un agente"""
+        if self.touch_agent(agent_id):
+            self.record_scale_reading(agent_id, reading)
+            self.notify_cloud('scale_reading', {
+                'device_type': 'scale',
+                'agent_id': agent_id,
+                'data': reading
+            })
+            print(f"⚖️ Lectura de báscula de {agent_id}: {(reading or {}).get('weight')}")
+
+    def record_scale_reading(self, agent_id, reading):
+        """Guardar una lectura puntual y dejarla como última de su báscula"""
+        self.store.record_scale_reading(agent_id, reading)
+        # Con varios workers la difunde el sondeo de la tabla (SharedScaleStreamHub)
+        if reading and reading.get('port') and 'error' not in reading and not self.shared:
+            self.scale_streams.publish(agent_id, reading['port'], reading)
+
+    def cached_scale_reading(self, agent_id, port, max_age):
+        """Última lectura de la báscula si tiene menos de `max_age` segundos (o None)"""
+        reading = self.scale_streams.fresh(agent_id, port, max_age)
+        if reading is None and self.shared:
+            # Con varios workers la lectura pudo llegar a otro proceso
+            reading = self.store.latest_scale_reading(agent_id, port, time.time() - max_age)
+        return reading
+
+    def handle_scale_stream(self, agent_id, reading):
+        """Lectura continua de una báscula: se difunde a los clientes SSE"""
+        if not reading or not reading.get('port'):
+            return
+        if self.shared:
+            # Los clientes pueden estar en otro worker: pasa por la tabla compartida
+            self.store.record_scale_reading(agent_id, reading)
+        else:
+            self.scale_streams.publish(agent_id, reading['port'], reading)
+
+    def handle_agent_event(self, data):
+        """/agent/scale-reading: lectura puntual o trama de un stream continuo"""
+        if data.get('stream'):
+            self.handle_scale_stream(data.get('agent_id'), data.get('reading'))
+        else:
+            self.handle_scale_reading(data.get('agent_id'), data.get('reading'))
+
+    def accept_results(self, agent_id, results):
+        """Entregar en lote los resultados de un agente; devuelve cuántos esperaba alguien"""
+        self.touch_agent(agent_id)
+        accepted = 0
+        for item in results:
+            if self.job_queue.complete(item.get('job_id'), item.get('result')):
+                accepted += 1
+        return accepted
+
+    def handle_channel_message(self, agent_id, message):
+        """Procesar una trama recibida por el canal WebSocket; devuelve la respuesta"""
+        msg_type = message.get('type')
+        msg_id = message.get('id')
+
+        if msg_type == 'register':
+            self.register_agent(dict(message.get('data') or {}, agent_id=agent_id))
+        elif msg_type == 'heartbeat':
+            if agent_id not in self.agents:
+                return {'type': 'error', 'id': msg_id, 'code': 'unknown_agent', 'error': 'Agente no encontrado'}
+            inventory_required, rescan = self.agent_heartbeat(agent_id, message.get('inventory_hash'))
+            if inventory_required:
+                return {'type': 'ack', 'id': msg_id, 'inventory_required': True, 'rescan': rescan}
+        elif msg_type == 'result':
+            self.touch_agent(agent_id)
+            self.job_queue.complete(msg_id, message.get('result'))
+            return None
+        elif msg_type == 'print_completed':
+            self.handle_print_completed(agent_id, message.get('result'))
+        elif msg_type == 'scale_reading':
+            self.handle_scale_reading(agent_id, message.get('reading'))
+        elif msg_type == 'scale_stream':
+            # Varias por segundo: sin ack
+            self.handle_scale_stream(agent_id, message.get('reading'))
+            return None
+        else:
+            return {'type': 'error', 'id': msg_id, 'error': f'Tipo de mensaje desconocido: {msg_type}'}
+
+        return {'type': 'ack', 'id': msg_id}
+
+    # Despacho de trabajos
+
+    def offline_response(self, agent_id):
+        """Respuesta 503 inmediata si el agente no da señales de vida (o None)"""
+        record = self.agents.get(agent_id)
+        if record and time.time() - record['last_seen'] > self.agents.online_ttl:
+            return {
+                'success': False,
+                'error': 'Agente offline: sin latidos recientes',
+                'retry_after': self.agents.online_ttl
+            }, 503
+        return None
+
+    def breaker_response(self, agent_id, take_probe=True):
+        """
+        (503 si el breaker no deja pasar el trabajo o None, prueba half-open
+        tomada). Quien toma la prueba la cierra con finish_forward o la
+        devuelve con breaker.release_probe
+        """
+        allowed, retry_after, probe = self.breaker.allow(agent_id, take_probe)
+        if allowed:
+            return None, probe
+        return ({
+            'success': False,
+            'error': 'Agente sin respuesta en los últimos intentos; reintentar más tarde',
+            'retry_after': int(retry_after) + 1
+        }, 503), False
+
+    def unavailable_response(self, agent_id):
+        """503 antes de esperar turno: agente offline o breaker abierto (sin tomar la prueba)"""
+        return self.offline_response(agent_id) or self.breaker_response(agent_id, take_probe=False)[0]
+
+    def finish_forward(self, agent_id, job_type, job_id, result, dispatch_ms):
+        """
+        Cerrar un trabajo reenviado al agente: breaker, historial y métricas.
+        Devuelve ((cuerpo, status), desglose para Server-Timing)
+        """
+        FORWARD_LATENCY.observe(dispatch_ms / 1000, agent_id, job_type)
+        timings = hop_timings(result, dispatch_ms)
+
+        if result is None:
+            self.breaker.record_failure(agent_id)
+            self.store.finish_job(job_id, 'timeout')
+            response = {
+                'success': False,
+                'error': 'Tiempo de espera agotado esperando al agente',
+                'job_id': job_id
+            }, 504
+            count_print_outcomes(job_type, *response)
+            return response, timings
+
+        self.breaker.record_success(agent_id)
+        result = dict(result, timings=timings)
+        self.store.finish_job(job_id, 'completed' if result.get('success') else 'failed', result)
+        if job_type == 'scale_read' and result.get('weight'):
+            self.record_scale_reading(agent_id, result['weight'])
+        if job_type in ('print', 'print_batch'):
+            # Un evento por ticket, como los que avisa el /print local del agente
+            for ticket in result.get('results') or [result.get('result') or {}]:
+                self.notify_cloud('print_completed', {
+                    'device_type': 'printer',
+                    'agent_id': agent_id,
+                    'job_id': job_id,
+                    'result': ticket
+                })
+
+        count_print_outcomes(job_type, result, 200)
+        return (result, 200), timings
+
+    def scale_watch_payload(self, port):
+        return {'scale_port': port, 'duration': SCALE_WATCH_LEASE}
+
+    def finish_scale_watch(self, agent_id, port, job_id, result):
+        """Cerrar la renovación del lease de una báscula"""
+        if result is None:
+            self.store.finish_job(job_id, 'timeout')
+            return
+        self.store.finish_job(job_id, 'completed' if result.get('success') else 'failed', result)
+        # Al abrir el stream el agente puede tener ya una lectura reciente
+        if result.get('reading') and self.scale_streams.latest(agent_id, port) is None:
+            self.scale_streams.publish(agent_id, port, result['reading'])
+
+    # Sharding
+
+    def remote_owner(self, agent_id, headers):
+        """Nodo dueño del agente si no es este (o None para atenderlo aquí)"""
+        if not self.shard.enabled or headers.get(FORWARDED_HEADER):
+            return None
+        if agent_id is None or self.shard.is_local(agent_id):
+            return None
+        return self.shard.owner(agent_id)
+
+    def forward_to_owner(self, owner, method, path, query_string, headers, body):
+        """
+        Reenviar una petición al nodo dueño (respuesta en streaming). Devuelve
+        (respuesta, desglose para Server-Timing) o (cuerpo 502, None)
+        """
+        started = time.perf_counter()
+        try:
+            forwarded = self.shard.forward(owner, method, path, query_string, headers, body, stream=True)
+        except requests.RequestException as e:
+            SHARD_FORWARDS.inc(owner, 'error')
+            return {'success': False, 'error': f'Nodo dueño inaccesible: {e}', 'node': owner}, None
+
+        SHARD_FORWARDS.inc(owner, str(forwarded.status_code))
+        timings = parse_server_timing(forwarded.headers.get('Server-Timing'))
+        owner_total = timings.pop('total', None)
+        timings = dict(timings, forward=round((time.perf_counter() - started) * 1000, 2))
+        if owner_total is not None:
+            timings['owner'] = owner_total
+        return forwarded, timings
+
+    def shard_info(self, agent_id):
+        """Nodos del anillo y, con ?agent_id=, el nodo dueño de ese agente"""
+        return {
+            'success': True,
+            'enabled': self.shard.enabled,
+            'self': self.shard.self_url,
+            'nodes': self.shard.ring.nodes,
+            'owner': self.shard.owner(agent_id) if agent_id else None
+        }
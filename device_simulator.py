@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Flota de dispositivos virtuales para medir el agente sin hardware (Linux/macOS)
+
+    python device_simulator.py --printers 2 --scales 1 --manifest simulated_devices.json
+    AGENT_SIMULATOR=simulated_devices.json python local_agent_definitivo.py
+
+Cada dispositivo es un pseudo-terminal: el agente escribe y lee en el lado
+esclavo (/dev/pts/N) igual que en una impresora o báscula serie/USB. Con
+`--network-printers` se añaden impresoras ESC/POS de red que escuchan en
+127.0.0.1 desde `--network-port` (9100, 9101...).
+
+- Impresora: sumidero de bytes que "imprime" a `--printer-throughput` bytes/s y
+  contesta la consulta de estado ESC/POS `GS r 1` en orden, tras imprimir lo
+  anterior. Con `--paper-out-rate` se queda sin papel durante
+  `--paper-out-duration` segundos: descarta lo que recibe y responde "sin papel".
+- Báscula: responde a `P\\r\\n` con `ST,GS,   1.234 kg\\r\\n` tras
+  `--scale-latency-ms`, con un peso que va cambiando.
+"""
+
+import argparse
+import json
+import os
+import pty
+import random
+import signal
+import socket
+import threading
+import time
+import tty
+
+# GS r 1: estado del sensor de papel (se procesa en orden con los datos)
+PAPER_STATUS_QUERY = b'\x1dr\x01'
+PAPER_OK = b'\x00'
+PAPER_END = b'\x0c'
+
+
+def open_pty():
+    """(fd maestro, fd esclavo, ruta del esclavo) en modo raw"""
+    master, slave = pty.openpty()
+    # Raw: sin eco ni traducción de \r\n; el simulador mantiene abierto el
+    # esclavo para que la configuración persista entre aperturas del agente
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+class VirtualPrinter:
+    def __init__(self, name, throughput=20000, paper_out_rate=0.0, paper_out_duration=5.0):
+        self.name = name
+        self.throughput = throughput
+        self.paper_out_rate = paper_out_rate
+        self.paper_out_duration = paper_out_duration
+        self.paper_out_until = 0
+        self.stats = {'bytes': 0, 'tickets': 0, 'discarded': 0, 'paper_out': 0}
+        self._open()
+
+    def _open(self):
+        self.master, self.slave, self.device = open_pty()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _print(self, data):
+        if not data:
+            return
+        if time.time() < self.paper_out_until:
+            self.stats['discarded'] += len(data)
+            return
+        time.sleep(len(data) / self.throughput)
+        self.stats['bytes'] += len(data)
+
+    def _status(self):
+        now = time.time()
+        if now >= self.paper_out_until and random.random() < self.paper_out_rate:
+            self.paper_out_until = now + self.paper_out_duration
+            self.stats['paper_out'] += 1
+        if now < self.paper_out_until:
+            return PAPER_END
+        self.stats['tickets'] += 1
+        return PAPER_OK
+
+    def _run(self):
+        self._consume(lambda: os.read(self.master, 65536), lambda data: os.write(self.master, data))
+
+    def _consume(self, read, write):
+        """Imprimir lo recibido y contestar cada GS r 1 en orden hasta que se cierre"""
+        pending = b''
+        while True:
+            data = read()
+            if not data:
+                return
+            pending += data
+            while True:
+                index = pending.find(PAPER_STATUS_QUERY)
+                if index < 0:
+                    break
+                self._print(pending[:index])
+                write(self._status())
+                pending = pending[index + len(PAPER_STATUS_QUERY):]
+            # Guardar un posible comienzo de consulta partido entre lecturas
+            keep = next((n for n in (2, 1) if pending.endswith(PAPER_STATUS_QUERY[:n])), 0)
+            self._print(pending[:len(pending) - keep])
+            pending = pending[len(pending) - keep:]
+
+    def manifest(self):
+        return {'name': self.name, 'device': self.device, 'status': 'Disponible', 'type': 'Simulación'}
+
+
+class VirtualNetworkPrinter(VirtualPrinter):
+    """Misma impresora detrás de un socket TCP (raw/JetDirect), una conexión por hilo"""
+
+    def __init__(self, port, throughput=20000, paper_out_rate=0.0, paper_out_duration=5.0):
+        self.port = port
+        super().__init__(f'127.0.0.1:{port}', throughput, paper_out_rate, paper_out_duration)
+        self.stats['connections'] = 0
+
+    def _open(self):
+        self.device = self.name
+        self.server = socket.create_server(('127.0.0.1', self.port), backlog=16)
+
+    def _run(self):
+        while True:
+            conn, _ = self.server.accept()
+            self.stats['connections'] += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                self._consume(lambda: conn.recv(65536), conn.sendall)
+            except OSError:
+                pass
+
+    def manifest(self):
+        return self.name
+
+
+class VirtualScale:
+    def __init__(self, latency_ms=50, weight=1.0):
+        self.latency = latency_ms / 1000
+        self.weight = weight
+        self.master, self.slave, self.port = open_pty()
+        self.stats = {'readings': 0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        pending = b''
+        while True:
+            pending += os.read(self.master, 1024)
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                if line.strip() != b'P':
+                    continue
+                time.sleep(self.latency)
+                # Peso que cambia de vez en cuando, como al poner y quitar producto
+                if random.random() < 0.2:
+                    self.weight = round(max(0.0, self.weight + random.uniform(-0.5, 0.5)), 3)
+                os.write(self.master, f"ST,GS,{self.weight:8.3f} kg\r\n".encode('ascii'))
+                self.stats['readings'] += 1
+
+    def manifest(self):
+        return {'port': self.port, 'status': 'Disponible'}
+
+
+def print_stats(printers, scales):
+    for printer in printers:
+        print(f"🖨️ {printer.name} ({printer.device}): {printer.stats}")
+    for scale in scales:
+        print(f"⚖️ {scale.port}: {scale.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Impresoras y básculas virtuales para el agente")
+    parser.add_argument('--printers', type=int, default=2)
+    parser.add_argument('--scales', type=int, default=1)
+    parser.add_argument('--network-printers', type=int, default=0)
+    parser.add_argument('--network-port', type=int, default=9100)
+    parser.add_argument('--printer-throughput', type=float, default=20000, help="bytes por segundo")
+    parser.add_argument('--paper-out-rate', type=float, default=0.0, help="probabilidad de quedarse sin papel por ticket")
+    parser.add_argument('--paper-out-duration', type=float, default=5.0, help="segundos sin papel")
+    parser.add_argument('--scale-latency-ms', type=float, default=50)
+    parser.add_argument('--manifest', default='simulated_devices.json')
+    args = parser.parse_args()
+
+    printers = [
+        VirtualPrinter(f'SIM-PRINTER-{n + 1}', args.printer_throughput, args.paper_out_rate, args.paper_out_duration).start()
+        for n in range(args.printers)
+    ]
+    network_printers = [
+        VirtualNetworkPrinter(args.network_port + n, args.printer_throughput, args.paper_out_rate, args.paper_out_duration).start()
+        for n in range(args.network_printers)
+    ]
+    scales = [VirtualScale(args.scale_latency_ms).start() for _ in range(args.scales)]
+
+    with open(args.manifest, 'w') as f:
+        json.dump({
+            'printers': [printer.manifest() for printer in printers],
+            'network_printers': [printer.manifest() for printer in network_printers],
+            'scales': [scale.manifest() for scale in scales]
+        }, f, indent=2)
+
+    print("🧪 Dispositivos virtuales listos")
+    print_stats(printers + network_printers, scales)
+    print(f"📄 Manifiesto: {os.path.abspath(args.manifest)}")
+    print(f"   AGENT_SIMULATOR={os.path.abspath(args.manifest)} python local_agent_definitivo.py")
+
+    def stop(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("\n" + "=" * 60)
+        print_stats(printers + network_printers, scales)
@@ -0,0 +1,16 @@
+"""
+Configuración de gunicorn para el VPS: varios workers con registro compartido en SQLite
+"""
+import multiprocessing
+import os
+
+# Todos los workers comparten registro de agentes y cola de trabajos
+os.environ.setdefault('REGISTRY_BACKEND', 'sqlite')
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# Los long-poll y canales WebSocket retienen un hilo mientras esperan
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 100))
+timeout = 60
@@ -0,0 +1,126 @@
+"""
+Caché de respuestas por Idempotency-Key para que los reintentos no re-impriman
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyCache:
+    """
+    Caché acotada con TTL. Las entradas se guardan en orden de creación, así
+    que purgar las vencidas cuesta O(vencidas) y, al llenarse, se descarta la
+    más antigua. Si llega un reintento mientras la petición original sigue en
+    curso, espera su resultado en lugar de ejecutarla otra vez; si la original
+    falla o su respuesta no se guarda, el reintento la ejecuta él mismo.
+    """
+
+    def __init__(self, max_entries=10000, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> {'event', 'response', 'cached', 'expires_at'}
+
+    def _purge(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry['expires_at'] > now and len(self._entries) < self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def _new_event(self):
+        return threading.Event()
+
+    def _claim(self, key):
+        """(entrada, dueña): la primera petición con la clave es la que ejecuta"""
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+            entry = {'event': self._new_event(), 'response': None, 'cached': False, 'expires_at': now + self.ttl}
+            self._entries[key] = entry
+            return entry, True
+
+    def _settle(self, key, entry, response, cache_if):
+        entry['response'] = response
+        if cache_if is not None and not cache_if(response):
+            self._discard(key, entry)
+        else:
+            entry['cached'] = True
+        entry['event'].set()
+
+    def _remaining(self, deadline):
+        return None if deadline is None else max(deadline - time.time(), 0)
+
+    def run(self, key, fn, wait_timeout=None, cache_if=None):
+        """
+        Ejecutar `fn` una sola vez por clave. Devuelve (respuesta, repetida);
+        la respuesta es None si la petición original sigue en curso tras
+        `wait_timeout`. Si `cache_if(respuesta)` es falso no se guarda.
+        """
+        deadline = None if wait_timeout is None else time.time() + wait_timeout
+        while True:
+            entry, owner = self._claim(key)
+            if owner:
+                break
+            if not entry['event'].wait(self._remaining(deadline)):
+                return None, True
+            if entry['cached']:
+                return entry['response'], True
+            # La original falló o no se guardó: volver a reclamar la clave
+
+        try:
+            response = fn()
+        except Exception:
+            self._discard(key, entry)
+            raise
+
+        self._settle(key, entry, response, cache_if)
+        return response, False
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry['event'].set()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AsyncIdempotencyCache(IdempotencyCache):
+    """
+    Misma caché para la edición asyncio: `fn` es una corrutina y los
+    reintentos concurrentes esperan un asyncio.Event. Solo debe usarse desde
+    el bucle de eventos.
+    """
+
+    def _new_event(self):
+        return asyncio.Event()
+
+    async def run(self, key, fn, wait_timeout=None, cache_if=None):
+        deadline = None if wait_timeout is None else time.time() + wait_timeout
+        while True:
+            entry, owner = self._claim(key)
+            if owner:
+                break
+            if not entry['event'].is_set():
+                try:
+                    await asyncio.wait_for(entry['event'].wait(), self._remaining(deadline))
+                except asyncio.TimeoutError:
+                    return None, True
+            if entry['cached']:
+                return entry['response'], True
+
+        try:
+            response = await fn()
+        except BaseException:
+            # También si se cancela la petición: que un reintento pueda ejecutarla
+            self._discard(key, entry)
+            raise
+
+        self._settle(key, entry, response, cache_if)
+        return response, False
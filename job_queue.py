@@ -0,0 +1,349 @@
+"""
+Cola de trabajos por agente - los agentes la drenan con long-poll desde el VPS
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+
+def new_job(job_type, payload):
+    return {
+        'job_id': uuid.uuid4().hex,
+        'type': job_type,
+        'payload': payload,
+        'created_at': time.time()
+    }
+
+
+class JobQueue:
+    def __init__(self, max_batch=50, store=None):
+        self.max_batch = max_batch
+        self.store = store        # historial de trabajos en SQLite (opcional)
+        self._lock = threading.Lock()
+        self._pending = {}        # agent_id -> deque de trabajos pendientes
+        self._conditions = {}     # agent_id -> Condition para despertar el long-poll
+        self._events = {}         # job_id -> Event que se activa con el resultado
+        self._results = {}        # job_id -> resultado devuelto por el agente
+
+    def _condition(self, agent_id):
+        cond = self._conditions.get(agent_id)
+        if cond is None:
+            cond = threading.Condition(self._lock)
+            self._conditions[agent_id] = cond
+        return cond
+
+    def submit(self, agent_id, job_type, payload):
+        """Encolar un trabajo para el agente y devolverlo (con su job_id)"""
+        job = new_job(job_type, payload)
+        if self.store:
+            self.store.record_job(agent_id, job)
+        with self._lock:
+            self._pending.setdefault(agent_id, deque()).append(job)
+            self._events[job['job_id']] = threading.Event()
+            self._condition(agent_id).notify_all()
+        return job
+
+    def fetch(self, agent_id, wait=25, max_jobs=None):
+        """Long-poll: esperar hasta `wait` segundos y devolver un lote de trabajos"""
+        limit = min(max_jobs or self.max_batch, self.max_batch)
+        deadline = time.time() + wait
+        with self._lock:
+            cond = self._condition(agent_id)
+            queue = self._pending.setdefault(agent_id, deque())
+            while not queue:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                cond.wait(remaining)
+
+            batch = []
+            while queue and len(batch) < limit:
+                batch.append(queue.popleft())
+
+        if self.store:
+            self.store.mark_jobs([job['job_id'] for job in batch], 'dispatched')
+        return batch
+
+    def requeue(self, agent_id, jobs):
+        """Devolver al frente de la cola trabajos que no se pudieron entregar"""
+        with self._lock:
+            queue = self._pending.setdefault(agent_id, deque())
+            for job in reversed(jobs):
+                if job['job_id'] in self._events:
+                    queue.appendleft(job)
+            self._condition(agent_id).notify_all()
+
+    def complete(self, job_id, result):
+        """Registrar el resultado de un trabajo; False si nadie lo espera ya"""
+        with self._lock:
+            event = self._events.get(job_id)
+            if event is None:
+                return False
+            self._results[job_id] = result
+        event.set()
+        return True
+
+    def wait_result(self, agent_id, job_id, timeout):
+        """Esperar el resultado de un trabajo; None si se agota el tiempo"""
+        event = self._events.get(job_id)
+        if event is None:
+            return None
+
+        event.wait(timeout)
+
+        with self._lock:
+            self._events.pop(job_id, None)
+            result = self._results.pop(job_id, None)
+            if result is None:
+                # Si el agente aún no lo recogió, retirarlo de la cola
+                queue = self._pending.get(agent_id)
+                if queue:
+                    for job in queue:
+                        if job['job_id'] == job_id:
+                            queue.remove(job)
+                            break
+        return result
+
+    def forget(self, agent_id):
+        """Liberar las estructuras de un agente desalojado si no tiene trabajos"""
+        with self._lock:
+            if self._pending.get(agent_id):
+                return False
+            self._pending.pop(agent_id, None)
+            self._conditions.pop(agent_id, None)
+            return True
+
+    def depth(self, agent_id=None):
+        """Trabajos pendientes de un agente (o de todos)"""
+        with self._lock:
+            if agent_id is not None:
+                return len(self._pending.get(agent_id, ()))
+            return sum(len(queue) for queue in self._pending.values())
+
+    def depths(self):
+        """{agent_id: trabajos pendientes} de los agentes con cola no vacía"""
+        return {agent_id: len(queue) for agent_id, queue in list(self._pending.items()) if queue}
+
+
+class SharedJobQueue(JobQueue):
+    """
+    Cola compartida entre procesos: los trabajos viven en la tabla jobs de
+    SQLite y el long-poll los reclama con un UPDATE ... RETURNING atómico, así
+    que un trabajo encolado en un worker lo recoge el agente conectado a otro.
+    Un hilo por proceso sondea la base de datos para despertar los long-poll
+    locales y entregar los resultados que llegaron por otros workers.
+    """
+
+    def __init__(self, store, max_batch=50, poll_interval=0.05):
+        super().__init__(max_batch=max_batch)
+        self.shared_store = store
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger(__name__)
+        self._waiting = {}        # agent_id -> long-polls esperando en este proceso
+        threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def submit(self, agent_id, job_type, payload):
+        job = new_job(job_type, payload)
+        with self._lock:
+            self._events[job['job_id']] = threading.Event()
+        self.shared_store.record_job(agent_id, job, sync=True)
+        with self._lock:
+            self._condition(agent_id).notify_all()
+        return job
+
+    def fetch(self, agent_id, wait=25, max_jobs=None):
+        limit = min(max_jobs or self.max_batch, self.max_batch)
+        deadline = time.time() + wait
+        with self._lock:
+            cond = self._condition(agent_id)
+            self._waiting[agent_id] = self._waiting.get(agent_id, 0) + 1
+        try:
+            while True:
+                jobs = self.shared_store.claim_jobs(agent_id, limit)
+                if jobs:
+                    return jobs
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                with self._lock:
+                    # Lo despierta un submit local o el sondeo de la base de datos
+                    cond.wait(remaining)
+        finally:
+            with self._lock:
+                self._waiting[agent_id] -= 1
+                if not self._waiting[agent_id]:
+                    del self._waiting[agent_id]
+
+    def requeue(self, agent_id, jobs):
+        self.shared_store.requeue_jobs([job['job_id'] for job in jobs])
+        with self._lock:
+            self._condition(agent_id).notify_all()
+
+    def complete(self, job_id, result):
+        stored = self.shared_store.complete_job(job_id, result)
+        local = super().complete(job_id, result)
+        return stored or local
+
+    def wait_result(self, agent_id, job_id, timeout):
+        event = self._events.get(job_id)
+        if event is None:
+            return None
+
+        event.wait(timeout)
+
+        with self._lock:
+            self._events.pop(job_id, None)
+            result = self._results.pop(job_id, None)
+        if result is None:
+            self.shared_store.cancel_job(job_id)
+        return result
+
+    def depth(self, agent_id=None):
+        return self.shared_store.queued_count(agent_id)
+
+    def depths(self):
+        return self.shared_store.queued_counts()
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self._lock:
+                    waiting = set(self._waiting)
+                    pending = list(self._events)
+
+                if waiting:
+                    ready = [agent_id for agent_id in self.shared_store.queued_agents() if agent_id in waiting]
+                    with self._lock:
+                        for agent_id in ready:
+                            self._condition(agent_id).notify_all()
+
+                if pending:
+                    for job_id, result in self.shared_store.job_results(pending):
+                        JobQueue.complete(self, job_id, result)
+            except Exception as e:
+                self.logger.error(f"Error sondeando la cola compartida: {e}")
+
+
+class AsyncJobQueue:
+    """
+    Cola para el servidor asyncio (app_async.py): misma semántica que JobQueue,
+    pero el long-poll espera un asyncio.Event y cada petición en curso espera
+    un Future, así que miles de impresiones pendientes no ocupan hilos. Solo
+    debe usarse desde el bucle de eventos.
+    """
+
+    def __init__(self, max_batch=50, store=None):
+        self.max_batch = max_batch
+        self.store = store
+        self._pending = {}        # agent_id -> deque de trabajos pendientes
+        self._wakeups = {}        # agent_id -> Event para despertar el long-poll
+        self._futures = {}        # job_id -> Future con el resultado del agente
+
+    def _wakeup(self, agent_id):
+        event = self._wakeups.get(agent_id)
+        if event is None:
+            event = asyncio.Event()
+            self._wakeups[agent_id] = event
+        return event
+
+    def submit(self, agent_id, job_type, payload):
+        """Encolar un trabajo para el agente y devolverlo (con su job_id)"""
+        job = new_job(job_type, payload)
+        if self.store:
+            self.store.record_job(agent_id, job)
+        self._pending.setdefault(agent_id, deque()).append(job)
+        self._futures[job['job_id']] = asyncio.get_running_loop().create_future()
+        self._wakeup(agent_id).set()
+        return job
+
+    async def fetch(self, agent_id, wait=25, max_jobs=None):
+        """Long-poll: esperar hasta `wait` segundos y devolver un lote de trabajos"""
+        limit = min(max_jobs or self.max_batch, self.max_batch)
+        deadline = time.time() + wait
+        queue = self._pending.setdefault(agent_id, deque())
+        while not queue:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            event = self._wakeup(agent_id)
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return []
+            # forget() puede haber soltado la cola mientras se esperaba
+            queue = self._pending.setdefault(agent_id, deque())
+
+        batch = []
+        while queue and len(batch) < limit:
+            batch.append(queue.popleft())
+
+        if self.store:
+            self.store.mark_jobs([job['job_id'] for job in batch], 'dispatched')
+        return batch
+
+    def requeue(self, agent_id, jobs):
+        """Devolver al frente de la cola trabajos que no se pudieron entregar"""
+        queue = self._pending.setdefault(agent_id, deque())
+        for job in reversed(jobs):
+            if job['job_id'] in self._futures:
+                queue.appendleft(job)
+        self._wakeup(agent_id).set()
+
+    def complete(self, job_id, result):
+        """Registrar el resultado de un trabajo; False si nadie lo espera ya"""
+        future = self._futures.get(job_id)
+        if future is None or future.done():
+            return False
+        future.set_result(result)
+        return True
+
+    async def wait_result(self, agent_id, job_id, timeout):
+        """Esperar el resultado de un trabajo; None si se agota el tiempo"""
+        future = self._futures.get(job_id)
+        if future is None:
+            return None
+
+        try:
+            await asyncio.wait({future}, timeout=timeout)
+        finally:
+            self._futures.pop(job_id, None)
+
+        if future.done():
+            return future.result()
+
+        # Si el agente aún no lo recogió, retirarlo de la cola
+        queue = self._pending.get(agent_id)
+        if queue:
+            for job in queue:
+                if job['job_id'] == job_id:
+                    queue.remove(job)
+                    break
+        return None
+
+    def forget(self, agent_id):
+        """Liberar las estructuras de un agente desalojado si no tiene trabajos"""
+        if self._pending.get(agent_id):
+            return False
+        self._pending.pop(agent_id, None)
+        event = self._wakeups.pop(agent_id, None)
+        if event is not None:
+            # Un long-poll que esperase este Event vuelve a mirar la cola nueva
+            event.set()
+        return True
+
+    def depth(self, agent_id=None):
+        """Trabajos pendientes de un agente (o de todos)"""
+        if agent_id is not None:
+            return len(self._pending.get(agent_id, ()))
+        # Lo llama el hilo del muestreador: copia para no iterar mientras el
+        # bucle de eventos añade agentes
+        return sum(len(queue) for queue in list(self._pending.values()))
+
+    def depths(self):
+        """{agent_id: trabajos pendientes} de los agentes con cola no vacía"""
+        return {agent_id: len(queue) for agent_id, queue in list(self._pending.items()) if queue}
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Generador de carga para el VPS: N agentes simulados y tráfico de impresión y
+báscula a ritmo fijo, con throughput y latencias p50/p95/p99
+
+    python load_test.py http://localhost:5000 --agents 500 --rate 100 --duration 60
+
+Cada agente simulado se registra y late como `register_with_vps` (o abre el
+canal WebSocket con --transport ws) y contesta los trabajos con la latencia y
+las tasas de fallo indicadas. La latencia de cada petición se mide desde el
+instante en que tocaba enviarla, así que una cola en el cliente también cuenta.
+
+Con --target-agent el tráfico va a agentes reales ya conectados (p. ej. uno con
+AGENT_SIMULATOR y los dispositivos virtuales de device_simulator.py, cuyo
+manifiesto indica las impresoras y básculas) para medir el agente completo.
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+
+# Canal WebSocket opcional (websocket-client) para --transport ws
+try:
+    import websocket
+    WEBSOCKET_AVAILABLE = True
+except ImportError:
+    WEBSOCKET_AVAILABLE = False
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def device_failed(body):
+    """200 del VPS pero la impresora o la báscula informó un error (sin papel...)"""
+    result = body.get('result') or body.get('weight') or {}
+    return result.get('status') == 'error' or 'error' in result
+
+
+class SimulatedAgent:
+    """Inventario e identidad de un agente falso"""
+
+    def __init__(self, run_id, index, printers):
+        self.agent_id = f"loadtest-{run_id}-{index:05d}"
+        self.printers = [
+            {'name': f'SIM-PRINTER-{n}', 'status': 'Disponible', 'type': 'Simulación'}
+            for n in range(printers)
+        ]
+        self.scales = [{'port': 'COM1', 'status': 'Disponible'}]
+        self.inventory_hash = hashlib.sha1(
+            json.dumps({'printers': self.printers, 'scales': self.scales}, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def registration(self):
+        return {
+            'agent_id': self.agent_id,
+            'platform': 'Windows',
+            'printers': self.printers,
+            'scales': self.scales,
+            'inventory_hash': self.inventory_hash,
+            'timestamp': time.time()
+        }
+
+    def heartbeat(self):
+        return {'agent_id': self.agent_id, 'inventory_hash': self.inventory_hash, 'timestamp': time.time()}
+
+
+class TargetAgent:
+    """Agente real ya registrado en el VPS, con los dispositivos del manifiesto"""
+
+    def __init__(self, agent_id, manifest):
+        self.agent_id = agent_id
+        self.printers = manifest.get('printers', [])
+        self.scales = manifest.get('scales', [])
+
+
+class LoadTester:
+    def __init__(self, base_url, agents=100, rate=50, duration=30, scale_ratio=0.2,
+                 latency_ms=50, jitter_ms=20, failure_rate=0.0, drop_rate=0.0,
+                 transport='http', concurrency=256, printers=2, heartbeat_interval=30,
+                 poll_wait=10, targets=()):
+        self.base_url = base_url.rstrip('/')
+        self.rate = rate
+        self.duration = duration
+        self.scale_ratio = scale_ratio
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.transport = transport
+        self.concurrency = concurrency
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_wait = poll_wait
+
+        run_id = uuid.uuid4().hex[:6]
+        self.simulated = [SimulatedAgent(run_id, index, printers) for index in range(agents)]
+        self.agents = self.simulated + list(targets)
+        self.stopped = threading.Event()
+        self.samples = []            # (tipo, status, latencia en s, terminada en s desde el inicio)
+        self.agent_jobs = Counter()  # trabajos recibidos por los agentes por resultado
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # Respuestas diferidas de los agentes: montículo (vence, orden, función)
+        self._due = []
+        self._due_cond = threading.Condition()
+        self._sequence = 0
+        self.responders = ThreadPoolExecutor(max_workers=32)
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    # --- Agentes simulados ---------------------------------------------------
+
+    def _answer(self, job):
+        """(segundos de latencia, resultado) o None si el agente no contesta"""
+        if random.random() < self.drop_rate:
+            return None
+        delay = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        failed = random.random() < self.failure_rate
+        payload = job.get('payload') or {}
+        timings = {'total': round(delay * 1000, 2)}
+
+        if job.get('type') == 'print':
+            result = {'printer': payload.get('printer_name'), 'status': 'error' if failed else 'printed'}
+            if failed:
+                result['error'] = 'Fallo simulado de impresora'
+            return delay, {'success': True, 'result': result, 'timings': timings}
+        if job.get('type') == 'print_batch':
+            status = 'error' if failed else 'printed'
+            results = [{'printer': item.get('printer_name'), 'status': status} for item in payload.get('jobs', [])]
+            return delay, {'success': True, 'results': results, 'timings': timings}
+        if job.get('type') == 'scale_read':
+            weight = {'port': payload.get('scale_port'), 'weight': round(random.uniform(0.1, 5), 3), 'unit': 'kg'}
+            if failed:
+                weight = {'port': payload.get('scale_port'), 'error': 'Fallo simulado de báscula'}
+            return delay, {'success': True, 'weight': weight, 'timings': timings}
+        if job.get('type') == 'scale_watch':
+            return delay, {'success': True, 'scale_port': payload.get('scale_port'), 'reading': None}
+        return delay, {'success': False, 'error': f"Tipo de trabajo desconocido: {job.get('type')}"}
+
+    def _handle_job(self, job, send_result):
+        answer = self._answer(job)
+        with self._lock:
+            self.agent_jobs['dropped' if answer is None else 'answered'] += 1
+        if answer is not None:
+            delay, result = answer
+            self._schedule(delay, lambda: send_result(job['job_id'], result))
+
+    def _schedule(self, delay, action):
+        with self._due_cond:
+            self._sequence += 1
+            heapq.heappush(self._due, (time.perf_counter() + delay, self._sequence, action))
+            self._due_cond.notify()
+
+    def _run_due(self):
+        while True:
+            with self._due_cond:
+                while not self._due or self._due[0][0] > time.perf_counter():
+                    self._due_cond.wait(self._due[0][0] - time.perf_counter() if self._due else None)
+                _, _, action = heapq.heappop(self._due)
+            self.responders.submit(self._safe, action)
+
+    def _safe(self, action):
+        try:
+            action()
+        except Exception:
+            pass
+
+    def _register(self, agent):
+        self._session().post(f"{self.base_url}/agent/register", json=agent.registration(), timeout=30)
+
+    def _poll_loop(self, agent):
+        """Agente HTTP: long-poll de trabajos y resultados por POST"""
+        session = requests.Session()
+
+        def send_result(job_id, result):
+            self._session().post(
+                f"{self.base_url}/agent/{agent.agent_id}/jobs/results",
+                json={'results': [{'job_id': job_id, 'result': result}]},
+                timeout=30
+            )
+
+        while not self.stopped.is_set():
+            try:
+                response = session.get(
+                    f"{self.base_url}/agent/{agent.agent_id}/jobs",
+                    params={'wait': self.poll_wait},
+                    timeout=self.poll_wait + 30
+                )
+                if response.status_code == 404:
+                    self._register(agent)
+                    continue
+                jobs = response.json().get('jobs', []) if response.status_code == 200 else []
+            except requests.RequestException:
+                time.sleep(1)
+                continue
+            for job in jobs:
+                self._handle_job(job, send_result)
+
+    def _heartbeat_loop(self):
+        """Latidos HTTP repartidos a lo largo del intervalo, como register_with_vps"""
+        pause = self.heartbeat_interval / max(len(self.simulated), 1)
+        while not self.stopped.is_set():
+            for agent in self.simulated:
+                if self.stopped.is_set():
+                    return
+                self.responders.submit(self._safe, lambda agent=agent: self._heartbeat(agent))
+                time.sleep(pause)
+
+    def _heartbeat(self, agent):
+        response = self._session().post(f"{self.base_url}/agent/register", json=agent.heartbeat(), timeout=30)
+        if response.status_code == 200 and response.json().get('inventory_required'):
+            self._register(agent)
+
+    def _channel_loop(self, agent):
+        """Agente WebSocket: registro, latidos, trabajos y resultados por el canal"""
+        url = 'ws' + self.base_url[4:] + f"/agent/{agent.agent_id}/ws"
+        send_lock = threading.Lock()
+        while not self.stopped.is_set():
+            try:
+                ws = websocket.create_connection(url, timeout=30)
+            except Exception:
+                time.sleep(1)
+                continue
+
+            def send(message):
+                with send_lock:
+                    ws.send(json.dumps(dict(message, id=message.get('id') or uuid.uuid4().hex)))
+
+            def send_result(job_id, result):
+                send({'type': 'result', 'id': job_id, 'result': result})
+
+            try:
+                send({'type': 'register', 'data': agent.registration()})
+                ws.settimeout(self.heartbeat_interval)
+                while not self.stopped.is_set():
+                    try:
+                        raw = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        send({'type': 'heartbeat', 'inventory_hash': agent.inventory_hash})
+                        continue
+                    if not raw:
+                        break
+                    message = json.loads(raw)
+                    if message.get('type') == 'job':
+                        self._handle_job(message['job'], send_result)
+                    elif message.get('inventory_required') or message.get('code') == 'unknown_agent':
+                        send({'type': 'register', 'data': agent.registration()})
+            except Exception:
+                pass
+            finally:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+
+    def start_agents(self):
+        if not self.simulated:
+            return
+        threading.Thread(target=self._run_due, daemon=True).start()
+        print(f"Registrando {len(self.simulated)} agentes simulados ({self.transport})...")
+        if self.transport == 'ws':
+            for agent in self.simulated:
+                threading.Thread(target=self._channel_loop, args=(agent,), daemon=True).start()
+        else:
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                list(pool.map(self._register, self.simulated))
+            for agent in self.simulated:
+                threading.Thread(target=self._poll_loop, args=(agent,), daemon=True).start()
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        # Margen para que los long-poll/canales estén abiertos antes de medir
+        time.sleep(2)
+
+    # --- Tráfico de clientes POS ---------------------------------------------
+
+    def _request(self, intended):
+        agent = random.choice(self.agents)
+        kind = 'scale' if agent.scales and random.random() < self.scale_ratio else 'print'
+        session = self._session()
+        try:
+            if kind == 'print':
+                response = session.post(
+                    f"{self.base_url}/agent/{agent.agent_id}/print",
+                    json={
+                        'printer_name': random.choice(agent.printers)['name'],
+                        'content': {'items': [{'name': 'Producto', 'price': 10.0, 'qty': 1}], 'total': 10.0}
+                    },
+                    timeout=60
+                )
+            else:
+                response = session.post(
+                    f"{self.base_url}/agent/{agent.agent_id}/scale/read",
+                    json={'scale_port': random.choice(agent.scales)['port']},
+                    timeout=60
+                )
+            status = response.status_code
+            if status == 200 and device_failed(response.json()):
+                status = 'device_error'
+        except requests.RequestException:
+            status = 'error'
+        finished = time.perf_counter()
+        with self._lock:
+            self.samples.append((kind, status, finished - intended, finished - self.started))
+
+    def drive(self):
+        """Enviar `rate` peticiones por segundo durante `duration` segundos"""
+        total = int(self.rate * self.duration)
+        print(f"Enviando {total} peticiones a {self.rate}/s durante {self.duration}s...")
+        clients = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.started = time.perf_counter()
+        cpu_started = time.process_time()
+        for index in range(total):
+            intended = self.started + index / self.rate
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            clients.submit(self._request, intended)
+        clients.shutdown(wait=True)
+        # Si el propio generador se come la CPU, las latencias miden al cliente
+        self.generator_cpu = (time.process_time() - cpu_started) / (time.perf_counter() - self.started)
+        self.stopped.set()
+
+    def run(self):
+        self.start_agents()
+        self.drive()
+        return self.print_summary()
+
+    # --- Informe ---------------------------------------------------------------
+
+    def summarize(self, samples):
+        latencies = sorted(sample[2] for sample in samples)
+        statuses = Counter(str(sample[1]) for sample in samples)
+        # Throughput: respuestas 200 por segundo hasta la última de ellas (los
+        # timeouts de trabajos sin respuesta no alargan la ventana)
+        ok = [sample[3] for sample in samples if sample[1] == 200]
+        window = max(ok + [self.duration]) if ok else self.duration
+        return {
+            'requests': len(samples),
+            'throughput': round(len(ok) / window, 2),
+            'ok_rate': round(statuses.get('200', 0) / len(samples), 4) if samples else 0,
+            'status': dict(statuses),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round((latencies[-1] if latencies else 0) * 1000, 2)
+        }
+
+    def print_summary(self):
+        report = {
+            'config': {
+                'base_url': self.base_url, 'agents': len(self.simulated),
+                'targets': [agent.agent_id for agent in self.agents[len(self.simulated):]], 'rate': self.rate,
+                'duration': self.duration, 'transport': self.transport,
+                'latency_ms': self.latency_ms, 'jitter_ms': self.jitter_ms,
+                'failure_rate': self.failure_rate, 'drop_rate': self.drop_rate
+            },
+            'all': self.summarize(self.samples),
+            'print': self.summarize([s for s in self.samples if s[0] == 'print']),
+            'scale': self.summarize([s for s in self.samples if s[0] == 'scale']),
+            'agent_jobs': dict(self.agent_jobs),
+            'generator_cpu': round(self.generator_cpu, 2),
+            'timestamp': datetime.now().isoformat()
+        }
+
+        print("\n" + "=" * 60)
+        print("RESULTADOS DE CARGA")
+        print("=" * 60)
+        print(f"Objetivo: {self.rate}/s durante {self.duration}s con {len(self.agents)} agentes")
+        for name in ('all', 'print', 'scale'):
+            stats = report[name]
+            print(
+                f"{name:>6}: {stats['requests']} peticiones, {stats['throughput']}/s, "
+                f"OK {stats['ok_rate'] * 100:.1f}%, p50 {stats['p50_ms']}ms, "
+                f"p95 {stats['p95_ms']}ms, p99 {stats['p99_ms']}ms, máx {stats['max_ms']}ms"
+            )
+            print(f"        status: {stats['status']}")
+        print(f"Trabajos en agentes: {report['agent_jobs']}")
+        print(f"CPU del generador: {self.generator_cpu * 100:.0f}% de un núcleo")
+        if self.generator_cpu > 0.8:
+            print("⚠️ El generador está cerca de saturar su CPU: lanzarlo en otra máquina o usar --transport ws")
+
+        self.save_results(report)
+        return report
+
+    def save_results(self, report):
+        """Guardar resultados en archivo JSON"""
+        try:
+            filename = f"load_test_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"\nResultados guardados en: {filename}")
+        except Exception as e:
+            print(f"\nNo se pudieron guardar resultados: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga del VPS con agentes simulados")
+    parser.add_argument('base_url', nargs='?', default="http://localhost:5000")
+    parser.add_argument('--agents', type=int, help="agentes simulados (100, o 0 con --target-agent)")
+    parser.add_argument('--rate', type=float, default=50, help="peticiones por segundo")
+    parser.add_argument('--duration', type=float, default=30, help="segundos de carga")
+    parser.add_argument('--scale-ratio', type=float, default=0.2, help="fracción de lecturas de báscula")
+    parser.add_argument('--latency-ms', type=float, default=50, help="latencia media del agente")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="desviación de la latencia")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fracción de trabajos con error de dispositivo")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="fracción de trabajos sin respuesta")
+    parser.add_argument('--transport', choices=('http', 'ws'), default='http')
+    parser.add_argument('--concurrency', type=int, default=256, help="peticiones simultáneas máximas del cliente")
+    parser.add_argument('--printers', type=int, default=2, help="impresoras por agente")
+    parser.add_argument('--target-agent', action='append', default=[], help="agente real al que enviar tráfico")
+    parser.add_argument('--manifest', default='simulated_devices.json', help="dispositivos de los agentes reales")
+    args = parser.parse_args()
+
+    if args.transport == 'ws' and not WEBSOCKET_AVAILABLE:
+        parser.error("--transport ws requiere websocket-client")
+
+    targets = []
+    if args.target_agent:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        targets = [TargetAgent(agent_id, manifest) for agent_id in args.target_agent]
+    if args.agents is None:
+        args.agents = 0 if targets else 100
+
+    tester = LoadTester(
+        args.base_url, agents=args.agents, rate=args.rate, duration=args.duration,
+        scale_ratio=args.scale_ratio, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        failure_rate=args.failure_rate, drop_rate=args.drop_rate, transport=args.transport,
+        concurrency=args.concurrency, printers=args.printers, targets=targets
+    )
+    tester.run()
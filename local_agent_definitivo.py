@@ -11,6 +11,14 @@ import serial
 import logging
 import json
 import os
+import uuid
+import hashlib
+import select
+import socket
+import ipaddress
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 # Detectar sistema operativo
@@ -38,6 +46,25 @@ def safe_import_win32():
 if IS_WINDOWS:
     WIN32_AVAILABLE = safe_import_win32()
 
+# Canal WebSocket opcional (websocket-client); sin él se usa HTTP + long-poll
+try:
+    import websocket
+    WEBSOCKET_AVAILABLE = True
+except ImportError:
+    WEBSOCKET_AVAILABLE = False
+
+# Dispositivos raw (pty del simulador, /dev/usb/lp*) solo fuera de Windows
+try:
+    import termios
+except ImportError:
+    termios = None
+
+# Modo simulador: impresoras y básculas virtuales de device_simulator.py
+SIMULATED_DEVICES = None
+if os.environ.get('AGENT_SIMULATOR'):
+    with open(os.environ['AGENT_SIMULATOR']) as f:
+        SIMULATED_DEVICES = json.load(f)
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -51,7 +78,8 @@ else:
     USER_DATA_DIR = Path.cwd()
     AGENT_LOG_FILE = USER_DATA_DIR / "agent.log"
 
-# Leer configuración
+# Leer configuración (sin agent_config.json se usa el VPS por defecto)
+VPS_URL = "http://18.222.185.0:5000"
 try:
     config_files = [
         USER_DATA_DIR / "agent_config.json",  # Preferir carpeta de usuario
@@ -67,12 +95,224 @@ try:
 except:
     VPS_URL = "http://18.222.185.0:5000"
 
-AGENT_ID = f"agent-{platform.node()}-{int(time.time())}"
+def load_agent_id():
+    """Id estable del agente, persistido en la carpeta de datos entre reinicios"""
+    id_file = USER_DATA_DIR / "agent_id"
+    try:
+        if id_file.exists():
+            agent_id = id_file.read_text().strip()
+            if agent_id:
+                return agent_id
+    except Exception as e:
+        logger.warning(f"No se pudo leer {id_file}: {e}")
+    
+    agent_id = f"agent-{platform.node()}-{uuid.uuid4().hex[:8]}"
+    try:
+        id_file.write_text(agent_id)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar {id_file}: {e}")
+    return agent_id
+
+AGENT_ID = load_agent_id()
+
+# Segundos que el VPS retiene el long-poll de trabajos
+JOB_POLL_WAIT = 25
+
+# Latido del canal WebSocket cuando no hay otro tráfico
+HEARTBEAT_INTERVAL = 30
+
+# Cada cuánto se re-escanean impresoras y básculas (los latidos solo llevan el hash)
+INVENTORY_RESCAN_INTERVAL = 300
+
+# Cuánto se recuerdan las impresiones por Idempotency-Key
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_MAX_ENTRIES = 5000
+PRINT_WAIT_TIMEOUT = 30
+
+# Lectura continua de básculas para los streams del VPS
+SCALE_STREAM_INTERVAL = 0.05   # pausa entre lecturas
+SCALE_STREAM_KEEPALIVE = 1     # publicar aunque el peso no cambie
+SCALE_STREAM_MAX_AGE = 1       # una lectura continua más vieja no sirve a /scale/read
+
+# Impresoras raw (ESC/POS directo al dispositivo): GS r 1 pide el estado del
+# papel y la impresora lo contesta tras imprimir lo anterior
+PAPER_STATUS_QUERY = b'\x1dr\x01'
+PAPER_END_BITS = 0x0c
+RAW_STATUS_TIMEOUT = 5
+
+# Impresoras ESC/POS de red (raw/JetDirect, sin spooler). AGENT_NETWORK_PRINTERS
+# lista hosts fijos ("10.0.0.5,10.0.0.6:9101") y AGENT_PRINTER_SUBNETS las redes
+# en las que buscar ("192.168.1.0/24"); el sondeo se guarda NETWORK_PROBE_TTL
+NETWORK_PRINTER_PORT = 9100
+NETWORK_CONNECT_TIMEOUT = 3
+NETWORK_PROBE_TIMEOUT = 0.3
+NETWORK_PROBE_WORKERS = 64
+NETWORK_PROBE_TTL = 600
+NETWORK_PROBE_MAX_HOSTS = 4096
+
+# Handles de impresora abiertos entre trabajos
+HANDLE_IDLE_TIMEOUT = 60   # se cierran tras este tiempo sin uso
+HANDLE_CHECK_AFTER = 5     # si llevan parados más, se comprueban antes de reutilizarlos
+
+# Conexiones keep-alive reutilizadas hacia el VPS (long-poll, latidos y avisos)
+VPS_POOL_SIZE = 4
+
+def create_vps_session():
+    """Sesión HTTP compartida con pool de conexiones y reintentos de conexión"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=VPS_POOL_SIZE,
+        max_retries=requests.adapters.Retry(total=2, connect=2, read=0, backoff_factor=0.5)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+vps_session = create_vps_session()
 
 # Agent Flask para PC local
 agent_app = Flask(__name__)
 agent_app.config['SECRET_KEY'] = 'local-agent-secret'
 
+class StageTimer:
+    """Milisegundos por etapa (formateo, spooler, serie...) para Server-Timing"""
+    
+    def __init__(self):
+        self.stages = {}
+    
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+    
+    def as_dict(self):
+        return {name: round(ms, 2) for name, ms in self.stages.items()}
+
+class PrintInterrupted(Exception):
+    """
+    El dispositivo falló con parte del trabajo ya enviado: repetirlo
+    reimprimiría tickets, así que no se reintenta. `results` lleva el
+    resultado de cada ticket del lote.
+    """
+    
+    def __init__(self, error, results=None):
+        super().__init__(str(error))
+        self.results = results
+
+def interrupted_results(printer_name, error, count):
+    return [{'status': 'error', 'printer': printer_name, 'error': f"Envío interrumpido, no se reenvía: {error}"}
+            for _ in range(count)]
+
+class DeviceHandlePool:
+    """
+    Un handle abierto por dispositivo (OpenPrinter de win32, descriptor de un
+    dispositivo raw, socket) reutilizado por trabajos sucesivos, uno a la vez,
+    para que cada ticket cueste solo su escritura.
+
+    Un handle parado más de `check_after` segundos se comprueba antes de
+    usarlo; si falla durante un trabajo se cierra y, si era reutilizado (pudo
+    caducar sin que lo supiéramos) y aún no se había enviado nada, el trabajo
+    se repite una vez con uno nuevo. Si ya se había escrito algo, `use` lanza
+    PrintInterrupted y no se repite. Un hilo cierra los que llevan
+    `idle_timeout` segundos sin uso.
+    """
+    
+    def __init__(self, idle_timeout, check_after):
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._lock = threading.Lock()
+        self._entries = {}   # clave -> {'lock', 'handle', 'close', 'last_used', 'stale'}
+        threading.Thread(target=self._expire_idle, daemon=True).start()
+    
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    'lock': threading.Lock(), 'handle': None, 'close': None, 'last_used': 0, 'stale': False
+                }
+            return entry
+    
+    def _discard(self, entry):
+        handle, close = entry['handle'], entry['close']
+        entry['handle'], entry['stale'] = None, False
+        if handle is not None:
+            try:
+                close(handle)
+            except Exception:
+                pass
+    
+    def _healthy(self, entry, check):
+        try:
+            return check(entry['handle']) is not False
+        except Exception:
+            return False
+    
+    def run(self, key, open_handle, close_handle, use, check=None, timer=None):
+        """use(handle) con el handle de `key`, abriéndolo con open_handle() si hace falta"""
+        timer = timer or StageTimer()
+        entry = self._entry(key)
+        with entry['lock']:
+            for attempt in (1, 2):
+                reused = entry['handle'] is not None
+                if reused and check and time.time() - entry['last_used'] > self.check_after:
+                    with timer.stage('check'):
+                        if not self._healthy(entry, check):
+                            self._discard(entry)
+                            reused = False
+                if entry['handle'] is None:
+                    with timer.stage('open'):
+                        entry['handle'], entry['close'] = open_handle(), close_handle
+                try:
+                    return use(entry['handle'])
+                except Exception as e:
+                    self._discard(entry)
+                    if not reused or attempt == 2 or isinstance(e, PrintInterrupted):
+                        raise
+                    device_manager.log_action(f"♻️ Handle caducado de {key}, reabriendo", "WARNING")
+                finally:
+                    entry['last_used'] = time.time()
+                    if entry['stale']:
+                        self._discard(entry)
+    
+    def invalidate(self, key):
+        """Cerrar el handle de `key` al terminar el trabajo en curso"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry['stale'] = True
+    
+    def open_count(self):
+        return sum(1 for entry in list(self._entries.values()) if entry['handle'] is not None)
+    
+    def _expire_idle(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            now = time.time()
+            for key, entry in list(self._entries.items()):
+                if entry['handle'] is None or now - entry['last_used'] < self.idle_timeout:
+                    continue
+                # Si está en uso no se toca; se mirará en la siguiente vuelta
+                if entry['lock'].acquire(blocking=False):
+                    try:
+                        if entry['handle'] is not None and now - entry['last_used'] >= self.idle_timeout:
+                            self._discard(entry)
+                            device_manager.log_action(f"🔒 Handle de {key} cerrado por inactividad")
+                    finally:
+                        entry['lock'].release()
+
+printer_handles = DeviceHandlePool(HANDLE_IDLE_TIMEOUT, HANDLE_CHECK_AFTER)
+
+def server_timing_header(timings):
+    """Cabecera Server-Timing a partir de {etapa: ms}"""
+    if not timings:
+        return {}
+    return {'Server-Timing': ', '.join(f'{name};dur={ms}' for name, ms in timings.items())}
+
 class LocalDeviceManager:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
@@ -90,7 +330,12 @@ class LocalDeviceManager:
         try:
             printers = []
             
-            if IS_WINDOWS and WIN32_AVAILABLE:
+            if SIMULATED_DEVICES is not None:
+                printers = [
+                    {'name': printer['name'], 'status': printer['status'], 'type': printer['type']}
+                    for printer in SIMULATED_DEVICES.get('printers', [])
+                ]
+            elif IS_WINDOWS and WIN32_AVAILABLE:
                 self.log_action(f"Escaneando impresoras locales...")
                 printer_enum = win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL)
                 for printer in printer_enum:
@@ -102,6 +347,8 @@ class LocalDeviceManager:
                     printers.append(printer_info)
                     self.log_action(f"Impresora encontrada: {printer[2]}")
             
+            printers += network_printers.inventory()
+            
             self.log_action(f"Total impresoras encontradas: {len(printers)}")
             return printers
             
@@ -109,53 +356,55 @@ class LocalDeviceManager:
             self.log_action(f"Error escaneando impresoras: {e}", "ERROR")
             return [{'name': 'Demo Printer', 'status': 'Demo', 'type': 'Simulación'}]
     
-    def print_ticket(self, printer_name, content):
+    def print_ticket(self, printer_name, content, timer=None):
         """Imprimir ticket localmente - versión final robusta"""
+        return self.print_tickets(printer_name, [content], timer)[0]
+    
+    def print_tickets(self, printer_name, contents, timer=None):
+        """Imprimir varios tickets en un único documento del spooler (una página por ticket)"""
+        timer = timer or StageTimer()
         try:
-            self.log_action(f"🖨️ Intentando imprimir en: {printer_name}")
+            self.log_action(f"🖨️ Intentando imprimir {len(contents)} ticket(s) en: {printer_name}")
+            
+            device = raw_printer_device(printer_name)
+            if device:
+                return self._print_raw_device(printer_name, device, contents, timer)
+            
+            address = network_printers.address(printer_name)
+            if address:
+                return self._print_network(printer_name, address, contents, timer)
             
             if IS_WINDOWS and WIN32_AVAILABLE:
                 # Usar método directo con win32print
-                ticket_content = self._format_ticket(content)
-                self.log_action(f"✅ Contenido del ticket generado ({len(ticket_content)} caracteres)")
+                with timer.stage('format'):
+                    tickets = [self._format_ticket(content) for content in contents]
+                self.log_action(f"✅ Contenido de tickets generado ({sum(len(t) for t in tickets)} caracteres)")
                 
                 try:
-                    self.log_action(f"🔧 Abriendo impresora: {printer_name}")
-                    hPrinter = win32print.OpenPrinter(printer_name)
-                    
-                    self.log_action("📋 Iniciando documento RAW")
-                    # Document info: (job title, output file, data type)
-                    doc_info = ("Ticket", None, "RAW")
-                    win32print.StartDocPrinter(hPrinter, 1, doc_info)
-                    
-                    self.log_action("📄 Iniciando página")
-                    win32print.StartPagePrinter(hPrinter)
-                    
-                    self.log_action("🖨️ Enviando contenido a impresora")
-                    data = ticket_content.encode('utf-8')
-                    win32print.WritePrinter(hPrinter, data)
-                    
-                    self.log_action("✅ Finalizando página")
-                    win32print.EndPagePrinter(hPrinter)
-                    
-                    self.log_action("📋 Finalizando documento")
-                    win32print.EndDocPrinter(hPrinter)
-                    
-                    self.log_action("🔒 Cerrando impresora")
-                    win32print.ClosePrinter(hPrinter)
+                    # El handle de OpenPrinter queda abierto para los siguientes trabajos
+                    printer_handles.run(
+                        ('win32', printer_name),
+                        lambda: self._open_win32_printer(printer_name),
+                        win32print.ClosePrinter,
+                        lambda hPrinter: self._spool_tickets(hPrinter, tickets, timer),
+                        check=lambda hPrinter: win32print.GetPrinter(hPrinter, 2),
+                        timer=timer
+                    )
                     
                     self.log_action("🎉 ¡IMPRESIÓN REAL COMPLETADA EXITOSAMENTE!")
                     
                     # Registrar en archivo de log
-                    with open(USER_DATA_DIR / f"print_job_{int(time.time())}.txt", 'w') as f:
+                    with timer.stage('log_file'), open(USER_DATA_DIR / f"print_job_{int(time.time())}.txt", 'w') as f:
                         f.write(f"Fecha: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
                         f.write("Impresora: {}\n".format(printer_name))
                         f.write("Estado: ÉXITO\n")
-                        f.write("Contenido:\n")
-                        f.write(ticket_content)
-                        f.write("\n" + "="*50 + "\n")
+                        for ticket_content in tickets:
+                            f.write("Contenido:\n")
+                            f.write(ticket_content)
+                            f.write("\n" + "="*50 + "\n")
                     
-                    return {'status': 'success', 'printer': printer_name, 'method': 'real_print'}
+                    return [{'status': 'success', 'printer': printer_name, 'method': 'real_print'}
+                            for _ in tickets]
                     
                 except Exception as print_error:
                     error_msg = f"Error en impresión real: {print_error}"
@@ -168,21 +417,24 @@ class LocalDeviceManager:
                         f.write("Error: {}\n".format(str(print_error)))
                         f.write("\n" + "="*50 + "\n")
                     
-                    return {'status': 'error', 'printer': printer_name, 'error': str(print_error)}
+                    return [{'status': 'error', 'printer': printer_name, 'error': str(print_error)}
+                            for _ in tickets]
                     
             else:
                 self.log_action("🖥️ Sistema no-Windows, usando simulación")
-                return {'status': 'simulated', 'printer': printer_name}
+                return [{'status': 'simulated', 'printer': printer_name} for _ in contents]
                 
         except Exception as e:
             error_msg = f"Error general imprimiendo: {e}"
             self.log_action(error_msg, "ERROR")
-            return {'status': 'error', 'printer': printer_name, 'error': str(e)}
+            return [{'status': 'error', 'printer': printer_name, 'error': str(e)} for _ in contents]
     
     def scan_scales(self):
         """Escanear básculas locales"""
         scales = []
-        if IS_WINDOWS:
+        if SIMULATED_DEVICES is not None:
+            scales = [dict(scale) for scale in SIMULATED_DEVICES.get('scales', [])]
+        elif IS_WINDOWS:
             self.log_action("Escaneando puertos COM para básculas...")
             for i in range(1, 10):
                 port_name = f'COM{i}'
@@ -197,27 +449,31 @@ class LocalDeviceManager:
         self.log_action(f"Total básculas encontradas: {len(scales)}")
         return scales
     
-    def read_scale(self, port):
+    def read_scale(self, port, timer=None):
         """Leer báscula local"""
+        timer = timer or StageTimer()
         try:
             self.log_action(f"📊 Intentando leer báscula en puerto: {port}")
             
-            if IS_WINDOWS:
-                ser = serial.Serial(port, 9600, timeout=2)
-                time.sleep(0.5)
-                ser.write(b'P\r\n')
-                time.sleep(1)
-                response = ser.readline().decode('utf-8').strip()
-                ser.close()
+            if IS_WINDOWS or is_simulated_scale(port):
+                with timer.stage('open'):
+                    ser = serial.Serial(port, 9600, timeout=2)
+                with timer.stage('settle'):
+                    time.sleep(0.5)
+                with timer.stage('write'):
+                    ser.write(b'P\r\n')
+                with timer.stage('wait'):
+                    time.sleep(1)
+                with timer.stage('read'):
+                    response = ser.readline().decode('utf-8').strip()
+                    ser.close()
                 
                 self.log_action(f"Respuesta báscula: {response}")
                 
-                if ',' in response:
-                    parts = response.split(',')
-                    if len(parts) >= 3:
-                        weight = float(parts[2].strip().split()[0])
-                        self.log_action(f"✅ Peso leído: {weight} kg")
-                        return {'port': port, 'weight': weight, 'unit': 'kg'}
+                weight = parse_scale_response(response)
+                if weight is not None:
+                    self.log_action(f"✅ Peso leído: {weight} kg")
+                    return {'port': port, 'weight': weight, 'unit': 'kg'}
             
             default_weight = 1.23
             self.log_action(f"⚠️ Usando peso simulado: {default_weight} kg")
@@ -228,6 +484,110 @@ class LocalDeviceManager:
             self.log_action(error_msg, "ERROR")
             return {'port': port, 'error': str(e)}
     
+    def _open_win32_printer(self, printer_name):
+        self.log_action(f"🔧 Abriendo impresora: {printer_name}")
+        return win32print.OpenPrinter(printer_name)
+    
+    def _spool_tickets(self, hPrinter, tickets, timer):
+        """Un documento RAW del spooler con una página por ticket"""
+        # Document info: (job title, output file, data type)
+        doc_info = ("Ticket", None, "RAW")
+        with timer.stage('start_doc'):
+            win32print.StartDocPrinter(hPrinter, 1, doc_info)
+        
+        # Con el documento abierto, un fallo ya no se repite: se intenta
+        # descartar lo encolado para que no salga medio lote
+        try:
+            for ticket_content in tickets:
+                win32print.StartPagePrinter(hPrinter)
+                with timer.stage('write'):
+                    win32print.WritePrinter(hPrinter, ticket_content.encode('utf-8'))
+                win32print.EndPagePrinter(hPrinter)
+            
+            with timer.stage('end_doc'):
+                win32print.EndDocPrinter(hPrinter)
+        except Exception as e:
+            try:
+                win32print.AbortPrinter(hPrinter)
+            except Exception:
+                pass
+            raise PrintInterrupted(e) from e
+    
+    def _print_raw_device(self, printer_name, device, contents, timer):
+        """Escribir cada ticket directo al dispositivo y confirmar el papel con GS r 1"""
+        with timer.stage('format'):
+            tickets = [self._format_ticket(content).encode('utf-8') for content in contents]
+        
+        def send(fd):
+            results = []
+            status = 0
+            for ticket in tickets:
+                # Si dejó de contestar no se le envían más tickets de este lote
+                if status is not None:
+                    try:
+                        with timer.stage('write'):
+                            write_all(fd, ticket + PAPER_STATUS_QUERY)
+                        with timer.stage('status'):
+                            status = read_paper_status(fd, RAW_STATUS_TIMEOUT)
+                    except Exception as e:
+                        # Sin nada escrito el pool puede repetir con otro descriptor
+                        if not results and not isinstance(e, PrintInterrupted):
+                            raise
+                        raise PrintInterrupted(
+                            e, results + interrupted_results(printer_name, e, len(tickets) - len(results))
+                        ) from e
+                    if status is None:
+                        # Una respuesta que llegue tarde se leería como la del siguiente ticket
+                        printer_handles.invalidate(device)
+                results.append(raw_print_result(printer_name, status))
+            return results
+        
+        try:
+            results = printer_handles.run(device, lambda: open_raw_device(device), os.close, send, fd_healthy, timer)
+        except PrintInterrupted as e:
+            self.log_action(f"❌ Envío a {device} interrumpido: {e}", "ERROR")
+            return e.results
+        self.log_action(f"✅ {len(results)} ticket(s) enviados a {device}")
+        return results
+    
+    def _print_network(self, printer_name, address, contents, timer):
+        """Tickets en tubería por la conexión persistente al puerto 9100"""
+        with timer.stage('format'):
+            tickets = [self._format_ticket(content).encode('utf-8') for content in contents]
+        
+        def submit(connection):
+            slots = []
+            try:
+                with timer.stage('write'):
+                    for ticket in tickets:
+                        slots.append(connection.submit(ticket))
+            except Exception as e:
+                # Sin nada enviado el pool puede repetir con otra conexión
+                if not slots and not isinstance(e, PrintInterrupted):
+                    raise
+                raise PrintInterrupted(e) from e
+            return connection, slots
+        
+        # Solo el envío ocupa la conexión: otro trabajo puede mandar los suyos
+        # mientras este espera los estados
+        try:
+            connection, slots = printer_handles.run(
+                ('tcp',) + address,
+                lambda: NetworkPrinterConnection(*address),
+                NetworkPrinterConnection.close,
+                submit,
+                check=lambda connection: not connection.closed,
+                timer=timer
+            )
+        except PrintInterrupted as e:
+            self.log_action(f"❌ Envío a {address[0]}:{address[1]} interrumpido: {e}", "ERROR")
+            return interrupted_results(printer_name, e, len(tickets))
+        with timer.stage('status'):
+            statuses = [connection.wait(slot, RAW_STATUS_TIMEOUT) for slot in slots]
+        
+        self.log_action(f"✅ {len(tickets)} ticket(s) enviados a {address[0]}:{address[1]}")
+        return [raw_print_result(printer_name, status, method='network') for status in statuses]
+    
     def _format_ticket(self, content):
         """Formatear ticket"""
         lines = []
@@ -249,9 +609,320 @@ class LocalDeviceManager:
         lines.append('Gracias por su compra\n'.center(32) + '\n')
         return ''.join(lines)
 
+def parse_scale_response(response):
+    """Peso de una respuesta 'x,y,peso kg' de la báscula (None si no se entiende)"""
+    parts = response.split(',')
+    if len(parts) < 3:
+        return None
+    try:
+        return float(parts[2].strip().split()[0])
+    except (ValueError, IndexError):
+        return None
+
+def raw_printer_device(printer_name):
+    """Ruta del dispositivo de una impresora raw (None si va por el spooler)"""
+    for printer in (SIMULATED_DEVICES or {}).get('printers', []):
+        if printer['name'] == printer_name:
+            return printer['device']
+    return None
+
+def is_simulated_scale(port):
+    return any(scale['port'] == port for scale in (SIMULATED_DEVICES or {}).get('scales', []))
+
+def open_raw_device(device):
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+    if termios and os.isatty(fd):
+        # Descartar bytes pendientes de una apertura anterior
+        termios.tcflush(fd, termios.TCIFLUSH)
+    return fd
+
+def fd_healthy(fd):
+    """False si el dispositivo se desconectó (POLLHUP/POLLERR) o el fd ya no vale"""
+    poller = select.poll()
+    poller.register(fd, select.POLLHUP | select.POLLERR | select.POLLNVAL)
+    return not poller.poll(0)
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except OSError as e:
+            if len(view) < len(data):
+                raise PrintInterrupted(e) from e
+            raise
+
+def read_paper_status(fd, timeout):
+    """Byte de estado de GS r 1 o None si la impresora no contesta"""
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if not ready:
+        return None
+    data = os.read(fd, 1)
+    return data[0] if data else None
+
+def raw_print_result(printer_name, status, method='raw_device'):
+    if status is None:
+        return {'status': 'error', 'printer': printer_name, 'error': 'La impresora no responde'}
+    if status & PAPER_END_BITS:
+        return {'status': 'error', 'printer': printer_name, 'error': 'Impresora sin papel'}
+    return {'status': 'success', 'printer': printer_name, 'method': method}
+
+class NetworkPrinterConnection:
+    """
+    Socket persistente a una impresora de red con tickets en tubería: cada
+    ticket se envía seguido de GS r 1 sin esperar a los anteriores y un hilo
+    lector asigna en orden cada byte de estado a su ticket.
+    """
+    
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port), timeout=NETWORK_CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._lock = threading.Lock()
+        self._pending = deque()   # tickets enviados esperando su byte de estado
+        threading.Thread(target=self._read_statuses, daemon=True).start()
+    
+    def submit(self, ticket):
+        slot = {'event': threading.Event(), 'status': None}
+        with self._lock:
+            if self.closed:
+                raise ConnectionError('Conexión con la impresora cerrada')
+            self._pending.append(slot)
+            try:
+                self.sock.sendall(ticket + PAPER_STATUS_QUERY)
+            except OSError as e:
+                # Puede haber salido parte del ticket
+                raise PrintInterrupted(e) from e
+        return slot
+    
+    def wait(self, slot, timeout):
+        """Byte de estado del ticket o None si no llega a tiempo"""
+        if not slot['event'].wait(timeout):
+            # Un estado que llegue tarde se asignaría al ticket siguiente
+            self.close()
+        return slot['status']
+    
+    def _read_statuses(self):
+        try:
+            while True:
+                data = self.sock.recv(64)
+                if not data:
+                    break
+                for status in data:
+                    with self._lock:
+                        slot = self._pending.popleft() if self._pending else None
+                    if slot is not None:
+                        slot['status'] = status
+                        slot['event'].set()
+        except OSError:
+            pass
+        self.close()
+    
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for slot in pending:
+            slot['event'].set()
+
+def parse_printer_address(text):
+    """('host', puerto) de 'host' o 'host:puerto'"""
+    host, _, port = text.strip().partition(':')
+    return host, int(port or NETWORK_PRINTER_PORT)
+
+class NetworkPrinterDiscovery:
+    """
+    Impresoras de red: los hosts fijos más los que aceptan conexión al puerto
+    9100 en las subredes configuradas. El sondeo abre las conexiones en
+    paralelo (NETWORK_PROBE_WORKERS) y su resultado se guarda en memoria y en
+    disco; caducado se sigue usando mientras se repite en segundo plano.
+    """
+    
+    def __init__(self, hosts, subnets, cache_file, ttl):
+        self.hosts = [parse_printer_address(host) for host in hosts if host.strip()]
+        self.subnets = [subnet.strip() for subnet in subnets if subnet.strip()]
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._probing = False
+        self.found = []
+        self.probed_at = 0
+        self._load_cache()
+    
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache.get('subnets') == self.subnets:
+                self.found = [tuple(address) for address in cache['printers']]
+                self.probed_at = cache['probed_at']
+        except (OSError, ValueError, KeyError):
+            pass
+    
+    def _save_cache(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump({'subnets': self.subnets, 'printers': self.found, 'probed_at': self.probed_at}, f)
+        except OSError as e:
+            device_manager.log_action(f"No se pudo guardar la caché de impresoras de red: {e}", "WARNING")
+    
+    def _candidates(self):
+        candidates = []
+        for subnet in self.subnets:
+            try:
+                network = ipaddress.ip_network(subnet, strict=False)
+            except ValueError:
+                device_manager.log_action(f"⚠️ Subred no válida: {subnet}", "WARNING")
+                continue
+            if network.num_addresses > NETWORK_PROBE_MAX_HOSTS:
+                device_manager.log_action(f"⚠️ Subred {subnet} demasiado grande para sondear", "WARNING")
+                continue
+            candidates += [(str(host), NETWORK_PRINTER_PORT) for host in network.hosts()]
+        return candidates
+    
+    def _accepts(self, address):
+        try:
+            socket.create_connection(address, timeout=NETWORK_PROBE_TIMEOUT).close()
+            return True
+        except OSError:
+            return False
+    
+    def probe(self):
+        """Sondear las subredes y guardar las impresoras que contestan"""
+        candidates = self._candidates()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=NETWORK_PROBE_WORKERS) as pool:
+            found = [address for address, ok in zip(candidates, pool.map(self._accepts, candidates)) if ok]
+        with self._lock:
+            self.found, self.probed_at, self._probing = found, time.time(), False
+        self._save_cache()
+        device_manager.log_action(
+            f"🔎 {len(found)} impresora(s) de red en {len(candidates)} hosts "
+            f"({(time.perf_counter() - started):.1f}s)"
+        )
+        return found
+    
+    def addresses(self):
+        if self.subnets:
+            with self._lock:
+                stale = time.time() - self.probed_at > self.ttl
+                first = not self.probed_at
+                start_background = stale and not first and not self._probing
+                if start_background:
+                    self._probing = True
+            if first:
+                self.probe()
+            elif start_background:
+                threading.Thread(target=self.probe, daemon=True).start()
+        return list(dict.fromkeys(self.hosts + self.found))
+    
+    def inventory(self):
+        return [
+            {'name': f"{host}:{port}", 'status': 'Disponible', 'type': 'Red (raw 9100)'}
+            for host, port in self.addresses()
+        ]
+    
+    def address(self, printer_name):
+        """('host', puerto) si printer_name es una impresora de red conocida"""
+        try:
+            address = parse_printer_address(printer_name)
+        except ValueError:
+            return None
+        return address if address in self.hosts or address in self.found else None
+
+network_printers = NetworkPrinterDiscovery(
+    os.environ.get('AGENT_NETWORK_PRINTERS', '').split(',')
+    + (SIMULATED_DEVICES or {}).get('network_printers', []),
+    os.environ.get('AGENT_PRINTER_SUBNETS', '').split(','),
+    USER_DATA_DIR / "network_printers.json",
+    NETWORK_PROBE_TTL
+)
+
 # Instancia del gestor de dispositivos
 device_manager = LocalDeviceManager()
 
+class ScaleWatcher:
+    """
+    Lectura continua de básculas mientras el VPS renueve el lease de cada
+    puerto: el puerto serie queda abierto y cada lectura se publica al VPS si
+    el peso cambió (o cada SCALE_STREAM_KEEPALIVE segundos). Las lecturas
+    puntuales del mismo puerto usan la última lectura en vez de abrirlo otra vez.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watches = {}   # puerto -> {'until', 'latest'}
+    
+    def watch(self, port, duration):
+        """Leer `port` durante `duration` segundos más; devuelve la última lectura"""
+        with self._lock:
+            watch = self._watches.get(port)
+            if watch is None:
+                watch = self._watches[port] = {'until': 0, 'latest': None}
+                threading.Thread(target=self._run, args=(port,), daemon=True).start()
+                device_manager.log_action(f"📡 Lectura continua de báscula en {port}")
+            watch['until'] = max(watch['until'], time.time() + duration)
+            return watch['latest']
+    
+    def latest(self, port, max_age=SCALE_STREAM_MAX_AGE):
+        watch = self._watches.get(port)
+        reading = watch and watch['latest']
+        if reading and time.time() - reading['timestamp'] <= max_age:
+            return reading
+        return None
+    
+    def _read_once(self, ser, port):
+        if ser is None:
+            return {'port': port, 'weight': 1.23, 'unit': 'kg', 'simulated': True}
+        ser.reset_input_buffer()
+        ser.write(b'P\r\n')
+        weight = parse_scale_response(ser.readline().decode('utf-8', 'replace').strip())
+        if weight is None:
+            return None
+        return {'port': port, 'weight': weight, 'unit': 'kg'}
+    
+    def _run(self, port):
+        ser = None
+        last_sent = None
+        try:
+            if IS_WINDOWS or is_simulated_scale(port):
+                ser = serial.Serial(port, 9600, timeout=SCALE_STREAM_KEEPALIVE)
+            while True:
+                with self._lock:
+                    watch = self._watches[port]
+                    if time.time() > watch['until']:
+                        self._watches.pop(port, None)
+                        break
+                
+                reading = self._read_once(ser, port)
+                if reading is not None:
+                    reading['timestamp'] = time.time()
+                    watch['latest'] = reading
+                    if (last_sent is None or last_sent['weight'] != reading['weight']
+                            or reading['timestamp'] - last_sent['timestamp'] >= SCALE_STREAM_KEEPALIVE):
+                        notify_vps('scale_stream', '/agent/scale-reading', {'reading': reading, 'stream': True})
+                        last_sent = reading
+                time.sleep(SCALE_STREAM_INTERVAL)
+        except Exception as e:
+            device_manager.log_action(f"Error en lectura continua de {port}: {e}", "ERROR")
+            with self._lock:
+                self._watches.pop(port, None)
+        finally:
+            if ser is not None:
+                ser.close()
+            device_manager.log_action(f"📡 Fin de lectura continua en {port}")
+
+scale_watcher = ScaleWatcher()
+
 @agent_app.route('/')
 def agent_index():
     return jsonify({
@@ -259,7 +930,8 @@ def agent_index():
         'status': 'running',
         'platform': platform.system(),
         'win32_available': WIN32_AVAILABLE,
-        'data_dir': str(USER_DATA_DIR)
+        'data_dir': str(USER_DATA_DIR),
+        'open_printer_handles': printer_handles.open_count()
     })
 
 @agent_app.route('/devices/printers', methods=['GET'])
@@ -271,28 +943,179 @@ def agent_get_printers():
         'agent_id': AGENT_ID
     })
 
-@agent_app.route('/print', methods=['POST'])
-def agent_print():
-    data = request.json
+class IdempotencyCache:
+    """
+    Respuestas ya servidas por Idempotency-Key (TTL y tamaño acotados). Es la
+    misma lógica que idempotency.py del VPS, copiada aquí porque el agente se
+    distribuye como un único archivo.
+    """
+    
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def run(self, key, fn, wait_timeout=None, cache_if=None):
+        """Ejecutar fn una sola vez por clave; devuelve (respuesta, repetida)"""
+        now = time.time()
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest['expires_at'] > now and len(self._entries) < self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+            
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = {'event': threading.Event(), 'response': None, 'expires_at': now + self.ttl}
+                self._entries[key] = entry
+        
+        if not owner:
+            entry['event'].wait(wait_timeout)
+            return entry['response'], True
+        
+        try:
+            entry['response'] = fn()
+            if cache_if is not None and not cache_if(entry['response']):
+                with self._lock:
+                    self._entries.pop(key, None)
+        except Exception:
+            with self._lock:
+                self._entries.pop(key, None)
+            raise
+        finally:
+            entry['event'].set()
+        return entry['response'], False
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+
+def print_succeeded(response):
+    """Solo se memorizan impresiones sin errores (un error se puede reintentar)"""
+    results = response.get('results') or [response.get('result') or {}]
+    return all(result.get('status') != 'error' for result in results)
+
+def run_idempotent(handler, data):
+    """Ejecutar una impresión una sola vez por idempotency_key"""
+    key = data.get('idempotency_key')
+    if not key:
+        return handler(data)
+    
+    response, replayed = idempotency_cache.run(
+        key, lambda: handler(data), wait_timeout=PRINT_WAIT_TIMEOUT, cache_if=print_succeeded
+    )
+    if response is None:
+        return {'success': False, 'error': 'Ya hay una impresión en curso con esta Idempotency-Key'}
+    if replayed:
+        device_manager.log_action(f"♻️ Reintento con Idempotency-Key {key}: no se re-imprime")
+    return response
+
+def run_print(data):
+    """Ejecutar una petición de impresión y devolver la respuesta"""
     printer_name = data.get('printer_name')
     content = data.get('content')
     
     device_manager.log_action(f"🖨️ Petición de impresión recibida para: {printer_name}")
-    result = device_manager.print_ticket(printer_name, content)
+    timer = StageTimer()
+    result = device_manager.print_ticket(printer_name, content, timer)
     
-    # Notificar al VPS que se imprimió
+    return {
+        'success': True,
+        'result': result,
+        'timings': timer.as_dict()
+    }
+
+def run_scale_read(data):
+    """Ejecutar una lectura de báscula y devolver la respuesta"""
+    scale_port = data.get('scale_port')
+    
+    timer = StageTimer()
+    # Si el puerto ya se está leyendo en continuo no se abre otra vez
+    weight = scale_watcher.latest(scale_port) or device_manager.read_scale(scale_port, timer)
+    
+    return {
+        'success': True,
+        'weight': weight,
+        'timings': timer.as_dict()
+    }
+
+def run_print_batch(data):
+    """Imprimir una ráfaga de tickets: un documento del spooler por impresora"""
+    jobs = data.get('jobs') or []
+    
+    # Agrupar por impresora conservando el orden de llegada
+    by_printer = {}
+    for index, job in enumerate(jobs):
+        by_printer.setdefault(job.get('printer_name'), []).append(index)
+    
+    results = [None] * len(jobs)
+    timer = StageTimer()
+    for printer_name, indexes in by_printer.items():
+        device_manager.log_action(f"🖨️ Lote de {len(indexes)} ticket(s) para: {printer_name}")
+        printed = device_manager.print_tickets(printer_name, [jobs[i].get('content') for i in indexes], timer)
+        for index, result in zip(indexes, printed):
+            results[index] = result
+    
+    return {
+        'success': True,
+        'results': results,
+        'timings': timer.as_dict()
+    }
+
+def run_scale_watch(data):
+    """Iniciar o prolongar la lectura continua de una báscula"""
+    scale_port = data.get('scale_port')
+    reading = scale_watcher.watch(scale_port, float(data.get('duration', 30)))
+    return {
+        'success': True,
+        'scale_port': scale_port,
+        'reading': reading
+    }
+
+JOB_HANDLERS = {
+    'print': lambda data: run_idempotent(run_print, data),
+    'print_batch': lambda data: run_idempotent(run_print_batch, data),
+    'scale_read': run_scale_read,
+    'scale_watch': run_scale_watch,
+}
+
+def request_data():
+    """Cuerpo JSON de la petición local con la cabecera Idempotency-Key incorporada"""
+    data = request.json or {}
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        data = dict(data, idempotency_key=key)
+    return data
+
+def notify_vps(msg_type, path, payload):
+    """Notificar al VPS por el canal WebSocket si está abierto, si no por HTTP"""
     try:
-        requests.post(f"{VPS_URL}/agent/print-completed", json={
-            'agent_id': AGENT_ID,
-            'result': result
-        }, timeout=5)
+        if vps_channel.send(msg_type, **payload):
+            return
+        vps_session.post(f"{VPS_URL}{path}", json=dict(payload, agent_id=AGENT_ID), timeout=5)
     except Exception as e:
         device_manager.log_action(f"Error notificando VPS: {e}")
+
+@agent_app.route('/print', methods=['POST'])
+def agent_print():
+    response = run_idempotent(run_print, request_data())
     
-    return jsonify({
-        'success': True,
-        'result': result
-    })
+    # Notificar al VPS que se imprimió
+    if 'result' in response:
+        notify_vps('print_completed', '/agent/print-completed', {'result': response['result']})
+    
+    return jsonify(response), 200, server_timing_header(response.get('timings'))
+
+@agent_app.route('/print/batch', methods=['POST'])
+def agent_print_batch():
+    response = run_idempotent(run_print_batch, request_data())
+    
+    # Notificar al VPS cada impresión
+    for result in response.get('results', []):
+        notify_vps('print_completed', '/agent/print-completed', {'result': result})
+    
+    return jsonify(response), 200, server_timing_header(response.get('timings'))
 
 @agent_app.route('/devices/scales', methods=['GET'])
 def agent_get_scales():
@@ -305,54 +1128,250 @@ def agent_get_scales():
 
 @agent_app.route('/scale/read', methods=['POST'])
 def agent_read_scale():
-    data = request.json
-    scale_port = data.get('scale_port')
-    
-    weight = device_manager.read_scale(scale_port)
+    response = run_scale_read(request.json)
     
     # Notificar al VPS la lectura
+    notify_vps('scale_reading', '/agent/scale-reading', {'reading': response['weight']})
+    
+    return jsonify(response), 200, server_timing_header(response.get('timings'))
+
+def execute_job(job):
+    """Ejecutar un trabajo recibido de la cola del VPS"""
+    handler = JOB_HANDLERS.get(job.get('type'))
+    if handler is None:
+        return {'success': False, 'error': f"Tipo de trabajo desconocido: {job.get('type')}"}
     try:
-        requests.post(f"{VPS_URL}/agent/scale-reading", json={
-            'agent_id': AGENT_ID,
-            'reading': weight
-        }, timeout=5)
-    except:
-        pass
+        started = time.perf_counter()
+        response = handler(job.get('payload') or {})
+        # Tiempo total en el agente: el VPS deduce de él el tiempo de cola y red
+        timings = dict(response.get('timings') or {}, total=round((time.perf_counter() - started) * 1000, 2))
+        return dict(response, timings=timings)
+    except Exception as e:
+        device_manager.log_action(f"Error ejecutando trabajo {job.get('job_id')}: {e}", "ERROR")
+        return {'success': False, 'error': str(e)}
+
+def poll_jobs():
+    """Drenar la cola de trabajos del VPS con long-poll (sin conexiones entrantes)"""
+    session = vps_session
+    while True:
+        try:
+            response = session.get(
+                f"{VPS_URL}/agent/{AGENT_ID}/jobs",
+                params={'wait': JOB_POLL_WAIT},
+                timeout=JOB_POLL_WAIT + 10
+            )
+            
+            if response.status_code != 200:
+                # 404 mientras el registro aún no ha llegado al VPS
+                device_manager.log_action(f"⚠️ Long-poll rechazado: {response.status_code}", "WARNING")
+                time.sleep(5)
+                continue
+            
+            jobs = response.json().get('jobs', [])
+            if not jobs:
+                continue
+            
+            device_manager.log_action(f"📥 {len(jobs)} trabajo(s) recibidos del VPS")
+            results = [
+                {'job_id': job['job_id'], 'result': execute_job(job)}
+                for job in jobs
+            ]
+            
+            session.post(
+                f"{VPS_URL}/agent/{AGENT_ID}/jobs/results",
+                json={'results': results},
+                timeout=10
+            )
+            
+        except Exception as e:
+            device_manager.log_action(f"Error en long-poll de trabajos: {e}", "ERROR")
+            time.sleep(5)
+
+class DeviceInventory:
+    """Inventario de dispositivos cacheado, con hash para latidos ligeros"""
     
-    return jsonify({
-        'success': True,
-        'weight': weight
-    })
+    def __init__(self, rescan_interval):
+        self.rescan_interval = rescan_interval
+        self.printers = []
+        self.scales = []
+        self.hash = None
+        self.scanned_at = 0
+        self._lock = threading.Lock()
+    
+    def refresh(self, force=False):
+        """Re-escanear si el inventario caducó; True si cambió el hash"""
+        with self._lock:
+            if not force and self.hash is not None and time.time() - self.scanned_at < self.rescan_interval:
+                return False
+            
+            printers = device_manager.get_printers()
+            scales = device_manager.scan_scales()
+            digest = hashlib.sha1(
+                json.dumps({'printers': printers, 'scales': scales}, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+            
+            changed = digest != self.hash
+            self.printers, self.scales, self.hash = printers, scales, digest
+            self.scanned_at = time.time()
+            return changed
+
+inventory = DeviceInventory(INVENTORY_RESCAN_INTERVAL)
+
+def collect_devices_info():
+    """Inventario de dispositivos que se envía al VPS al registrarse"""
+    inventory.refresh()
+    return {
+        'agent_id': AGENT_ID,
+        'platform': platform.system(),
+        'printers': inventory.printers,
+        'scales': inventory.scales,
+        'inventory_hash': inventory.hash,
+        'timestamp': time.time(),
+        'win32_available': WIN32_AVAILABLE,
+        'data_dir': str(USER_DATA_DIR)
+    }
+
+def heartbeat_info():
+    """Latido ligero: solo el hash del inventario"""
+    return {
+        'agent_id': AGENT_ID,
+        'inventory_hash': inventory.hash,
+        'timestamp': time.time()
+    }
 
 def register_with_vps():
-    """Registrar este agente con el VPS"""
+    """Registrar este agente con el VPS y mantener latidos ligeros"""
+    session = vps_session
+    send_full = True
     while True:
         try:
-            devices_info = {
-                'agent_id': AGENT_ID,
-                'platform': platform.system(),
-                'printers': device_manager.get_printers(),
-                'scales': device_manager.scan_scales(),
-                'timestamp': time.time(),
-                'win32_available': WIN32_AVAILABLE,
-                'data_dir': str(USER_DATA_DIR)
-            }
+            if inventory.refresh():
+                send_full = True
+            full = send_full
             
-            response = requests.post(
+            response = session.post(
                 f"{VPS_URL}/agent/register", 
-                json=devices_info, 
+                json=collect_devices_info() if full else heartbeat_info(), 
                 timeout=10
             )
             
             if response.status_code == 200:
-                device_manager.log_action(f"✅ Agente registrado exitosamente: {AGENT_ID}")
+                body = response.json()
+                if full:
+                    device_manager.log_action(f"✅ Agente registrado exitosamente: {AGENT_ID}")
+                
+                # El VPS pide el inventario completo si no coincide el hash
+                send_full = body.get('inventory_required', False)
+                if body.get('rescan'):
+                    inventory.refresh(force=True)
+                if send_full and not full:
+                    continue
             else:
                 device_manager.log_action(f"⚠️ Error registrando agente: {response.status_code}", "WARNING")
                 
         except Exception as e:
             device_manager.log_action(f"Error conexión VPS: {e}", "ERROR")
         
-        time.sleep(30)  # Registrar cada 30 segundos
+        time.sleep(30)  # Latido cada 30 segundos
+
+class VPSChannel:
+    """Canal WebSocket persistente con el VPS: tramas JSON con id de correlación"""
+    
+    def __init__(self, url):
+        self.url = url
+        self.ws = None
+        self._send_lock = threading.Lock()
+    
+    def send(self, msg_type, msg_id=None, **fields):
+        """Enviar una trama; False si el canal no está abierto"""
+        message = dict(fields, type=msg_type, id=msg_id or uuid.uuid4().hex)
+        with self._send_lock:
+            if self.ws is None:
+                return False
+            self.ws.send(json.dumps(message))
+        return True
+    
+    def run(self):
+        """Mantener el canal abierto; devuelve False si el VPS no lo soporta"""
+        while True:
+            try:
+                ws = websocket.create_connection(self.url, timeout=10)
+            except websocket.WebSocketBadStatusException as e:
+                device_manager.log_action(f"⚠️ VPS sin canal WebSocket ({e.status_code}), usando HTTP", "WARNING")
+                return False
+            except Exception as e:
+                device_manager.log_action(f"Error abriendo canal WebSocket: {e}", "ERROR")
+                time.sleep(5)
+                continue
+            
+            with self._send_lock:
+                self.ws = ws
+            device_manager.log_action(f"🔌 Canal WebSocket abierto con el VPS: {AGENT_ID}")
+            
+            try:
+                self.send('register', data=collect_devices_info())
+                ws.settimeout(HEARTBEAT_INTERVAL)
+                while True:
+                    try:
+                        raw = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        self._heartbeat()
+                        continue
+                    if not raw:
+                        break
+                    self._on_message(json.loads(raw))
+            except Exception as e:
+                device_manager.log_action(f"Canal WebSocket interrumpido: {e}", "ERROR")
+            finally:
+                with self._send_lock:
+                    self.ws = None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            
+            time.sleep(5)
+    
+    def _heartbeat(self):
+        # Solo se envía el inventario completo si cambió desde el último escaneo
+        if inventory.refresh():
+            self.send('register', data=collect_devices_info())
+        else:
+            self.send('heartbeat', inventory_hash=inventory.hash, timestamp=time.time())
+    
+    def _on_message(self, message):
+        msg_type = message.get('type')
+        if msg_type == 'job':
+            threading.Thread(target=self._run_job, args=(message['job'],), daemon=True).start()
+        elif msg_type == 'ack' and message.get('inventory_required'):
+            if message.get('rescan'):
+                inventory.refresh(force=True)
+            self.send('register', data=collect_devices_info())
+        elif msg_type == 'error' and message.get('code') == 'unknown_agent':
+            # El VPS se reinició y perdió el registro
+            self.send('register', data=collect_devices_info())
+        elif msg_type == 'error':
+            device_manager.log_action(f"⚠️ Error del VPS: {message.get('error')}", "WARNING")
+    
+    def _run_job(self, job):
+        result = execute_job(job)
+        try:
+            self.send('result', msg_id=job['job_id'], result=result)
+        except Exception as e:
+            device_manager.log_action(f"Error enviando resultado {job['job_id']}: {e}", "ERROR")
+
+vps_channel = VPSChannel(VPS_URL.replace('http', 'ws', 1) + f"/agent/{AGENT_ID}/ws")
+
+def connect_to_vps():
+    """Mantener la conexión con el VPS: canal WebSocket o, si no está disponible, HTTP"""
+    if WEBSOCKET_AVAILABLE and vps_channel.run():
+        return
+    
+    # Recoger trabajos del VPS (modelo pull, funciona detrás de NAT)
+    jobs_thread = threading.Thread(target=poll_jobs, daemon=True)
+    jobs_thread.start()
+    
+    register_with_vps()
 
 if __name__ == '__main__':
     print("🚀 Iniciando Agente Local Mejorado para POS")
@@ -364,8 +1383,8 @@ if __name__ == '__main__':
     print("📊 Este agente expone tus dispositivos locales al VPS")
     print("=" * 60)
     
-    # Iniciar registro en background
-    register_thread = threading.Thread(target=register_with_vps, daemon=True)
+    # Iniciar conexión con el VPS en background
+    register_thread = threading.Thread(target=connect_to_vps, daemon=True)
     register_thread.start()
     
     # Iniciar servidor del agente
@@ -0,0 +1,212 @@
+"""
+Métricas en formato de texto de Prometheus: contadores, histogramas y gauges
+"""
+import bisect
+import threading
+import weakref
+from abc import ABC, abstractmethod
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+
+class _ShardedMetric(_Metric, ABC):
+    """
+    Cada hilo escribe en su propio fragmento (threading.local), así que
+    registrar una observación no toma ningún lock; el lock solo se usa la
+    primera vez que un hilo o una combinación de etiquetas aparece. Al
+    exportar se suman los fragmentos. Cuando un hilo termina, su fragmento se
+    suma a `_retired` y se suelta: los hilos que van y vienen (gunicorn,
+    hilos de streams SSE) no hacen crecer la lista.
+
+    `max_series` acota la cardinalidad: las combinaciones de etiquetas que
+    lleguen después se agrupan en una serie "other".
+    """
+
+    def __init__(self, name, help_text, labels=(), max_series=None):
+        super().__init__(name, help_text, labels)
+        self.max_series = max_series
+        self._overflow = tuple('other' for _ in self.labels)
+        self._series = set()
+        self._shards = []
+        self._retired = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            finalizer = weakref.finalize(threading.current_thread(), self._retire, shard)
+            finalizer.atexit = False
+        return shard
+
+    def _retire(self, shard):
+        """Pasar el fragmento de un hilo terminado al acumulado"""
+        with self._lock:
+            self._shards.remove(shard)
+            for key, value in shard.items():
+                self._merge(self._retired, key, value)
+
+    @abstractmethod
+    def _merge(self, totals, key, value):
+        """Sumar `value` a la serie `key` de `totals`"""
+
+    def collect(self):
+        with self._lock:
+            shards = list(self._shards)
+            totals = {}
+            for key, value in self._retired.items():
+                self._merge(totals, key, value)
+        for shard in shards:
+            for key, value in dict(shard).items():
+                self._merge(totals, key, value)
+        return totals
+
+    def _key(self, values):
+        if self.max_series is None or values in self._series:
+            return values
+        with self._lock:
+            if values in self._series or len(self._series) < self.max_series:
+                self._series.add(values)
+                return values
+        return self._overflow
+
+
+class Counter(_ShardedMetric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=(), max_series=None):
+        super().__init__(name + '_total', help_text, labels, max_series)
+
+    def inc(self, *values, amount=1):
+        key = self._key(values)
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, totals, key, value):
+        totals[key] = totals.get(key, 0) + value
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(_ShardedMetric):
+    """Histograma con buckets fijos; cada fragmento guarda [cuentas por bucket..., suma]"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS, max_series=None):
+        super().__init__(name, help_text, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *values):
+        key = self._key(values)
+        shard = self._shard()
+        counts = shard.get(key)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 2)
+            shard[key] = counts
+        # El último bucket (+Inf) está en len(buckets); la suma va al final
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, totals, key, counts):
+        merged = totals.setdefault(key, [0] * len(counts))
+        for index, count in enumerate(counts):
+            merged[index] += count
+
+    def render(self):
+        lines = self._header()
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(round(counts[-1], 6))}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Valor calculado al exportar: `collect()` devuelve un número o {etiquetas: valor}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, collect, labels=()):
+        super().__init__(name, help_text, labels)
+        self._collect = collect
+
+    def render(self):
+        values = self._collect()
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = self._header()
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=(), max_series=None):
+        return self._add(Counter(name, help_text, labels, max_series))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS, max_series=None):
+        return self._add(Histogram(name, help_text, labels, buckets, max_series))
+
+    def gauge(self, name, help_text, collect, labels=()):
+        return self._add(Gauge(name, help_text, collect, labels))
+
+    def render(self):
+        """Exposición en formato de texto de Prometheus (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -97,6 +97,40 @@ def scale_reading():
             'error': str(e)
         }), 500
 
+@app.route('/api/device/events', methods=['POST'])
+def device_events():
+    """Recibir un lote de eventos del VPS: {'events': [...]}"""
+    try:
+        events = (request.json or {}).get('events')
+        if not isinstance(events, list):
+            return jsonify({
+                'success': False,
+                'error': 'Se esperaba una lista en events'
+            }), 400
+        
+        for event in events:
+            event_type = event.get('event')
+            if event_type == 'print_completed':
+                print_jobs.append({
+                    'result': event.get('result'),
+                    'completed_at': event.get('timestamp', time.time())
+                })
+            elif event_type == 'scale_reading':
+                scale_readings.append({
+                    'data': event.get('data'),
+                    'received_at': time.time()
+                })
+        
+        return jsonify({
+            'success': True,
+            'received': len(events)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
     """Obtener lista de dispositivos registrados"""
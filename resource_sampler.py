@@ -0,0 +1,73 @@
+"""
+Muestreo en segundo plano de recursos del sistema y contadores del servicio
+"""
+import logging
+import threading
+import time
+
+# psutil es opcional: sin él solo se publican los contadores del servicio
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+
+class ResourceSampler:
+    """
+    Un hilo refresca cada `interval` segundos CPU, memoria, disco y los
+    contadores que devuelve `collect()`, y guarda el resultado en una
+    instantánea inmutable. /health y /metrics solo leen esa instantánea, así
+    que un sondeo del balanceador nunca bloquea ni hace trabajo caro.
+    """
+
+    def __init__(self, collect=None, interval=5, disk_path='.'):
+        self.collect = collect
+        self.interval = interval
+        self.disk_path = disk_path
+        self.logger = logging.getLogger(__name__)
+        self._snapshot = {'sampled_at': None}
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        if PSUTIL_AVAILABLE:
+            # La primera llamada fija la referencia; las siguientes no bloquean
+            psutil.cpu_percent(interval=None)
+        self.sample()
+        threading.Thread(target=self._loop, daemon=True).start()
+        return self
+
+    def snapshot(self):
+        """Última muestra (diccionario compartido: no modificar)"""
+        return self._snapshot
+
+    def age(self):
+        """Segundos desde la última muestra (None si aún no hay ninguna)"""
+        sampled_at = self._snapshot['sampled_at']
+        return None if sampled_at is None else time.time() - sampled_at
+
+    def sample(self):
+        snapshot = {}
+        try:
+            if PSUTIL_AVAILABLE:
+                snapshot['cpu_percent'] = psutil.cpu_percent(interval=None)
+                snapshot['memory_percent'] = psutil.virtual_memory().percent
+                snapshot['disk_percent'] = psutil.disk_usage(self.disk_path).percent
+            if self.collect:
+                snapshot.update(self.collect())
+        except Exception as e:
+            # Conservar la muestra anterior; age() delata si se queda vieja
+            self.logger.error(f"Error muestreando recursos: {e}")
+            return
+        snapshot['sampled_at'] = time.time()
+        self._snapshot = snapshot
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
@@ -0,0 +1,186 @@
+"""
+Difusión de lecturas de báscula a clientes Server-Sent Events y última
+lectura por (agente, puerto) para responder sin ir al agente
+"""
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+
+
+def sse_event(reading):
+    """Trama SSE con una lectura"""
+    return f"event: reading\ndata: {json.dumps(reading)}\n\n"
+
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+class ScaleStreamHub:
+    """
+    Lecturas por (agent_id, puerto) repartidas a todos los suscriptores.
+
+    Cada suscriptor tiene una cola acotada: si un cliente va lento se
+    descartan sus lecturas más viejas, nunca se bloquea al agente ni a los
+    demás clientes. El agente solo lee la báscula mientras alguien renueve su
+    lease (`claim_renewal`), una vez por (agente, puerto) sin importar cuántos
+    clientes miren. La última lectura de cada báscula, continua o puntual,
+    sirve además de caché para `/scale/read?max_age_ms=`.
+    """
+
+    def __init__(self, max_queue=16):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers = {}   # (agent_id, port) -> set de colas
+        self._latest = {}        # (agent_id, port) -> última lectura
+        self._renewed = {}       # (agent_id, port) -> momento de la última renovación
+
+    def _new_queue(self):
+        return queue.Queue(self.max_queue)
+
+    def subscribe(self, agent_id, port):
+        subscription = self._new_queue()
+        with self._lock:
+            self._subscribers.setdefault((agent_id, port), set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, agent_id, port, subscription):
+        key = (agent_id, port)
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                # Sin clientes: el lease del agente vence solo y deja de leer
+                self._subscribers.pop(key, None)
+                self._renewed.pop(key, None)
+
+    def publish(self, agent_id, port, reading, received_at=None):
+        key = (agent_id, port)
+        reading = dict(reading, received_at=received_at or time.time())
+        with self._lock:
+            self._latest[key] = reading
+            subscribers = list(self._subscribers.get(key, ()))
+        for subscription in subscribers:
+            self._offer(subscription, reading)
+        return len(subscribers)
+
+    def _offer(self, subscription, reading):
+        while True:
+            try:
+                subscription.put_nowait(reading)
+                return
+            except queue.Full:
+                try:
+                    subscription.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def latest(self, agent_id, port):
+        return self._latest.get((agent_id, port))
+
+    def fresh(self, agent_id, port, max_age):
+        """Última lectura si llegó hace menos de `max_age` segundos (o None)"""
+        reading = self._latest.get((agent_id, port))
+        if reading and time.time() - reading['received_at'] <= max_age:
+            return reading
+        return None
+
+    def claim_renewal(self, agent_id, port, interval):
+        """True para un solo llamante cada `interval` segundos por (agente, puerto)"""
+        key = (agent_id, port)
+        now = time.time()
+        with self._lock:
+            if now - self._renewed.get(key, 0) < interval:
+                return False
+            self._renewed[key] = now
+            return True
+
+    def forget(self, agent_id):
+        with self._lock:
+            for key in [key for key in self._latest if key[0] == agent_id]:
+                if key not in self._subscribers:
+                    self._latest.pop(key, None)
+
+    def stream_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def next_reading(self, subscription, timeout):
+        """Siguiente lectura del suscriptor o None si pasan `timeout` segundos"""
+        try:
+            return subscription.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SharedScaleStreamHub(ScaleStreamHub):
+    """
+    Hub para varios workers de gunicorn (REGISTRY_BACKEND=sqlite): la lectura
+    llega al worker que tiene el canal del agente, pero el cliente SSE puede
+    estar en cualquier otro. Las lecturas se escriben en la tabla
+    scale_readings y un hilo por proceso, mientras tenga suscriptores, sondea
+    las filas nuevas y las difunde a los suyos. `publish` sigue entregando
+    solo en este proceso (p. ej. la lectura inicial de un scale_watch).
+    """
+
+    def __init__(self, store, max_queue=16, poll_interval=0.05):
+        super().__init__(max_queue)
+        self.store = store
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger(__name__)
+        self._last_id = None     # última fila de scale_readings ya difundida
+        threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def latest(self, agent_id, port):
+        # La última lectura pudo llegar a otro worker antes de abrir el stream
+        return super().latest(agent_id, port) or self.store.latest_scale_reading(agent_id, port, 0)
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self._lock:
+                    watched = set(self._subscribers)
+                if not watched:
+                    # Sin clientes no se sondea; al volver se empieza por lo nuevo
+                    self._last_id = None
+                    continue
+                if self._last_id is None:
+                    self._last_id = self.store.last_scale_reading_id()
+                    continue
+
+                rows = self.store.scale_readings_since(self._last_id)
+                if rows:
+                    self._last_id = rows[-1][0]
+                for _, agent_id, port, reading, received_at in rows:
+                    if (agent_id, port) in watched and 'error' not in reading:
+                        self.publish(agent_id, port, reading, received_at)
+            except Exception as e:
+                self.logger.error(f"Error sondeando lecturas compartidas: {e}")
+
+
+class AsyncScaleStreamHub(ScaleStreamHub):
+    """Misma difusión para la edición asyncio: colas asyncio en el bucle de eventos"""
+
+    def _new_queue(self):
+        return asyncio.Queue(self.max_queue)
+
+    def _offer(self, subscription, reading):
+        while True:
+            try:
+                subscription.put_nowait(reading)
+                return
+            except asyncio.QueueFull:
+                try:
+                    subscription.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+
+    async def next_reading(self, subscription, timeout):
+        try:
+            return await asyncio.wait_for(subscription.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,149 @@
+"""
+Reparto de agentes entre varios nodos del VPS con hashing consistente
+"""
+import bisect
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Cabecera que marca una petición ya reenviada por otro nodo (evita bucles)
+FORWARDED_HEADER = 'X-Shard-Forwarded-By'
+
+# Cabeceras de conexión que no se copian al reenviar
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host', 'content-length',
+    'content-encoding', 'accept-encoding'
+}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Anillo de hashing consistente con `vnodes` puntos virtuales por nodo.
+    Añadir o quitar un nodo solo mueve las claves de los arcos que ganaba o
+    perdía (~1/N del total); el resto sigue en el mismo dueño.
+    """
+
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self._lock = threading.Lock()
+        self._points = []   # hashes ordenados
+        self._owners = []   # nodo dueño de cada punto
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def add(self, node):
+        with self._lock:
+            if node in self._nodes:
+                return
+            self._nodes.add(node)
+            for index in range(self.vnodes):
+                point = _hash(f"{node}#{index}")
+                position = bisect.bisect(self._points, point)
+                self._points.insert(position, point)
+                self._owners.insert(position, node)
+
+    def remove(self, node):
+        with self._lock:
+            if node not in self._nodes:
+                return
+            self._nodes.discard(node)
+            kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+            self._points = [point for point, _ in kept]
+            self._owners = [owner for _, owner in kept]
+
+    def owner(self, key):
+        """Nodo dueño de `key` (None si el anillo está vacío)"""
+        points, owners = self._points, self._owners
+        if not points:
+            return None
+        position = bisect.bisect(points, _hash(key))
+        return owners[position % len(points)]
+
+
+class ShardRouter:
+    """
+    Decide qué nodo atiende a cada agente y reenvía allí las peticiones que
+    lleguen a otro nodo, reutilizando conexiones HTTP por nodo.
+
+    Los nodos se identifican por su URL base (la misma con la que los
+    alcanzan agentes y otros nodos). Con un solo nodo, o sin `self_url`,
+    todo es local.
+    """
+
+    def __init__(self, self_url=None, nodes=(), vnodes=160, pool_size=32,
+                 connect_timeout=3, read_timeout=35):
+        self.self_url = self_url.rstrip('/') if self_url else None
+        nodes = [node.rstrip('/') for node in nodes if node.strip()]
+        if self.self_url and self.self_url not in nodes:
+            nodes.append(self.self_url)
+        self.ring = HashRing(nodes, vnodes=vnodes)
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(nodes), 1), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def enabled(self):
+        return self.self_url is not None and len(self.ring.nodes) > 1
+
+    def owner(self, agent_id):
+        if not self.enabled:
+            return self.self_url
+        return self.ring.owner(agent_id)
+
+    def is_local(self, agent_id):
+        return not self.enabled or self.ring.owner(agent_id) == self.self_url
+
+    def forward(self, node, method, path, query=b'', headers=None, body=None, stream=False):
+        """
+        Reenviar una petición al nodo dueño; devuelve la respuesta de requests
+        (con `stream` el cuerpo se lee a medida que llega, p. ej. streams SSE)
+        """
+        url = f"{node}{path}"
+        if query:
+            url += '?' + (query.decode() if isinstance(query, bytes) else query)
+        headers = {name: value for name, value in (headers or {}).items() if name.lower() not in HOP_BY_HOP}
+        headers[FORWARDED_HEADER] = self.self_url
+        # Sin compresión entre nodos: el nodo de entrada comprime para el cliente
+        headers['Accept-Encoding'] = 'identity'
+        return self.session.request(
+            method, url, headers=headers, data=body, timeout=self.timeout, stream=stream
+        )
+
+
+def response_headers(response):
+    """Cabeceras de la respuesta del nodo dueño que se devuelven al cliente"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in HOP_BY_HOP and name.lower() not in ('server', 'date', 'server-timing')}
+
+
+def parse_server_timing(header):
+    """'dispatch;dur=12.5, total;dur=13' -> {'dispatch': 12.5, 'total': 13.0}"""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur' and name:
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+def websocket_url(http_url):
+    return 'ws' + http_url[4:] if http_url.startswith('http') else http_url
@@ -0,0 +1,567 @@
+"""
+Almacenamiento persistente del VPS en SQLite (modo WAL)
+
+Las escrituras se encolan y un hilo escritor las aplica en lote: todo lo
+pendiente se confirma en una sola transacción con executemany, así miles de
+altas/actualizaciones por segundo cuestan pocos fsync. Las lecturas usan una
+conexión por hilo y consultas con índices. El mismo hilo borra periódicamente
+el historial de trabajos y lecturas más antiguo que su retención.
+
+La base de datos también es el estado compartido entre workers de gunicorn
+(REGISTRY_BACKEND=sqlite): las operaciones que otro proceso debe ver al
+instante (registro, reclamar trabajos, resultados) se escriben de forma
+síncrona.
+"""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from itertools import groupby
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    agent_id   TEXT PRIMARY KEY,
+    platform   TEXT,
+    status     TEXT NOT NULL,           -- 'online' (activo) o 'evicted'
+    info       TEXT NOT NULL,
+    last_seen  REAL NOT NULL,
+    refresh_inventory INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_agents_status_id ON agents (status, agent_id);
+CREATE INDEX IF NOT EXISTS idx_agents_last_seen ON agents (last_seen);
+CREATE INDEX IF NOT EXISTS idx_agents_platform ON agents (platform, agent_id);
+
+-- Índice secundario de impresoras por nombre, mantenido por triggers al registrar
+CREATE TABLE IF NOT EXISTS agent_printers (
+    printer_name TEXT NOT NULL,
+    agent_id     TEXT NOT NULL,
+    PRIMARY KEY (printer_name, agent_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_agent_printers_agent ON agent_printers (agent_id);
+
+CREATE TRIGGER IF NOT EXISTS trg_agents_printers_insert AFTER INSERT ON agents BEGIN
+    INSERT OR IGNORE INTO agent_printers (printer_name, agent_id)
+    SELECT COALESCE(json_extract(value, '$.name'), value), NEW.agent_id
+    FROM json_each(NEW.info, '$.printers');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_agents_printers_update AFTER UPDATE OF info ON agents BEGIN
+    DELETE FROM agent_printers WHERE agent_id = NEW.agent_id;
+    INSERT OR IGNORE INTO agent_printers (printer_name, agent_id)
+    SELECT COALESCE(json_extract(value, '$.name'), value), NEW.agent_id
+    FROM json_each(NEW.info, '$.printers');
+END;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id       TEXT PRIMARY KEY,
+    agent_id     TEXT NOT NULL,
+    type         TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    payload      TEXT,
+    result       TEXT,
+    created_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_agent ON jobs (agent_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs (agent_id, created_at) WHERE status = 'queued';
+
+CREATE TABLE IF NOT EXISTS scale_readings (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent_id    TEXT NOT NULL,
+    port        TEXT,
+    weight      REAL,
+    unit        TEXT,
+    reading     TEXT NOT NULL,
+    created_at  REAL NOT NULL,          -- recepción en el VPS
+    agent_timestamp REAL                -- reloj del PC de la tienda, solo informativo
+);
+CREATE INDEX IF NOT EXISTS idx_readings_agent ON scale_readings (agent_id, port, created_at);
+CREATE INDEX IF NOT EXISTS idx_readings_created ON scale_readings (created_at);
+
+-- Huecos de admisión ocupados por los workers: una fila por trabajo en curso
+-- (printer NULL) y otra por cada impresora que ocupa; caducan solos si el
+-- worker muere sin liberarlos
+CREATE TABLE IF NOT EXISTS admission_slots (
+    agent_id   TEXT NOT NULL,
+    printer    TEXT,
+    owner      TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_admission_agent ON admission_slots (agent_id, printer, owner);
+"""
+
+UPSERT_AGENT = """
+INSERT INTO agents (agent_id, platform, status, info, last_seen) VALUES (?, ?, 'online', ?, ?)
+ON CONFLICT (agent_id) DO UPDATE SET
+    platform = excluded.platform, status = 'online', info = excluded.info, last_seen = excluded.last_seen
+"""
+TOUCH_AGENT = "UPDATE agents SET last_seen = ?, status = 'online' WHERE agent_id = ?"
+ARCHIVE_AGENT = "UPDATE agents SET status = 'evicted' WHERE agent_id = ?"
+INSERT_JOB = """
+INSERT OR IGNORE INTO jobs (job_id, agent_id, type, status, payload, created_at, updated_at)
+VALUES (?, ?, ?, 'queued', ?, ?, ?)
+"""
+UPDATE_JOB = "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE job_id = ?"
+UPDATE_JOB_STATUS = "UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?"
+CLAIM_JOBS = """
+UPDATE jobs SET status = 'dispatched', updated_at = ?
+WHERE job_id IN (
+    SELECT job_id FROM jobs WHERE agent_id = ? AND status = 'queued' ORDER BY created_at LIMIT ?
+)
+RETURNING job_id, type, payload, created_at
+"""
+COMPLETE_JOB = """
+UPDATE jobs SET status = 'completed', result = ?, updated_at = ?
+WHERE job_id = ? AND result IS NULL AND status IN ('queued', 'dispatched')
+"""
+INSERT_READING = """
+INSERT INTO scale_readings (agent_id, port, weight, unit, reading, created_at, agent_timestamp)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+LATEST_READING = """
+SELECT reading, created_at FROM scale_readings
+WHERE agent_id = ? AND port = ? AND created_at >= ?
+ORDER BY created_at DESC LIMIT 1
+"""
+
+# Retención: se borra por tandas para no retener el lock de escritura
+PURGE_JOBS = """
+DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs WHERE created_at < ? ORDER BY created_at LIMIT ?)
+"""
+PURGE_READINGS = """
+DELETE FROM scale_readings WHERE id IN (
+    SELECT id FROM scale_readings WHERE created_at < ? ORDER BY created_at LIMIT ?
+)
+"""
+PURGE_CHUNK = 5000
+
+JOB_COLUMNS = ('job_id', 'agent_id', 'type', 'status', 'payload', 'result', 'created_at', 'updated_at')
+
+
+class SQLiteStore:
+    def __init__(self, path, batch_size=1000, job_ttl=None, reading_ttl=None, sweep_interval=600):
+        self.path = path
+        self.batch_size = batch_size
+        # Segundos que se conservan trabajos y lecturas de báscula (None: siempre)
+        self.retention = [
+            (table, sql, ttl)
+            for table, sql, ttl in (('jobs', PURGE_JOBS, job_ttl), ('scale_readings', PURGE_READINGS, reading_ttl))
+            if ttl
+        ]
+        self.sweep_interval = sweep_interval
+        self.logger = logging.getLogger(__name__)
+        self._local = threading.local()
+        self._writes = queue.Queue()
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,      # transacciones explícitas
+            check_same_thread=False,
+            cached_statements=256      # sentencias preparadas reutilizadas
+        )
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _migrate(self, conn):
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(agents)')}
+        if 'refresh_inventory' not in columns:
+            conn.execute('ALTER TABLE agents ADD COLUMN refresh_inventory INTEGER NOT NULL DEFAULT 0')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(scale_readings)')}
+        if 'agent_timestamp' not in columns:
+            conn.execute('ALTER TABLE scale_readings ADD COLUMN agent_timestamp REAL')
+        # (status, agent_id) sustituye a (status): también sirve para paginar en orden
+        conn.execute('DROP INDEX IF EXISTS idx_agents_status')
+        if conn.execute('SELECT 1 FROM agent_printers LIMIT 1').fetchone() is None:
+            # Bases de datos anteriores al índice de impresoras
+            conn.execute(
+                "INSERT OR IGNORE INTO agent_printers (printer_name, agent_id) "
+                "SELECT COALESCE(json_extract(p.value, '$.name'), p.value), a.agent_id "
+                "FROM agents a, json_each(a.info, '$.printers') p WHERE a.status = 'online'"
+            )
+
+    def _connection(self):
+        """Conexión de lectura propia de cada hilo"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    # Escrituras en lote
+
+    def _write(self, sql, params, sync=False):
+        if sync:
+            return self._connection().execute(sql, params).rowcount
+        self._writes.put((sql, params))
+
+    def _write_loop(self):
+        conn = self._connect()
+        next_sweep = time.time() if self.retention else None
+        while True:
+            try:
+                timeout = None if next_sweep is None else max(next_sweep - time.time(), 0)
+                batch = [self._writes.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            waiters = [params for sql, params in batch if sql is None]
+            self._apply(conn, [op for op in batch if op[0] is not None])
+            for event in waiters:
+                event.set()
+
+            if next_sweep is not None and time.time() >= next_sweep:
+                self._sweep(conn)
+                next_sweep = time.time() + self.sweep_interval
+
+    def _apply(self, conn, ops):
+        if not ops:
+            return
+        try:
+            conn.execute('BEGIN')
+            for sql, group in groupby(ops, key=lambda op: op[0]):
+                conn.executemany(sql, [params for _, params in group])
+            conn.execute('COMMIT')
+        except Exception as e:
+            conn.execute('ROLLBACK')
+            self.logger.error(f"Error escribiendo lote en SQLite, reintentando una a una: {e}")
+            for sql, params in ops:
+                try:
+                    conn.execute(sql, params)
+                except Exception as op_error:
+                    self.logger.error(f"Escritura descartada: {op_error}")
+
+    def _sweep(self, conn):
+        """Borrar lo que supera la retención (índices por created_at), por tandas"""
+        now = time.time()
+        for table, sql, ttl in self.retention:
+            deleted = 0
+            try:
+                while True:
+                    count = conn.execute(sql, (now - ttl, PURGE_CHUNK)).rowcount
+                    deleted += count
+                    if count < PURGE_CHUNK:
+                        break
+            except Exception as e:
+                self.logger.error(f"Error aplicando la retención de {table}: {e}")
+            if deleted:
+                self.logger.info(f"Retención de {table}: {deleted} filas borradas")
+
+    def flush(self, timeout=None):
+        """Esperar a que se apliquen todas las escrituras encoladas"""
+        event = threading.Event()
+        self._writes.put((None, event))
+        return event.wait(timeout)
+
+    # Agentes
+
+    def upsert_agent(self, agent_id, info, last_seen=None, sync=False):
+        self._write(UPSERT_AGENT, (
+            agent_id, info.get('platform'), json.dumps(info), last_seen or time.time()
+        ), sync=sync)
+
+    def touch_agent(self, agent_id, last_seen=None):
+        self._write(TOUCH_AGENT, (last_seen or time.time(), agent_id))
+
+    def archive_agent(self, agent_id, sync=False):
+        self._write(ARCHIVE_AGENT, (agent_id,), sync=sync)
+
+    def get_agent(self, agent_id):
+        """(info, last_seen) de un agente activo, o None"""
+        row = self._connection().execute(
+            "SELECT info, last_seen FROM agents WHERE agent_id = ? AND status = 'online'", (agent_id,)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def list_agents(self, online_since, status=None):
+        """Agentes activos; `status` online/offline se decide por last_seen >= online_since"""
+        sql = "SELECT agent_id, info, last_seen FROM agents WHERE status = 'online'"
+        params = []
+        if status == 'online':
+            sql += ' AND last_seen >= ?'
+            params.append(online_since)
+        elif status == 'offline':
+            sql += ' AND last_seen < ?'
+            params.append(online_since)
+        rows = self._connection().execute(sql, params)
+        return [(agent_id, json.loads(info), last_seen) for agent_id, info, last_seen in rows]
+
+    def count_agents(self, online_since):
+        """(online, total) de los agentes activos"""
+        conn = self._connection()
+        online = conn.execute(
+            "SELECT COUNT(*) FROM agents WHERE status = 'online' AND last_seen >= ?", (online_since,)
+        ).fetchone()[0]
+        total = conn.execute("SELECT COUNT(*) FROM agents WHERE status = 'online'").fetchone()[0]
+        return online, total
+
+    def device_counts(self, online_since):
+        """(impresoras, básculas) declaradas por los agentes online"""
+        row = self._connection().execute(
+            "SELECT COALESCE(SUM(json_array_length(info, '$.printers')), 0), "
+            "COALESCE(SUM(json_array_length(info, '$.scales')), 0) "
+            "FROM agents WHERE status = 'online' AND last_seen >= ?", (online_since,)
+        ).fetchone()
+        return row[0], row[1]
+
+    def page_agents(self, online_since, status=None, platform=None, printer=None, limit=None, cursor=None):
+        """
+        Resumen (agent_id, platform, last_seen, impresoras, básculas) de los
+        agentes activos en orden de agent_id, filtrado con los índices
+        """
+        sql = ("SELECT agent_id, platform, last_seen, json_array_length(info, '$.printers'), "
+               "json_array_length(info, '$.scales') FROM agents WHERE status = 'online'")
+        params = []
+        if status == 'online':
+            sql += ' AND last_seen >= ?'
+            params.append(online_since)
+        elif status == 'offline':
+            sql += ' AND last_seen < ?'
+            params.append(online_since)
+        elif status is not None:
+            return []
+        if platform is not None:
+            sql += ' AND platform = ?'
+            params.append(platform)
+        if printer is not None:
+            sql += ' AND agent_id IN (SELECT agent_id FROM agent_printers WHERE printer_name = ?)'
+            params.append(printer)
+        if cursor is not None:
+            sql += ' AND agent_id > ?'
+            params.append(cursor)
+        sql += ' ORDER BY agent_id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self._connection().execute(sql, params).fetchall()
+
+    def evict_agents(self, seen_before=None, keep=None, offline_before=None):
+        """Archivar agentes vistos antes de `seen_before` y los offline más antiguos por encima de `keep`"""
+        conn = self._connection()
+        evicted = []
+        if seen_before is not None:
+            evicted += [row[0] for row in conn.execute(
+                "SELECT agent_id FROM agents WHERE status = 'online' AND last_seen < ?", (seen_before,)
+            )]
+        if keep is not None:
+            total = conn.execute("SELECT COUNT(*) FROM agents WHERE status = 'online'").fetchone()[0]
+            excess = total - len(evicted) - keep
+            if excess > 0:
+                evicted += [row[0] for row in conn.execute(
+                    "SELECT agent_id FROM agents WHERE status = 'online' AND last_seen < ? "
+                    "ORDER BY last_seen LIMIT ? OFFSET ?",
+                    (offline_before, excess, len(evicted))
+                )]
+        for agent_id in evicted:
+            self.archive_agent(agent_id, sync=True)
+        return evicted
+
+    def set_refresh(self, agent_id, flag):
+        return self._write(
+            'UPDATE agents SET refresh_inventory = ? WHERE agent_id = ?', (int(flag), agent_id), sync=True
+        )
+
+    def pop_refresh(self, agent_id):
+        """True si había una petición de inventario pendiente (y la consume)"""
+        return self._write(
+            'UPDATE agents SET refresh_inventory = 0 WHERE agent_id = ? AND refresh_inventory = 1',
+            (agent_id,), sync=True
+        ) > 0
+
+    def load_agents(self):
+        """Agentes no desalojados, para reconstruir el registro al arrancar"""
+        rows = self._connection().execute(
+            "SELECT agent_id, info, last_seen FROM agents WHERE status = 'online'"
+        )
+        return [(agent_id, json.loads(info), last_seen) for agent_id, info, last_seen in rows]
+
+    # Trabajos
+
+    def record_job(self, agent_id, job, sync=False):
+        self._write(INSERT_JOB, (
+            job['job_id'], agent_id, job['type'], json.dumps(job.get('payload')),
+            job['created_at'], job['created_at']
+        ), sync=sync)
+
+    def mark_jobs(self, job_ids, status):
+        now = time.time()
+        for job_id in job_ids:
+            self._write(UPDATE_JOB_STATUS, (status, now, job_id))
+
+    def finish_job(self, job_id, status, result=None):
+        self._write(UPDATE_JOB, (status, json.dumps(result), time.time(), job_id))
+
+    def claim_jobs(self, agent_id, limit):
+        """Reclamar de forma atómica los trabajos en cola de un agente"""
+        rows = self._connection().execute(CLAIM_JOBS, (time.time(), agent_id, limit)).fetchall()
+        jobs = [
+            {'job_id': job_id, 'type': job_type, 'payload': json.loads(payload), 'created_at': created_at}
+            for job_id, job_type, payload, created_at in rows
+        ]
+        jobs.sort(key=lambda job: job['created_at'])
+        return jobs
+
+    def requeue_jobs(self, job_ids):
+        for job_id in job_ids:
+            self._write(
+                "UPDATE jobs SET status = 'queued' WHERE job_id = ? AND status = 'dispatched' AND result IS NULL",
+                (job_id,), sync=True
+            )
+
+    def cancel_job(self, job_id):
+        """Retirar un trabajo que nadie ha reclamado aún"""
+        return self._write(
+            "UPDATE jobs SET status = 'timeout', updated_at = ? WHERE job_id = ? AND status = 'queued'",
+            (time.time(), job_id), sync=True
+        ) > 0
+
+    def complete_job(self, job_id, result):
+        return self._write(COMPLETE_JOB, (json.dumps(result), time.time(), job_id), sync=True) > 0
+
+    def job_results(self, job_ids):
+        """Resultados ya disponibles de los trabajos indicados"""
+        conn = self._connection()
+        results = []
+        job_ids = list(job_ids)
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            sql = ('SELECT job_id, result FROM jobs WHERE result IS NOT NULL AND job_id IN (%s)'
+                   % ','.join('?' * len(chunk)))
+            results += [(job_id, json.loads(result)) for job_id, result in conn.execute(sql, chunk)]
+        return results
+
+    def queued_agents(self):
+        """Agentes con trabajos en cola (índice parcial idx_jobs_queued)"""
+        return [row[0] for row in self._connection().execute(
+            "SELECT DISTINCT agent_id FROM jobs WHERE status = 'queued'"
+        )]
+
+    def queued_count(self, agent_id=None):
+        if agent_id is not None:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND agent_id = ?", (agent_id,)
+            ).fetchone()[0]
+        return self._connection().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def queued_counts(self):
+        """{agent_id: trabajos en cola} de los agentes con trabajos pendientes"""
+        return dict(self._connection().execute(
+            "SELECT agent_id, COUNT(*) FROM jobs WHERE status = 'queued' GROUP BY agent_id"
+        ))
+
+    def job_history(self, agent_id=None, status=None, before=None, limit=50):
+        """Últimos trabajos, filtrados por agente/estado; `before` pagina por created_at"""
+        clauses, params = [], []
+        if agent_id is not None:
+            clauses.append('agent_id = ?')
+            params.append(agent_id)
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+        if before is not None:
+            clauses.append('created_at < ?')
+            params.append(before)
+
+        sql = 'SELECT ' + ', '.join(JOB_COLUMNS) + ' FROM jobs'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at DESC LIMIT ?'
+        params.append(limit)
+
+        jobs = []
+        for row in self._connection().execute(sql, params):
+            job = dict(zip(JOB_COLUMNS, row))
+            job['payload'] = json.loads(job['payload']) if job['payload'] else None
+            job['result'] = json.loads(job['result']) if job['result'] else None
+            jobs.append(job)
+        return jobs
+
+    # Admisión compartida entre workers
+
+    def admit(self, agent_id, printers, agent_limit, printer_limit, owner, expires_at):
+        """Ocupar de forma atómica un hueco del agente y de sus impresoras; False si no caben"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM admission_slots WHERE agent_id = ? AND expires_at <= ?', (agent_id, now))
+            counts = dict(conn.execute(
+                'SELECT printer, COUNT(*) FROM admission_slots WHERE agent_id = ? GROUP BY printer', (agent_id,)
+            ))
+            fits = counts.get(None, 0) < agent_limit and all(
+                counts.get(printer, 0) < printer_limit for printer in printers
+            )
+            if fits:
+                conn.executemany(
+                    'INSERT INTO admission_slots (agent_id, printer, owner, expires_at) VALUES (?, ?, ?, ?)',
+                    [(agent_id, printer, owner, expires_at) for printer in (None,) + tuple(printers)]
+                )
+            conn.execute('COMMIT')
+            return fits
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release_admission(self, agent_id, printers, owner):
+        for printer in (None,) + tuple(printers):
+            self._write(
+                'DELETE FROM admission_slots WHERE rowid = (SELECT rowid FROM admission_slots '
+                'WHERE agent_id = ? AND printer IS ? AND owner = ? LIMIT 1)',
+                (agent_id, printer, owner), sync=True
+            )
+
+    def admission_counts(self):
+        """{agent_id: trabajos en curso} en todos los workers"""
+        return dict(self._connection().execute(
+            'SELECT agent_id, COUNT(*) FROM admission_slots WHERE printer IS NULL AND expires_at > ? '
+            'GROUP BY agent_id', (time.time(),)
+        ))
+
+    # Básculas
+
+    def record_scale_reading(self, agent_id, reading):
+        """Guardar una lectura con la hora de llegada al VPS (el reloj de la tienda puede ir desfasado)"""
+        reading = reading or {}
+        agent_timestamp = reading.get('timestamp')
+        if not isinstance(agent_timestamp, (int, float)):
+            agent_timestamp = None
+        self._write(INSERT_READING, (
+            agent_id, reading.get('port'), reading.get('weight'), reading.get('unit'),
+            json.dumps(reading), time.time(), agent_timestamp
+        ))
+
+    def last_scale_reading_id(self):
+        return self._connection().execute('SELECT COALESCE(MAX(id), 0) FROM scale_readings').fetchone()[0]
+
+    def scale_readings_since(self, last_id, limit=1000):
+        """Lecturas guardadas después de la fila `last_id`: (id, agente, puerto, lectura, recibida)"""
+        rows = self._connection().execute(
+            'SELECT id, agent_id, port, reading, created_at FROM scale_readings WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, limit)
+        )
+        return [(row_id, agent_id, port, json.loads(reading), created_at)
+                for row_id, agent_id, port, reading, created_at in rows]
+
+    def latest_scale_reading(self, agent_id, port, since):
+        """Lectura más reciente de (agente, puerto) recibida después de `since` (hora del VPS) o None"""
+        row = self._connection().execute(LATEST_READING, (agent_id, port, since)).fetchone()
+        if row is None:
+            return None
+        return dict(json.loads(row[0]), received_at=row[1])
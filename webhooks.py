@@ -0,0 +1,133 @@
+"""
+Entrega asíncrona y por lotes de eventos de dispositivos al POS en la nube
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class WebhookDispatcher:
+    """
+    Las peticiones de los agentes solo encolan el evento y responden. Un hilo
+    por destino junta eventos hasta `max_batch` o hasta que el más antiguo
+    lleve `flush_interval` segundos en cola, y los envía en un solo POST
+    {'events': [...]}.
+
+    Errores de red, 5xx y 429 se reintentan con backoff exponencial con
+    jitter (o lo que pida Retry-After) hasta `max_attempts`; mientras tanto
+    los eventos nuevos siguen acumulándose. Cada cola está acotada a
+    `max_queue`: si el destino no da abasto se descartan los más viejos.
+    """
+
+    def __init__(self, api_key=None, max_batch=100, flush_interval=1.0, max_queue=10000,
+                 max_attempts=5, backoff=0.5, max_backoff=30, timeout=10, on_result=None):
+        self.api_key = api_key
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.on_result = on_result   # on_result(url, resultado, eventos) para métricas
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._destinations = {}      # url -> {'queue': deque de (encolado, evento), 'cond'}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _destination(self, url):
+        destination = self._destinations.get(url)
+        if destination is None:
+            with self._lock:
+                destination = self._destinations.get(url)
+                if destination is None:
+                    destination = {'queue': deque(), 'cond': threading.Condition()}
+                    self._destinations[url] = destination
+                    threading.Thread(target=self._run, args=(url, destination), daemon=True).start()
+        return destination
+
+    def enqueue(self, url, event):
+        """Encolar un evento para `url` sin esperar a la entrega"""
+        destination = self._destination(url)
+        dropped = 0
+        with destination['cond']:
+            queue = destination['queue']
+            while len(queue) >= self.max_queue:
+                queue.popleft()
+                dropped += 1
+            queue.append((time.time(), event))
+            destination['cond'].notify()
+        if dropped:
+            self._record(url, 'dropped', dropped)
+
+    def depths(self):
+        """{url: eventos pendientes}"""
+        return {url: len(destination['queue']) for url, destination in list(self._destinations.items())}
+
+    def _record(self, url, outcome, count):
+        if self.on_result:
+            self.on_result(url, outcome, count)
+
+    def _next_batch(self, destination):
+        cond, queue = destination['cond'], destination['queue']
+        with cond:
+            while not queue:
+                cond.wait()
+            # Ventana de tiempo: esperar a llenar el lote o a que venza el más antiguo
+            while len(queue) < self.max_batch:
+                remaining = queue[0][0] + self.flush_interval - time.time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+            return [queue.popleft()[1] for _ in range(min(len(queue), self.max_batch))]
+
+    def _run(self, url, destination):
+        while True:
+            batch = self._next_batch(destination)
+            try:
+                self._deliver(url, batch)
+            except Exception as e:
+                self.logger.error(f"Error entregando eventos a {url}: {e}")
+                self._record(url, 'failed', len(batch))
+
+    def _deliver(self, url, batch):
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+
+        for attempt in range(1, self.max_attempts + 1):
+            retry_after = None
+            try:
+                response = self.session.post(url, json={'events': batch}, headers=headers, timeout=self.timeout)
+                if response.status_code < 300:
+                    self._record(url, 'delivered', len(batch))
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    # Rechazo definitivo (4xx): reintentar no va a cambiar nada
+                    self.logger.error(f"{url} rechazó {len(batch)} eventos: {response.status_code}")
+                    self._record(url, 'rejected', len(batch))
+                    return False
+                retry_after = response.headers.get('Retry-After')
+                error = f"status {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+
+            if attempt == self.max_attempts:
+                break
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+            if retry_after and retry_after.isdigit():
+                delay = min(self.max_backoff, int(retry_after))
+            self.logger.warning(f"Fallo entregando a {url} ({error}); reintento {attempt} en {delay:.1f}s")
+            time.sleep(delay)
+
+        self.logger.error(f"Se descartan {len(batch)} eventos para {url} tras {self.max_attempts} intentos")
+        self._record(url, 'failed', len(batch))
+        return False